@@ -12,9 +12,13 @@ from .models import (
     Inventory,
     InventoryItem,
     Product,
+    ProductMaterial,
     ProductMovement,
     ProductOutbound,
-    ProductOutboundItem
+    ProductOutboundItem,
+    MaterialStockCheckpoint,
+    ProductStockCheckpoint,
+    MaterialLocationStock
 )
 from django.utils.html import format_html
 from django.urls import reverse
@@ -29,25 +33,80 @@ class MaterialMovementInline(admin.TabularInline):
     readonly_fields = ['movement_date']
     can_delete = False
 
+class MaterialLocationStockInline(admin.TabularInline):
+    model = MaterialLocationStock
+    extra = 0
+    fields = ['location', 'stock', 'updated_at']
+    readonly_fields = ['location', 'stock', 'updated_at']
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
 class PurchaseItemInline(admin.TabularInline):
     model = PurchaseItem
     extra = 1
     fields = ['control_number', 'material', 'specification', 'quantity', 
               'unit', 'material_type', 'notes']
 
+class ProductMaterialInline(admin.TabularInline):
+    model = ProductMaterial
+    fk_name = 'product'
+    extra = 1
+    fields = ['material', 'component', 'quantity', 'scrap_rate', 'notes']
+    autocomplete_fields = ['material', 'component']
+
 @admin.register(Material)
 class MaterialAdmin(admin.ModelAdmin):
     list_display = ('code', 'name', 'specification', 'unit', 'stock')
     search_fields = ('code', 'name', 'specification')
-    inlines = [MaterialMovementInline]
+    inlines = [MaterialLocationStockInline, MaterialMovementInline]
+    change_list_template = 'admin/inventory/material/change_list.html'
+
+    def get_readonly_fields(self, request, obj=None):
+        # 总库存为各库位库存之和，只能通过变动记录过账修改
+        if obj is not None:
+            return ('stock',)
+        return ()
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('reconcile-stock/',
+                 self.admin_site.admin_view(self.reconcile_stock),
+                 name='inventory_reconcile_stock'),
+        ]
+        return custom_urls + urls
+
+    def reconcile_stock(self, request):
+        """库存与台账对账报告"""
+        from .stock_ledger import MATERIAL_LEDGER, PRODUCT_LEDGER
+
+        return TemplateResponse(
+            request,
+            'admin/inventory/reconcile_stock.html',
+            context={
+                **self.admin_site.each_context(request),
+                'title': '库存对账',
+                'opts': self.model._meta,
+                'material_drifts': list(MATERIAL_LEDGER.find_drift()),
+                'product_drifts': list(PRODUCT_LEDGER.find_drift()),
+            }
+        )
 
 @admin.register(MaterialMovement)
 class MaterialMovementAdmin(admin.ModelAdmin):
     list_display = ('material', 'movement_type', 'quantity', 'unit', 'movement_date', 'reference_number', 'purchase', 'batch')
-    list_filter = ('movement_type', 'material', 'movement_date')
+    list_filter = ('movement_type', 'reason', 'source_type', 'material', 'movement_date')
     search_fields = ('reference_number', 'notes', 'purchase__purchase_number')
     readonly_fields = ('movement_date',)
 
+    def get_readonly_fields(self, request, obj=None):
+        """已过账的变动记录只能修改备注等说明字段"""
+        if obj:
+            return self.readonly_fields + ('material', 'movement_type', 'quantity', 'location', 'batch')
+        return self.readonly_fields
+
 @admin.register(Supplier)
 class SupplierAdmin(admin.ModelAdmin):
     list_display = ('code', 'name', 'contact', 'phone', 'is_active')
@@ -139,6 +198,7 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ('is_active', 'customers')
     search_fields = ('code', 'name', 'specification')
     filter_horizontal = ('customers',)
+    inlines = [ProductMaterialInline]
     
     def get_customers_display(self, obj):
         """显示关联的客户"""
@@ -282,6 +342,8 @@ class ProductMovementAdmin(admin.ModelAdmin):
     ]
     list_filter = [
         'movement_type',
+        'reason',
+        'source_type',
         'movement_date',
         'product',
     ]
@@ -307,6 +369,22 @@ class MaterialBatchAdmin(admin.ModelAdmin):
     search_fields = ('batch_number', 'material__name', 'purchase__purchase_number')
     readonly_fields = ('created_at',)
 
+@admin.register(MaterialStockCheckpoint)
+class MaterialStockCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('material', 'date', 'stock', 'created_at')
+    list_filter = ('date',)
+    search_fields = ('material__code', 'material__name')
+    date_hierarchy = 'date'
+    readonly_fields = ('created_at',)
+
+@admin.register(ProductStockCheckpoint)
+class ProductStockCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('product', 'date', 'stock', 'created_at')
+    list_filter = ('date',)
+    search_fields = ('product__code', 'product__name')
+    date_hierarchy = 'date'
+    readonly_fields = ('created_at',)
+
 class InventoryItemInline(admin.TabularInline):
     model = InventoryItem
     extra = 1
@@ -0,0 +1,149 @@
+"""
+物料清单展开模块：把多级物料清单展开为单件产品的材料用量并按产品缓存
+
+展开结果（已计入各级损耗）按物料清单版本号缓存，物料清单任一明细变化后版本号改变，
+缓存随之失效；需求计算和生产单建立材料需求时直接读取展开结果，不再逐级查询。
+版本号保存在数据库中，各进程共用；缓存设有效期，旧版本的结果到期后自动清除。
+"""
+from collections import defaultdict
+from decimal import Decimal, ROUND_UP
+from typing import Dict, List
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+
+from production.models import MaterialRequirement
+
+from .models import ProductMaterial, bump_cache_versions, cache_versions
+from .reservations import refresh_material_reserved
+
+BULK_CREATE_BATCH_SIZE = 500
+BOM_VERSION_KEY = 'bom'
+BOM_CACHE_TIMEOUT = 24 * 60 * 60
+
+# 生产单材料需求保留两位小数，向上取整避免少领
+REQUIREMENT_QUANTUM = Decimal('0.01')
+
+
+def _flattened_bom_key(version, product_id):
+    return f'inventory:flattened_bom:{version}:{product_id}'
+
+
+def bom_version():
+    """物料清单的缓存版本号，一次查询"""
+    return cache_versions([BOM_VERSION_KEY])[BOM_VERSION_KEY]
+
+
+def touch_bom():
+    """
+    标记物料清单已变化，使全部产品的展开结果失效
+
+    上级产品的展开结果依赖下级半成品，因此不按产品失效而是整体递增版本号；
+    版本号与物料清单修改在同一事务中提交。
+    """
+    bump_cache_versions([BOM_VERSION_KEY])
+
+
+def _load_bom_lines(product_ids) -> Dict[int, List[tuple]]:
+    """逐级读取产品及其下级半成品的物料清单明细，每一级一次查询"""
+    lines = defaultdict(list)
+    loaded = set()
+    frontier = set(product_ids)
+    while frontier:
+        loaded |= frontier
+        components = set()
+        rows = ProductMaterial.objects.filter(product_id__in=frontier).values_list(
+            'product_id', 'material_id', 'component_id', 'quantity', 'scrap_rate')
+        for product_id, material_id, component_id, quantity, scrap_rate in rows:
+            lines[product_id].append((material_id, component_id, quantity * (1 + scrap_rate)))
+            if component_id:
+                components.add(component_id)
+        frontier = components - loaded
+    return {product_id: lines.get(product_id, []) for product_id in loaded}
+
+
+def _expand(lines) -> Dict[int, Dict[int, Decimal]]:
+    """在内存中逐级展开，每个产品只展开一次"""
+    flattened = {}
+
+    def expand(product_id, path):
+        if product_id in flattened:
+            return flattened[product_id]
+        if product_id in path:
+            raise ValidationError('物料清单存在循环引用，无法展开')
+        totals = defaultdict(Decimal)
+        for material_id, component_id, quantity in lines[product_id]:
+            if material_id:
+                totals[material_id] += quantity
+            else:
+                for component_material_id, component_quantity in expand(
+                        component_id, path | {product_id}).items():
+                    totals[component_material_id] += quantity * component_quantity
+        flattened[product_id] = dict(totals)
+        return flattened[product_id]
+
+    for product_id in lines:
+        expand(product_id, frozenset())
+    return flattened
+
+
+def flatten_boms(product_ids) -> Dict[int, Dict[int, Decimal]]:
+    """
+    各产品单件所需的材料用量 {产品ID: {材料ID: 数量}}，已计入各级损耗
+
+    命中缓存时只读取一次版本号；未命中的产品逐级读取物料清单（每一级一次查询）后展开，
+    展开过程中算出的下级半成品结果一并写入缓存。没有物料清单的产品结果为空字典。
+    """
+    product_ids = set(product_ids)
+    if not product_ids:
+        return {}
+    version = bom_version()
+    keys = {product_id: _flattened_bom_key(version, product_id) for product_id in product_ids}
+    cached = cache.get_many(keys.values())
+    result = {product_id: cached[key] for product_id, key in keys.items() if key in cached}
+
+    missing = product_ids - result.keys()
+    if missing:
+        flattened = _expand(_load_bom_lines(missing))
+        cache.set_many({
+            _flattened_bom_key(version, product_id): materials
+            for product_id, materials in flattened.items()
+        }, BOM_CACHE_TIMEOUT)
+        result.update({product_id: flattened[product_id] for product_id in missing})
+    return result
+
+
+def bom_material_quantities(product_quantities) -> Dict[int, Decimal]:
+    """按物料清单汇总一组产品数量所需的材料 {材料ID: 数量}，product_quantities 为 {产品ID: 数量}"""
+    totals = defaultdict(Decimal)
+    boms = flatten_boms(product_quantities.keys())
+    for product_id, quantity in product_quantities.items():
+        for material_id, per_unit in boms[product_id].items():
+            totals[material_id] += per_unit * quantity
+    return dict(totals)
+
+
+def create_bom_requirements(production_orders) -> List[MaterialRequirement]:
+    """
+    按物料清单为生产单批量建立材料需求，需求数量 = 单件用量 × 计划数量
+
+    没有物料清单的产品不建立需求；需求批量写入后重新汇总涉及材料的预留库存。
+    """
+    production_orders = list(production_orders)
+    boms = flatten_boms(production_order.product_id for production_order in production_orders)
+    requirements = [
+        MaterialRequirement(
+            production_order=production_order,
+            material_id=material_id,
+            required_quantity=(per_unit * production_order.planned_quantity).quantize(
+                REQUIREMENT_QUANTUM, rounding=ROUND_UP),
+            notes='按物料清单生成',
+        )
+        for production_order in production_orders
+        for material_id, per_unit in sorted(boms[production_order.product_id].items())
+    ]
+    if not requirements:
+        return []
+    requirements = MaterialRequirement.objects.bulk_create(requirements, batch_size=BULK_CREATE_BATCH_SIZE)
+    refresh_material_reserved({requirement.material_id for requirement in requirements})
+    return requirements
@@ -0,0 +1,254 @@
+"""
+材料变动批量过账模块
+"""
+from collections import defaultdict
+from decimal import Decimal
+from typing import List, Dict, Any
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from rest_framework import serializers
+
+from .models import (
+    Material, MaterialLocationStock, MaterialMovement, MaterialBatch, deduct_batch_quantities, post_material_stocks,
+)
+
+BULK_CREATE_BATCH_SIZE = 500
+
+# 各变动类型对库存的影响方向，调整不改变库存（与 MaterialMovement.save 一致）
+STOCK_DIRECTION = {'in': 1, 'out': -1, 'adjust': 0}
+
+
+def _char_field(label, **kwargs):
+    return serializers.CharField(allow_blank=True, error_messages={
+        'invalid': f'{label}格式不正确',
+        'null': f'{label}格式不正确',
+        'max_length': f'{label}不能超过{{max_length}}个字符',
+    }, **kwargs)
+
+
+# 各行字段按 MaterialMovement 的字段定义校验类型、长度和精度，不合格的行不写入
+QUANTITY_FIELD = serializers.DecimalField(max_digits=10, decimal_places=2, error_messages={
+    'invalid': '数量格式不正确',
+    'null': '数量格式不正确',
+    'max_string_length': '数量格式不正确',
+    'max_digits': '数量超出范围',
+    'max_whole_digits': '数量超出范围',
+    'max_decimal_places': '数量最多保留{max_decimal_places}位小数',
+})
+TEXT_FIELDS = {
+    'unit': _char_field('单位', max_length=20, allow_null=True),
+    'reference_number': _char_field('关联单号', max_length=50),
+    'location': _char_field('库位', max_length=50),
+    'notes': _char_field('备注'),
+}
+
+
+def _to_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _clean(field, value, row_errors):
+    """按字段校验并转换一个值，不合格时记入 row_errors 并返回 None"""
+    try:
+        return field.run_validation(value)
+    except serializers.ValidationError as e:
+        row_errors.extend(str(message) for message in e.detail)
+        return None
+
+
+def _validate_lines(lines_data, materials, batches):
+    """一次遍历校验所有明细，返回 (待创建的变动记录, 每行结果)"""
+    movements = []
+    results = []
+
+    for i, line in enumerate(lines_data):
+        row_errors = []
+        material = materials.get(_to_id(line.get('material')))
+        movement_type = line.get('movement_type')
+
+        if material is None:
+            row_errors.append(f"材料ID {line.get('material')} 不存在")
+        if not isinstance(movement_type, str) or movement_type not in STOCK_DIRECTION:
+            row_errors.append(f'变动类型 {movement_type} 无效')
+
+        quantity = _clean(QUANTITY_FIELD, line.get('quantity'), row_errors)
+        if quantity is not None and quantity <= 0:
+            row_errors.append('数量必须大于0')
+        text = {name: _clean(field, line.get(name, ''), row_errors) for name, field in TEXT_FIELDS.items()}
+
+        batch = None
+        if line.get('batch'):
+            batch = batches.get(_to_id(line.get('batch')))
+            if batch is None:
+                row_errors.append(f"批次ID {line.get('batch')} 不存在")
+            elif material is not None and batch.material_id != material.id:
+                row_errors.append(f'批次 {batch.batch_number} 不属于该材料')
+
+        if row_errors:
+            results.append({'row_number': i + 1, 'success': False, 'errors': row_errors})
+            movements.append(None)
+            continue
+
+        results.append({'row_number': i + 1, 'success': True, 'errors': []})
+        movements.append(MaterialMovement(
+            material=material,
+            movement_type=movement_type,
+            quantity=quantity,
+            unit=text['unit'] or material.unit,
+            reference_number=text['reference_number'],
+            notes=text['notes'],
+            location=text['location'],
+            batch=batch,
+        ))
+
+    return movements, results
+
+
+def post_material_movements(lines_data: List[Dict[str, Any]], operator=None) -> Dict[str, Any]:
+    """
+    批量过账材料变动
+
+    所有明细在一次遍历中完成校验（数量最多两位小数，文本字段不超过字段长度），
+    校验通过后在同一事务中 bulk_create 变动记录，全部（材料, 库位）的净变动量一次过账，
+    每个批次只更新一次剩余数量。任何一行失败则整批不写入。
+
+    Args:
+        lines_data: 变动明细列表
+            [{
+                "material": int,
+                "movement_type": "in" | "out" | "adjust",
+                "quantity": number,
+                "unit": str (可选，默认材料单位),
+                "batch": int (可选),
+                "reference_number": str (可选),
+                "location": str (可选),
+                "notes": str (可选)
+            }]
+        operator: 操作人（可选）
+
+    Returns:
+        Dict: 过账结果，results 与输入明细一一对应
+    """
+    if not lines_data:
+        return {
+            'success': False,
+            'errors': ['变动明细不能为空'],
+            'results': [],
+            'summary': {'total_lines': 0, 'material_count': 0}
+        }
+
+    malformed = [i + 1 for i, line in enumerate(lines_data) if not isinstance(line, dict)]
+    if malformed:
+        return {
+            'success': False,
+            'errors': [f'第{row_number}行：明细格式不正确' for row_number in malformed],
+            'results': [
+                {'row_number': i + 1, 'success': isinstance(line, dict),
+                 'errors': [] if isinstance(line, dict) else ['明细格式不正确']}
+                for i, line in enumerate(lines_data)
+            ],
+            'summary': {'total_lines': len(lines_data), 'material_count': 0}
+        }
+
+    materials = Material.objects.in_bulk(
+        {_to_id(line.get('material')) for line in lines_data} - {None})
+    batches = MaterialBatch.objects.in_bulk(
+        {_to_id(line.get('batch')) for line in lines_data} - {None})
+    movements, results = _validate_lines(lines_data, materials, batches)
+
+    errors = [
+        f"第{result['row_number']}行：{'；'.join(result['errors'])}"
+        for result in results if not result['success']
+    ]
+    if errors:
+        return {
+            'success': False,
+            'errors': errors,
+            'results': results,
+            'summary': {'total_lines': len(lines_data), 'material_count': 0}
+        }
+
+    # 按（材料, 库位）汇总净变动量、按批次汇总出库量
+    location_deltas = defaultdict(Decimal)
+    batch_outgoing = defaultdict(Decimal)
+    for movement in movements:
+        movement.operator = operator
+        location_deltas[(movement.material_id, movement.location)] += STOCK_DIRECTION[movement.movement_type] * movement.quantity
+        if movement.batch_id and movement.movement_type == 'out':
+            batch_outgoing[movement.batch_id] += movement.quantity
+
+    stock_errors = {}
+    with transaction.atomic():
+        # 批次剩余数量不能扣减为负数，先锁定批次再校验
+        locked_batches = MaterialBatch.objects.select_for_update().in_bulk(batch_outgoing.keys())
+        for batch_id, quantity in sorted(batch_outgoing.items()):
+            batch = locked_batches.get(batch_id)
+            if batch is None:
+                stock_errors[batches[batch_id].material_id] = f'批次 {batches[batch_id].batch_number} 不存在'
+            elif batch.remaining_quantity < quantity:
+                stock_errors[batch.material_id] = (
+                    f"材料 {materials[batch.material_id].name} 批次 {batch.batch_number} 剩余数量不足，"
+                    f"剩余: {batch.remaining_quantity}, 需要: {quantity}")
+
+        # 锁定涉及的库位行，逐个库位给出库存不足的提示
+        location_stocks = {
+            (material_id, location): stock
+            for material_id, location, stock in MaterialLocationStock.objects.select_for_update().filter(
+                material_id__in={material_id for material_id, _ in location_deltas},
+                location__in={location for _, location in location_deltas},
+            ).order_by('material_id', 'location').values_list('material_id', 'location', 'stock')
+        }
+        for (material_id, location), delta in sorted(location_deltas.items()):
+            stock = location_stocks.get((material_id, location), Decimal('0'))
+            if material_id not in stock_errors and stock + delta < 0:
+                stock_errors[material_id] = (
+                    f"材料 {materials[material_id].name} 库位 {location or '默认'} "
+                    f"库存不足，当前库存: {stock}, 需要: {-delta}")
+
+        if stock_errors:
+            # 整批回滚
+            transaction.set_rollback(True)
+        else:
+            balances = post_material_stocks(location_deltas)
+            deduct_batch_quantities(
+                batch_outgoing, {batches[batch_id].material_id for batch_id in batch_outgoing})
+
+            MaterialMovement.objects.bulk_create(movements, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    if stock_errors:
+        for result, movement in zip(results, movements):
+            result['success'] = False
+            result['errors'] = [
+                stock_errors.get(movement.material_id, '同批其他明细过账失败，本行未写入')
+            ]
+        return {
+            'success': False,
+            'errors': list(stock_errors.values()),
+            'results': results,
+            'summary': {'total_lines': len(lines_data), 'material_count': 0}
+        }
+
+    material_deltas = defaultdict(Decimal)
+    for (material_id, _), delta in location_deltas.items():
+        material_deltas[material_id] += delta
+
+    for result, movement in zip(results, movements):
+        result['movement_id'] = movement.pk
+        result['stock_after'] = float(balances[movement.material_id])
+
+    return {
+        'success': True,
+        'errors': [],
+        'results': results,
+        'summary': {
+            'total_lines': len(lines_data),
+            'material_count': len(material_deltas),
+            'net_changes': {
+                material_id: float(delta) for material_id, delta in material_deltas.items()
+            }
+        }
+    }
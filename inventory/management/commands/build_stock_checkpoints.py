@@ -0,0 +1,35 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from inventory.stock_ledger import MATERIAL_LEDGER, PRODUCT_LEDGER
+
+
+class Command(BaseCommand):
+    help = '生成材料和产品的日末库存检查点，建议每晚定时执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='检查点日期（YYYY-MM-DD），默认为昨天',
+        )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                date = parse_date(options['date'])
+            except ValueError:
+                date = None
+            if date is None:
+                raise CommandError(f"日期格式不正确：{options['date']}")
+        else:
+            date = timezone.localdate() - datetime.timedelta(days=1)
+
+        material_count = MATERIAL_LEDGER.build_checkpoints(date)
+        product_count = PRODUCT_LEDGER.build_checkpoints(date)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{date} 检查点已生成：材料 {material_count} 条，产品 {product_count} 条'
+        ))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from inventory.models import MaterialBatch, touch_material_batches
+
+
+class Command(BaseCommand):
+    help = '将有效期早于指定日期的正常批次批量标记为已过期'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='基准日期（YYYY-MM-DD），有效期早于该日期的批次视为过期，默认为今天',
+        )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                date = parse_date(options['date'])
+            except ValueError:
+                date = None
+            if date is None:
+                raise CommandError(f"日期格式不正确：{options['date']}")
+        else:
+            date = timezone.localdate()
+
+        with transaction.atomic():
+            expired = MaterialBatch.objects.filter(status='normal', expiry_date__lt=date)
+            material_ids = set(expired.values_list('material_id', flat=True))
+            count = expired.update(status='expired')
+            if material_ids:
+                touch_material_batches(material_ids)
+
+        self.stdout.write(self.style.SUCCESS(f'已将 {count} 个批次标记为已过期（有效期早于 {date}）'))
@@ -0,0 +1,63 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q, Sum
+
+from inventory.models import MaterialBatch, touch_material_batches
+
+
+class Command(BaseCommand):
+    help = '用一次分组查询重新计算所有批次的剩余数量和状态，并报告偏差'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='将偏差批次的剩余数量和状态修正为重新计算的结果',
+        )
+
+    def handle(self, *args, **options):
+        # 剩余数量 = 初始数量 - 该批次所有出库数量
+        batches = MaterialBatch.objects.values(
+            'id', 'material_id', 'batch_number', 'initial_quantity', 'remaining_quantity', 'status'
+        ).annotate(
+            total_out=Sum('materialmovement__quantity', filter=Q(materialmovement__movement_type='out'))
+        ).order_by('id')
+
+        drifted = []
+        checked = 0
+        for batch in batches.iterator():
+            checked += 1
+            expected = batch['initial_quantity'] - (batch['total_out'] or Decimal('0'))
+            # 状态按实际剩余判断：用尽的批次为已耗尽，仍有剩余的已耗尽批次恢复为正常，已过期的保持不变
+            status = batch['status']
+            if expected <= 0:
+                status = 'depleted'
+            elif status == 'depleted':
+                status = 'normal'
+            if expected != batch['remaining_quantity'] or status != batch['status']:
+                drifted.append(MaterialBatch(
+                    id=batch['id'], material_id=batch['material_id'],
+                    remaining_quantity=expected, status=status))
+                if expected != batch['remaining_quantity']:
+                    self.stdout.write(
+                        f"批次 {batch['batch_number']}：记录剩余 {batch['remaining_quantity']}，"
+                        f"实际剩余 {expected}，偏差 {batch['remaining_quantity'] - expected}"
+                    )
+                else:
+                    self.stdout.write(
+                        f"批次 {batch['batch_number']}：剩余 {expected}，"
+                        f"状态应为 {status}，记录为 {batch['status']}"
+                    )
+
+        if drifted and options['fix']:
+            with transaction.atomic():
+                MaterialBatch.objects.bulk_update(drifted, ['remaining_quantity', 'status'], batch_size=500)
+                touch_material_batches(batch.material_id for batch in drifted)
+            self.stdout.write(self.style.SUCCESS(f'已修正 {len(drifted)} 个批次'))
+
+        if drifted:
+            self.stdout.write(self.style.WARNING(f'共检查 {checked} 个批次，{len(drifted)} 个存在偏差'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'共检查 {checked} 个批次，未发现偏差'))
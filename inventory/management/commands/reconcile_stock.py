@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from inventory.stock_ledger import MATERIAL_LEDGER, PRODUCT_LEDGER
+
+
+class Command(BaseCommand):
+    help = '核对材料、产品库存与变动记录净数量是否一致，并报告偏差'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='每次从数据库读取的记录数',
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        for label, ledger in (('材料', MATERIAL_LEDGER), ('产品', PRODUCT_LEDGER)):
+            count = 0
+            for drift in ledger.find_drift(chunk_size=options['chunk_size']):
+                count += 1
+                self.stdout.write(
+                    f"{label} {drift['name']} ({drift['code']})：库存 {drift['stock']}，"
+                    f"台账 {drift['ledger_stock']}，偏差 {drift['difference']}"
+                )
+            if count:
+                self.stdout.write(self.style.WARNING(f'{label}：{count} 条存在偏差'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{label}：库存与台账一致'))
+            total += count
+
+        if total:
+            self.stdout.write(self.style.WARNING(f'共发现 {total} 条偏差'))
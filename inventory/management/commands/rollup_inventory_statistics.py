@@ -0,0 +1,54 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from inventory.models import InventoryStatistics, MaterialMovement
+from inventory.stock_ledger import build_daily_statistics
+
+
+class Command(BaseCommand):
+    help = '按日汇总材料库存统计；不带参数时从上次汇总的次日增量汇总到昨天，适合每晚定时执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='开始日期（YYYY-MM-DD），指定后重新汇总该日期起的数据')
+        parser.add_argument('--end', help='结束日期（YYYY-MM-DD），默认为昨天')
+
+    def _parse(self, value):
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise CommandError(f'日期格式不正确：{value}')
+        return date
+
+    def handle(self, *args, **options):
+        end_date = (
+            self._parse(options['end']) if options['end']
+            else timezone.localdate() - datetime.timedelta(days=1)
+        )
+
+        if options['start']:
+            start_date = self._parse(options['start'])
+        else:
+            last_date = InventoryStatistics.objects.aggregate(last=Max('date'))['last']
+            if last_date:
+                start_date = last_date + datetime.timedelta(days=1)
+            else:
+                first_movement = MaterialMovement.objects.aggregate(first=Min('movement_date'))['first']
+                if first_movement is None:
+                    self.stdout.write('没有材料变动记录，无需汇总')
+                    return
+                start_date = timezone.localtime(first_movement).date()
+
+        if start_date > end_date:
+            self.stdout.write(f'库存统计已是最新（截至 {end_date}）')
+            return
+
+        count = build_daily_statistics(start_date, end_date)
+        self.stdout.write(self.style.SUCCESS(
+            f'已汇总 {start_date} 至 {end_date} 的库存统计，共 {count} 条'
+        ))
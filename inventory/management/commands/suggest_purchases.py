@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from inventory.purchase_suggestions import (
+    DEFAULT_LEAD_TIME_DAYS,
+    DEFAULT_LOOKBACK_DAYS,
+    create_purchase_suggestions,
+)
+
+
+class Command(BaseCommand):
+    help = '按再订货点计算采购建议，并按供应商生成草稿采购单'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='计算日期（YYYY-MM-DD），默认为今天')
+        parser.add_argument(
+            '--lookback-days', type=int, default=DEFAULT_LOOKBACK_DAYS,
+            help=f'统计消耗速度的天数，默认 {DEFAULT_LOOKBACK_DAYS} 天',
+        )
+        parser.add_argument(
+            '--lead-time-days', type=int, default=DEFAULT_LEAD_TIME_DAYS,
+            help=f'采购提前期（天），默认 {DEFAULT_LEAD_TIME_DAYS} 天',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='只输出建议，不生成采购单')
+
+    def handle(self, *args, **options):
+        as_of = None
+        if options['date']:
+            try:
+                as_of = parse_date(options['date'])
+            except ValueError:
+                as_of = None
+            if as_of is None:
+                raise CommandError(f"日期格式不正确：{options['date']}")
+        if options['lookback_days'] <= 0:
+            raise CommandError('统计天数必须大于0')
+        if options['lead_time_days'] < 0:
+            raise CommandError('采购提前期不能为负数')
+
+        result = create_purchase_suggestions(
+            as_of=as_of,
+            lookback_days=options['lookback_days'],
+            lead_time_days=options['lead_time_days'],
+            dry_run=options['dry_run'],
+        )
+
+        for purchase in result['purchases']:
+            self.stdout.write(
+                f"{purchase['purchase_number'] or '(未生成)'} 供应商ID {purchase['supplier']}："
+                f"{len(purchase['items'])} 种材料"
+            )
+        for line in result['unassigned']:
+            self.stdout.write(self.style.WARNING(
+                f"材料 {line['material_code']} 需要采购 {line['quantity']}，但没有采购记录，无法确定供应商"
+            ))
+
+        summary = result['summary']
+        action = '建议' if options['dry_run'] else '已生成'
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {summary['purchase_count']} 张草稿采购单，共 {summary['item_count']} 条明细"
+        ))
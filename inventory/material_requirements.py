@@ -2,9 +2,39 @@
 材料需求计算模块
 """
 from decimal import Decimal
+from collections import defaultdict
 from typing import List, Dict, Any
-from .models import Product
-from orders.models import Order, OrderItem
+from django.core.cache import cache
+from .bom import BOM_VERSION_KEY, flatten_boms
+from .models import Material, Product, bump_cache_versions, cache_versions
+from orders.models import Order
+
+RESULT_CACHE_TIMEOUT = 60 * 60
+
+
+def _order_version_key(order_id):
+    return f'order_requirements:{order_id}'
+
+
+def _product_version_key(product_id):
+    return f'product:{product_id}'
+
+
+def product_versions(product_ids):
+    """各产品的缓存版本号，产品（如单重）变化后版本号随之改变；一次查询"""
+    keys = {product_id: _product_version_key(product_id) for product_id in product_ids}
+    versions = cache_versions(keys.values())
+    return {product_id: versions[key] for product_id, key in keys.items()}
+
+
+def touch_order_requirements(order_ids):
+    """标记订单或其明细已变化，使该订单的材料需求计算结果失效"""
+    bump_cache_versions(_order_version_key(order_id) for order_id in order_ids)
+
+
+def touch_products(product_ids):
+    """标记产品已变化，使包含这些产品的订单的材料需求计算结果失效"""
+    bump_cache_versions(_product_version_key(product_id) for product_id in product_ids)
 
 
 class MaterialRequirementCalculator:
@@ -29,62 +59,93 @@ class MaterialRequirementCalculator:
         """
         material_requirements = {}
         calculation_details = []
-        errors = []
+        errors = []  # (行号, 提示)，两轮校验后按行号排序
         
+        # 先解析全部行，再用一次 in_bulk 查询读取涉及的产品
+        rows = []
         for i, item in enumerate(order_items_data):
+            product_id = item.get('product_id')
             try:
-                product_id = item.get('product_id')
                 quantity = Decimal(str(item.get('quantity', 0)))
-                
-                if not product_id:
-                    errors.append(f"第{i+1}行：产品ID不能为空")
-                    continue
-                
-                if quantity <= 0:
-                    errors.append(f"第{i+1}行：数量必须大于0")
-                    continue
-                
-                try:
-                    product = Product.objects.get(id=product_id, is_active=True)
-                except:
-                    errors.append(f"第{i+1}行：产品ID {product_id} 不存在或已禁用")
-                    continue
-                
-                # 计算材料重量
-                unit_weight = product.unit_weight
-                material_weight = unit_weight * quantity
-                
-                # 累计材料需求
-                product_key = f"product_{product_id}"
-                if product_key not in material_requirements:
-                    material_requirements[product_key] = {
-                        'product_id': product_id,
-                        'product_name': product.name,
-                        'product_code': product.code,
-                        'specification': product.specification,
-                        'unit_weight': float(unit_weight),
-                        'total_quantity': Decimal('0'),
-                        'total_material_weight': Decimal('0')
-                    }
-                
-                material_requirements[product_key]['total_quantity'] += quantity
-                material_requirements[product_key]['total_material_weight'] += material_weight
-                
-                # 计算详情
-                calculation_details.append({
-                    'row_number': i + 1,
+            except Exception as e:
+                errors.append((i, f"第{i+1}行：计算出错 - {str(e)}"))
+                continue
+            
+            if not product_id:
+                errors.append((i, f"第{i+1}行：产品ID不能为空"))
+                continue
+            
+            if not quantity.is_finite():
+                errors.append((i, f"第{i+1}行：数量格式不正确"))
+                continue
+            
+            if quantity <= 0:
+                errors.append((i, f"第{i+1}行：数量必须大于0"))
+                continue
+            
+            try:
+                product_pk = int(product_id)
+            except (TypeError, ValueError):
+                errors.append((i, f"第{i+1}行：产品ID {product_id} 不存在或已禁用"))
+                continue
+            
+            rows.append((i, item, product_pk, quantity))
+        
+        products = Product.objects.filter(is_active=True).only(
+            'name', 'code', 'specification', 'unit_weight'
+        ).in_bulk({product_pk for _, _, product_pk, _ in rows})
+        # 物料清单展开结果按产品缓存，不逐级查询
+        boms = flatten_boms(products.keys())
+        bom_totals = defaultdict(Decimal)
+        
+        for i, item, product_id, quantity in rows:
+            product = products.get(product_id)
+            if product is None:
+                errors.append((i, f"第{i+1}行：产品ID {product_id} 不存在或已禁用"))
+                continue
+            
+            # 计算材料重量
+            unit_weight = product.unit_weight
+            material_weight = unit_weight * quantity
+            
+            # 累计材料需求
+            product_key = f"product_{product_id}"
+            if product_key not in material_requirements:
+                material_requirements[product_key] = {
                     'product_id': product_id,
                     'product_name': product.name,
                     'product_code': product.code,
-                    'quantity': float(quantity),
+                    'specification': product.specification,
                     'unit_weight': float(unit_weight),
-                    'material_weight': float(material_weight),
-                    'calculation_formula': f'{quantity} × {unit_weight}kg = {material_weight}kg',
-                    'notes': item.get('notes', '')
-                })
-                
-            except Exception as e:
-                errors.append(f"第{i+1}行：计算出错 - {str(e)}")
+                    'total_quantity': Decimal('0'),
+                    'total_material_weight': Decimal('0')
+                }
+            
+            material_requirements[product_key]['total_quantity'] += quantity
+            material_requirements[product_key]['total_material_weight'] += material_weight
+            
+            # 按物料清单（含损耗）累计各材料需求
+            bom_materials = []
+            for material_id, per_unit in sorted(boms[product_id].items()):
+                required_quantity = per_unit * quantity
+                bom_totals[material_id] += required_quantity
+                bom_materials.append({'material_id': material_id, 'quantity': float(required_quantity)})
+            
+            # 计算详情
+            calculation_details.append({
+                'row_number': i + 1,
+                'product_id': product_id,
+                'product_name': product.name,
+                'product_code': product.code,
+                'quantity': float(quantity),
+                'unit_weight': float(unit_weight),
+                'material_weight': float(material_weight),
+                'calculation_formula': f'{quantity} × {unit_weight}kg = {material_weight}kg',
+                'notes': item.get('notes', ''),
+                'bom_materials': bom_materials
+            })
+        
+        errors = [message for _, message in sorted(errors, key=lambda error: error[0])]
         
         # 转换结果格式
         requirements_list = []
@@ -96,13 +157,27 @@ class MaterialRequirementCalculator:
             total_material_weight += Decimal(str(req['total_material_weight']))
             requirements_list.append(req)
         
+        materials = Material.objects.only('code', 'name', 'unit').in_bulk(bom_totals.keys()) if bom_totals else {}
+        bom_material_requirements = [
+            {
+                'material_id': material_id,
+                'material_code': materials[material_id].code,
+                'material_name': materials[material_id].name,
+                'unit': materials[material_id].unit,
+                'required_quantity': float(required_quantity)
+            }
+            for material_id, required_quantity in sorted(bom_totals.items())
+        ]
+        
         return {
             'success': len(errors) == 0,
             'errors': errors,
             'material_requirements': requirements_list,
             'calculation_details': calculation_details,
+            'bom_material_requirements': bom_material_requirements,
             'summary': {
                 'total_product_types': len(requirements_list),
+                'total_bom_materials': len(bom_material_requirements),
                 'total_items_processed': len(calculation_details),
                 'total_material_weight': float(total_material_weight),
                 'total_material_weight_display': f'{total_material_weight:.3f} kg'
@@ -114,24 +189,39 @@ class MaterialRequirementCalculator:
         """
         根据订单ID计算材料需求
         
+        结果按订单版本号和物料清单版本号缓存，并记录所涉产品的版本号；
+        订单、订单明细、产品或物料清单变化时由信号递增版本号，缓存随之失效；
+        版本号保存在数据库中，各进程共用。命中缓存时只读取订单和产品的版本号（两次查询）。
+        
         Args:
             order_id: 订单ID
             
         Returns:
             Dict: 计算结果
         """
+        order_key = _order_version_key(order_id)
+        versions = cache_versions([order_key, BOM_VERSION_KEY])
+        cache_key = (
+            f'inventory:order_requirements:{order_id}:{versions[order_key]}:{versions[BOM_VERSION_KEY]}'
+        )
+        cached = cache.get(cache_key)
+        if cached is not None and product_versions(cached['product_ids']) == cached['product_versions']:
+            return {**cached['result'], 'cached': True}
+        
         try:
-            order = Order.objects.get(id=order_id)
-            order_items = order.items.all()
+            order = Order.objects.select_related('customer').get(id=order_id)
+            # 产品信息由 calculate_from_order_items 统一批量读取，这里只取产品ID
+            order_items = list(order.items.order_by('pk').values('product_id', 'quantity', 'notes'))
+            # 计算前读取产品版本号，计算期间产品变化时下次读取不会命中
+            versions = product_versions({item['product_id'] for item in order_items})
             
             # 转换为统一格式
             order_items_data = []
             for item in order_items:
                 order_items_data.append({
-                    'product_id': item.product.id,
-                    'quantity': float(item.quantity),
-                    'product_name': item.product.name,
-                    'notes': f"订单{order.order_number} - {item.notes}" if item.notes else f"订单{order.order_number}"
+                    'product_id': item['product_id'],
+                    'quantity': float(item['quantity']),
+                    'notes': f"订单{order.order_number} - {item['notes']}" if item['notes'] else f"订单{order.order_number}"
                 })
             
             result = MaterialRequirementCalculator.calculate_from_order_items(order_items_data)
@@ -143,7 +233,12 @@ class MaterialRequirementCalculator:
                 'delivery_date': order.delivery_date.strftime('%Y-%m-%d')
             }
             
-            return result
+            cache.set(cache_key, {
+                'product_ids': list(versions),
+                'product_versions': versions,
+                'result': result,
+            }, RESULT_CACHE_TIMEOUT)
+            return {**result, 'cached': False}
             
         except Order.DoesNotExist:
             return {
@@ -151,8 +246,10 @@ class MaterialRequirementCalculator:
                 'errors': [f'订单ID {order_id} 不存在'],
                 'material_requirements': [],
                 'calculation_details': [],
+                'bom_material_requirements': [],
                 'summary': {
                     'total_product_types': 0,
+                    'total_bom_materials': 0,
                     'total_items_processed': 0,
                     'total_material_weight': 0,
                     'total_material_weight_display': '0.000 kg'
@@ -164,8 +261,10 @@ class MaterialRequirementCalculator:
                 'errors': [f'计算订单材料需求时出错: {str(e)}'],
                 'material_requirements': [],
                 'calculation_details': [],
+                'bom_material_requirements': [],
                 'summary': {
                     'total_product_types': 0,
+                    'total_bom_materials': 0,
                     'total_items_processed': 0,
                     'total_material_weight': 0,
                     'total_material_weight_display': '0.000 kg'
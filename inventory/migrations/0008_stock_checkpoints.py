@@ -0,0 +1,46 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0007_product_unit_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialStockCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='检查点日期')),
+                ('stock', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='日末库存')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_checkpoints', to='inventory.material', verbose_name='材料')),
+            ],
+            options={
+                'verbose_name': '材料库存检查点',
+                'verbose_name_plural': '材料库存检查点',
+                'ordering': ['-date'],
+                'unique_together': {('material', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductStockCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='检查点日期')),
+                ('stock', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='日末库存')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_checkpoints', to='inventory.product', verbose_name='产品')),
+            ],
+            options={
+                'verbose_name': '产品库存检查点',
+                'verbose_name_plural': '产品库存检查点',
+                'ordering': ['-date'],
+                'unique_together': {('product', 'date')},
+            },
+        ),
+    ]
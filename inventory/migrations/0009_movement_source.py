@@ -0,0 +1,53 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0008_stock_checkpoints'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='materialmovement',
+            name='reason',
+            field=models.CharField(blank=True, choices=[('purchase_receipt', '采购入库'), ('purchase_reversal', '撤销采购入库'), ('production_issue', '生产领料'), ('production_receipt', '生产完成入库'), ('production_reversal', '撤销生产完成'), ('sales_shipment', '订单发货出库'), ('outbound', '产品出库'), ('outbound_reversal', '撤销产品出库'), ('adjustment', '库存调整')], max_length=20, verbose_name='变动原因'),
+        ),
+        migrations.AddField(
+            model_name='materialmovement',
+            name='source_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True, verbose_name='来源单据ID'),
+        ),
+        migrations.AddField(
+            model_name='materialmovement',
+            name='source_type',
+            field=models.CharField(blank=True, choices=[('purchase', '采购单'), ('production_order', '生产单'), ('sales_order', '销售订单'), ('product_outbound', '产品出库单'), ('inventory', '库存盘点')], max_length=20, verbose_name='来源单据类型'),
+        ),
+        migrations.AddField(
+            model_name='productmovement',
+            name='reason',
+            field=models.CharField(blank=True, choices=[('purchase_receipt', '采购入库'), ('purchase_reversal', '撤销采购入库'), ('production_issue', '生产领料'), ('production_receipt', '生产完成入库'), ('production_reversal', '撤销生产完成'), ('sales_shipment', '订单发货出库'), ('outbound', '产品出库'), ('outbound_reversal', '撤销产品出库'), ('adjustment', '库存调整')], max_length=20, verbose_name='变动原因'),
+        ),
+        migrations.AddField(
+            model_name='productmovement',
+            name='source_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True, verbose_name='来源单据ID'),
+        ),
+        migrations.AddField(
+            model_name='productmovement',
+            name='source_type',
+            field=models.CharField(blank=True, choices=[('purchase', '采购单'), ('production_order', '生产单'), ('sales_order', '销售订单'), ('product_outbound', '产品出库单'), ('inventory', '库存盘点')], max_length=20, verbose_name='来源单据类型'),
+        ),
+        migrations.AddIndex(
+            model_name='materialmovement',
+            index=models.Index(fields=['source_type', 'source_id', 'reason'], name='materialmove_source_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productmovement',
+            index=models.Index(fields=['source_type', 'source_id', 'reason'], name='productmove_source_idx'),
+        ),
+    ]
@@ -0,0 +1,88 @@
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def backfill_material_movements(apps, schema_editor):
+    """按采购单外键和备注前缀回填材料变动的来源"""
+    MaterialMovement = apps.get_model('inventory', 'MaterialMovement')
+    ProductionOrder = apps.get_model('production', 'ProductionOrder')
+
+    production_orders = dict(ProductionOrder.objects.values_list('order_number', 'id'))
+
+    pending = []
+    for movement in MaterialMovement.objects.filter(source_type='').iterator(chunk_size=BATCH_SIZE):
+        if movement.purchase_id and movement.notes.startswith('采购入库'):
+            movement.source_type, movement.source_id, movement.reason = (
+                'purchase', movement.purchase_id, 'purchase_receipt')
+        elif movement.purchase_id and movement.notes.startswith('撤销入库'):
+            movement.source_type, movement.source_id, movement.reason = (
+                'purchase', movement.purchase_id, 'purchase_reversal')
+        elif movement.notes.startswith('生产领料') and movement.reference_number in production_orders:
+            movement.source_type, movement.source_id, movement.reason = (
+                'production_order', production_orders[movement.reference_number], 'production_issue')
+        else:
+            continue
+
+        pending.append(movement)
+        if len(pending) >= BATCH_SIZE:
+            MaterialMovement.objects.bulk_update(pending, ['source_type', 'source_id', 'reason'])
+            pending = []
+
+    if pending:
+        MaterialMovement.objects.bulk_update(pending, ['source_type', 'source_id', 'reason'])
+
+
+def backfill_product_movements(apps, schema_editor):
+    """按关联单号和备注回填产品变动的来源"""
+    ProductMovement = apps.get_model('inventory', 'ProductMovement')
+    ProductOutbound = apps.get_model('inventory', 'ProductOutbound')
+    ProductionOrder = apps.get_model('production', 'ProductionOrder')
+    Order = apps.get_model('orders', 'Order')
+
+    outbounds = dict(ProductOutbound.objects.values_list('outbound_number', 'id'))
+    production_orders = dict(ProductionOrder.objects.values_list('order_number', 'id'))
+    sales_orders = dict(Order.objects.values_list('order_number', 'id'))
+
+    pending = []
+    for movement in ProductMovement.objects.filter(source_type='').iterator(chunk_size=BATCH_SIZE):
+        reference = movement.reference_number
+        notes = movement.notes
+
+        if '生产完成入库' in notes and '订单号' in notes and reference in sales_orders:
+            source = ('sales_order', sales_orders[reference], 'production_receipt')
+        elif '订单发货出库' in notes and reference in sales_orders:
+            source = ('sales_order', sales_orders[reference], 'sales_shipment')
+        elif '生产完成入库' in notes and reference in production_orders:
+            source = ('production_order', production_orders[reference], 'production_receipt')
+        elif '撤销生产完成' in notes and reference in production_orders:
+            source = ('production_order', production_orders[reference], 'production_reversal')
+        elif notes.startswith('撤销出库') and reference.startswith('撤销-') and reference[3:] in outbounds:
+            source = ('product_outbound', outbounds[reference[3:]], 'outbound_reversal')
+        elif notes.startswith('产品出库') and reference in outbounds:
+            source = ('product_outbound', outbounds[reference], 'outbound')
+        else:
+            continue
+
+        movement.source_type, movement.source_id, movement.reason = source
+        pending.append(movement)
+        if len(pending) >= BATCH_SIZE:
+            ProductMovement.objects.bulk_update(pending, ['source_type', 'source_id', 'reason'])
+            pending = []
+
+    if pending:
+        ProductMovement.objects.bulk_update(pending, ['source_type', 'source_id', 'reason'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0009_movement_source'),
+        ('orders', '0001_initial'),
+        ('production', '0005_alter_productionorder_sales_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_material_movements, migrations.RunPython.noop),
+        migrations.RunPython(backfill_product_movements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:40
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0010_backfill_movement_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialLocationStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.CharField(blank=True, max_length=50, verbose_name='库位')),
+                ('stock', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=10, verbose_name='库存')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_stocks', to='inventory.material', verbose_name='材料')),
+            ],
+            options={
+                'verbose_name': '材料库位库存',
+                'verbose_name_plural': '材料库位库存',
+                'ordering': ['material', 'location'],
+                'unique_together': {('material', 'location')},
+            },
+        ),
+    ]
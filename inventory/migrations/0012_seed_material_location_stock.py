@@ -0,0 +1,29 @@
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def seed_location_stock(apps, schema_editor):
+    """将现有材料库存记入默认库位"""
+    Material = apps.get_model('inventory', 'Material')
+    MaterialLocationStock = apps.get_model('inventory', 'MaterialLocationStock')
+
+    MaterialLocationStock.objects.bulk_create(
+        (
+            MaterialLocationStock(material_id=pk, location='', stock=stock)
+            for pk, stock in Material.objects.exclude(stock=0).values_list('pk', 'stock').iterator()
+        ),
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0011_material_location_stock'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_location_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:42
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0012_seed_material_location_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='material',
+            name='reserved_stock',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10, verbose_name='预留库存'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='reserved_stock',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10, verbose_name='预留库存'),
+        ),
+    ]
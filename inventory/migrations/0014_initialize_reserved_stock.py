@@ -0,0 +1,50 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations
+
+OPEN_ORDER_STATUSES = ['pending', 'processing', 'completed']
+
+
+def initialize_reserved_stock(apps, schema_editor):
+    """按现有的未完成需求、未发货订单和草稿出库单计算预留库存"""
+    Material = apps.get_model('inventory', 'Material')
+    Product = apps.get_model('inventory', 'Product')
+    ProductOutboundItem = apps.get_model('inventory', 'ProductOutboundItem')
+    MaterialRequirement = apps.get_model('production', 'MaterialRequirement')
+    OrderItem = apps.get_model('orders', 'OrderItem')
+
+    material_reserved = defaultdict(Decimal)
+    requirements = MaterialRequirement.objects.exclude(production_order__status='completed')
+    for material_id, required, actual in requirements.values_list(
+            'material_id', 'required_quantity', 'actual_quantity').iterator():
+        material_reserved[material_id] += max(required - actual, Decimal('0'))
+
+    product_reserved = defaultdict(Decimal)
+    order_items = OrderItem.objects.filter(order__status__in=OPEN_ORDER_STATUSES)
+    for product_id, quantity in order_items.values_list('product_id', 'quantity').iterator():
+        product_reserved[product_id] += quantity
+    outbound_items = ProductOutboundItem.objects.filter(outbound__status='draft').exclude(
+        outbound__order__status__in=OPEN_ORDER_STATUSES)
+    for product_id, quantity in outbound_items.values_list('product_id', 'quantity').iterator():
+        product_reserved[product_id] += quantity
+
+    Material.objects.bulk_update(
+        [Material(pk=pk, reserved_stock=quantity) for pk, quantity in material_reserved.items()],
+        ['reserved_stock'], batch_size=500)
+    Product.objects.bulk_update(
+        [Product(pk=pk, reserved_stock=quantity) for pk, quantity in product_reserved.items()],
+        ['reserved_stock'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0013_reserved_stock'),
+        ('orders', '0001_initial'),
+        ('production', '0005_alter_productionorder_sales_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(initialize_reserved_stock, migrations.RunPython.noop),
+    ]
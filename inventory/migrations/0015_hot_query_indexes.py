@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0014_initialize_reserved_stock'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='materialbatch',
+            index=models.Index(fields=['material', 'status', 'production_date'], name='materialbatch_fifo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='materialmovement',
+            index=models.Index(fields=['material', 'movement_date'], name='materialmove_material_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='materialmovement',
+            index=models.Index(fields=['batch', 'movement_type'], name='materialmove_batch_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productmovement',
+            index=models.Index(fields=['reference_number', 'movement_type'], name='productmove_ref_type_idx'),
+        ),
+    ]
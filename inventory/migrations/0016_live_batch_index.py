@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:47
+
+from django.db import migrations, models
+
+
+def mark_depleted_batches(apps, schema_editor):
+    """已用完的批次标记为已耗尽"""
+    MaterialBatch = apps.get_model('inventory', 'MaterialBatch')
+    MaterialBatch.objects.filter(status='normal', remaining_quantity__lte=0).update(status='depleted')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0015_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_depleted_batches, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='materialbatch',
+            name='materialbatch_fifo_idx',
+        ),
+        migrations.AddIndex(
+            model_name='materialbatch',
+            index=models.Index(condition=models.Q(('remaining_quantity__gt', 0), ('status', 'normal')), fields=['material', 'production_date'], name='materialbatch_live_fifo_idx'),
+        ),
+    ]
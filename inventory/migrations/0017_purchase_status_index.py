@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0016_live_batch_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='materialpurchase',
+            index=models.Index(fields=['status'], name='materialpurchase_status_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0017_purchase_status_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(blank=True, max_length=20, verbose_name='单号前缀')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('last_value', models.PositiveIntegerField(default=0, verbose_name='已发放序号')),
+            ],
+            options={
+                'verbose_name': '单据编号序列',
+                'verbose_name_plural': '单据编号序列',
+                'unique_together': {('prefix', 'date')},
+            },
+        ),
+    ]
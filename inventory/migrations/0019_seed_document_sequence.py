@@ -0,0 +1,55 @@
+import datetime
+import re
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+# (应用, 模型, 单号字段, 前缀)，与 inventory.sequences 中的单据类型一致
+DOCUMENTS = [
+    ('orders', 'Order', 'order_number', 'SO'),
+    ('production', 'ProductionOrder', 'order_number', 'PO'),
+    ('inventory', 'ProductOutbound', 'outbound_number', ''),
+    ('inventory', 'MaterialPurchase', 'purchase_number', 'CG'),
+]
+
+
+def seed_sequences(apps, schema_editor):
+    """按已有单号初始化各（前缀, 日期）的序号，新发放的单号不会与历史单号重复"""
+    DocumentSequence = apps.get_model('inventory', 'DocumentSequence')
+
+    sequences = []
+    for app_label, model_name, field, prefix in DOCUMENTS:
+        model = apps.get_model(app_label, model_name)
+        pattern = re.compile(rf'^{re.escape(prefix)}(\d{{8}})(\d+)$')
+        last_values = {}
+        numbers = model.objects.filter(**{f'{field}__startswith': prefix}).values_list(field, flat=True)
+        for number in numbers.iterator(chunk_size=BATCH_SIZE):
+            match = pattern.match(number)
+            if not match:
+                continue
+            try:
+                date = datetime.datetime.strptime(match.group(1), '%Y%m%d').date()
+            except ValueError:
+                continue
+            last_values[date] = max(last_values.get(date, 0), int(match.group(2)))
+
+        sequences.extend(
+            DocumentSequence(prefix=prefix, date=date, last_value=last_value)
+            for date, last_value in last_values.items()
+        )
+
+    DocumentSequence.objects.bulk_create(sequences, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0018_document_sequence'),
+        ('orders', '0001_initial'),
+        ('production', '0008_backfill_batch_lineage'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.6 on 2026-10-18 07:06
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0019_seed_document_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductMaterial',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=4, help_text='每件产品所需的材料数量（按材料单位）或半成品件数', max_digits=12, verbose_name='单件用量')),
+                ('scrap_rate', models.DecimalField(decimal_places=4, default=Decimal('0.0000'), help_text='如 0.05 表示额外损耗 5%', max_digits=5, verbose_name='损耗率')),
+                ('notes', models.TextField(blank=True, verbose_name='备注')),
+                ('component', models.ForeignKey(blank=True, help_text='下级产品，与材料二选一', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='used_in_boms', to='inventory.product', verbose_name='半成品')),
+                ('material', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='bom_usages', to='inventory.material', verbose_name='材料')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bom_lines', to='inventory.product', verbose_name='产品')),
+            ],
+            options={
+                'verbose_name': '物料清单',
+                'verbose_name_plural': '物料清单',
+                'unique_together': {('product', 'component'), ('product', 'material')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.6 on 2026-10-18 07:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0020_product_material'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='materialmovement',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inventory.materialbatch', verbose_name='批次'),
+        ),
+        migrations.AlterField(
+            model_name='materialmovement',
+            name='purchase',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='materialmovements', to='inventory.materialpurchase', verbose_name='采购单'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0021_materialmovement_keep_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventoryitem',
+            name='location',
+            field=models.CharField(blank=True, max_length=50, verbose_name='库位'),
+        ),
+    ]
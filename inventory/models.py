@@ -6,10 +6,282 @@ from django.dispatch import receiver
 from decimal import Decimal
 from django.utils import timezone
 import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from django.db import transaction
-from django.db.models import Sum, Max
+from django.db.models import F, Value, Case, When, Q
+from django.db.models.lookups import GreaterThanOrEqual
 from django.urls import reverse
 
+
+# 批量过账时每条UPDATE涉及的库位数，避免 CASE 和 IN 条件超出数据库的表达式和参数限制
+STOCK_POSTING_CHUNK_SIZE = 500
+
+
+def _apply_delta(queryset, delta):
+    """对 queryset 选中的单行做条件UPDATE过账，需在事务中调用"""
+    if delta < 0:
+        updated = queryset.filter(stock__gte=-delta).update(stock=F('stock') + delta)
+        if not updated:
+            current = queryset.values_list('stock', flat=True).first() or Decimal('0')
+            raise ValidationError(f'库存不足，当前库存: {current}, 需要: {-delta}')
+    elif delta > 0:
+        queryset.update(stock=F('stock') + delta)
+
+
+def apply_stock_delta(model, pk, delta):
+    """
+    以单条条件UPDATE原子地过账库存，返回过账后的库存
+
+    出库（delta < 0）时附加 stock >= 数量 条件，库存不足则不更新并抛出异常；
+    只更新 stock 一列，不会覆盖其他字段，并发过账不会丢失更新。
+    """
+    queryset = model.objects.filter(pk=pk)
+    with transaction.atomic():
+        _apply_delta(queryset, Decimal(str(delta)))
+        # 本事务已持有该行的写锁，读取到的即为本次过账后的余额
+        return queryset.values_list('stock', flat=True).get()
+
+
+def _update_fields_excluding(instance, maintained_fields):
+    """整行保存时需要写入的字段：排除由过账或预留汇总维护的字段"""
+    return [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in maintained_fields
+    ]
+
+
+def _chunks(items, size):
+    """把列表按 size 切块"""
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def post_material_stocks(deltas):
+    """
+    按（材料, 库位）批量过账库存，返回 {材料ID: 过账后的总库存}
+
+    deltas 为 {(材料ID, 库位): 变动量}。每个库位只锁定对应的一行，不同库位的过账互不阻塞；
+    出库只检查该库位的库存，任一库位不足则整体不过账。
+    每 STOCK_POSTING_CHUNK_SIZE 个库位用一条条件UPDATE过账，避免单条SQL的表达式超出数据库限制。
+    材料总库存在同一事务中按净变动量更新，与库位库存同时提交或回滚。
+    """
+    deltas = {
+        (material_id, location or ''): Decimal(str(delta))
+        for (material_id, location), delta in deltas.items()
+    }
+    if not deltas:
+        return {}
+    material_ids = {material_id for material_id, _ in deltas}
+    # 按材料和库位两个 IN 条件选行，逐键匹配放在 CASE 中：不匹配任何键的行变动量为 NULL，不会被更新
+    rows = MaterialLocationStock.objects.filter(
+        material_id__in=material_ids, location__in={location for _, location in deltas})
+    decimal_field = models.DecimalField(max_digits=10, decimal_places=2)
+    with transaction.atomic():
+        # 入库的库位行不存在时先一次性补建
+        incoming = [key for key, delta in deltas.items() if delta > 0]
+        if incoming:
+            MaterialLocationStock.objects.bulk_create(
+                [MaterialLocationStock(material_id=material_id, location=location)
+                 for material_id, location in incoming],
+                ignore_conflicts=True,
+                batch_size=STOCK_POSTING_CHUNK_SIZE,
+            )
+        if len(deltas) > 1:
+            # 按固定顺序加锁，避免并发过账相互死锁
+            list(rows.select_for_update().order_by('material_id', 'location').values_list('pk'))
+        # 出库附加 库存 + 变动量 >= 0 条件，不足的库位不会被更新
+        updated = 0
+        for chunk in _chunks(sorted(deltas.items()), STOCK_POSTING_CHUNK_SIZE):
+            delta_expression = Case(
+                *[When(material_id=material_id, location=location, then=Value(delta))
+                  for (material_id, location), delta in chunk],
+                output_field=decimal_field,
+            )
+            updated += rows.filter(
+                material_id__in={material_id for (material_id, _), _ in chunk},
+                location__in={location for (_, location), _ in chunk},
+            ).filter(GreaterThanOrEqual(F('stock') + delta_expression, 0)).update(
+                stock=F('stock') + delta_expression)
+        if updated != len(deltas):
+            current = dict(
+                ((material_id, location), stock)
+                for material_id, location, stock in rows.values_list('material_id', 'location', 'stock')
+            )
+            for key, delta in sorted(deltas.items()):
+                stock = current.get(key, Decimal('0'))
+                if stock + delta < 0:
+                    raise ValidationError(f'库存不足，当前库存: {stock}, 需要: {-delta}')
+        # 库位行已按固定顺序锁定后再更新材料总库存，加锁顺序与其他过账一致
+        material_deltas = defaultdict(Decimal)
+        for (material_id, _), delta in deltas.items():
+            material_deltas[material_id] += delta
+        for chunk in _chunks(sorted(material_deltas.items()), STOCK_POSTING_CHUNK_SIZE):
+            Material.objects.filter(pk__in=[material_id for material_id, _ in chunk]).update(
+                stock=F('stock') + Case(
+                    *[When(pk=material_id, then=Value(delta)) for material_id, delta in chunk],
+                    output_field=decimal_field,
+                ))
+        totals = dict(Material.objects.filter(pk__in=material_ids).values_list('pk', 'stock'))
+    return {material_id: totals.get(material_id, Decimal('0')) for material_id in material_ids}
+
+
+def post_material_stock(material_id, location, delta):
+    """按（材料, 库位）过账库存，返回过账后该材料的总库存"""
+    return post_material_stocks({(material_id, location or ''): delta})[material_id]
+
+
+def post_product_stocks(deltas):
+    """
+    用一条条件UPDATE按产品批量过账库存，返回 {产品ID: 过账后的库存}
+
+    deltas 为 {产品ID: 变动量}。出库附加 库存 + 变动量 >= 0 条件，
+    任一产品库存不足则整体不过账；调用方应先锁定产品行并给出逐行的校验提示。
+    """
+    deltas = {product_id: Decimal(str(delta)) for product_id, delta in deltas.items()}
+    if not deltas:
+        return {}
+    products = Product.objects.filter(pk__in=deltas)
+    delta_expression = Case(
+        *[When(pk=product_id, then=Value(delta)) for product_id, delta in deltas.items()],
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+    )
+    with transaction.atomic():
+        updated = products.filter(GreaterThanOrEqual(F('stock') + delta_expression, 0)).update(
+            stock=F('stock') + delta_expression)
+        balances = dict(products.values_list('pk', 'stock'))
+        if updated != len(deltas):
+            for product_id, delta in sorted(deltas.items()):
+                stock = balances.get(product_id, Decimal('0'))
+                if stock + delta < 0:
+                    raise ValidationError(f'库存不足，当前库存: {stock}, 需要: {-delta}')
+    return balances
+
+
+def cache_versions(keys):
+    """
+    读取一组缓存版本号 {键: 版本号}，一次查询，没有记录的键版本号为 0
+
+    版本号保存在数据库中，各进程（包括管理命令）读取到的版本号一致；
+    结果缓存的键包含版本号，版本号递增后各进程的旧缓存同时失效。
+    """
+    keys = set(keys)
+    versions = dict(CacheVersion.objects.filter(key__in=keys).values_list('key', 'version'))
+    return {key: versions.get(key, 0) for key in keys}
+
+
+def bump_cache_versions(keys):
+    """
+    递增一组缓存版本号，与数据变更在同一事务中提交
+
+    事务提交前其他进程读取到的仍是旧版本号和旧数据，不会把旧数据缓存到新版本下。
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    with transaction.atomic():
+        updated = CacheVersion.objects.filter(key__in=keys).update(
+            version=F('version') + 1, updated_at=timezone.now())
+        if updated < len(keys):
+            # 首次使用的键先补建再递增；已存在的行版本号至少为 1，不会被重复递增
+            CacheVersion.objects.bulk_create([CacheVersion(key=key) for key in keys], ignore_conflicts=True)
+            CacheVersion.objects.filter(key__in=keys, version=0).update(version=1, updated_at=timezone.now())
+
+
+def _batch_version_key(material_id):
+    return f'material_batches:{material_id}'
+
+
+def batch_versions(material_ids):
+    """各材料批次数据的缓存版本号，批次变化后版本号随之改变"""
+    keys = {material_id: _batch_version_key(material_id) for material_id in material_ids}
+    versions = cache_versions(keys.values())
+    return {material_id: versions[key] for material_id, key in keys.items()}
+
+
+_deferred_batch_touches = threading.local()
+
+
+def touch_material_batches(material_ids):
+    """标记材料的批次已变化，使依赖批次数据的缓存（如领料分配预览）失效"""
+    pending = getattr(_deferred_batch_touches, 'material_ids', None)
+    if pending is not None:
+        pending.update(material_ids)
+        return
+    bump_cache_versions(_batch_version_key(material_id) for material_id in material_ids)
+
+
+@contextmanager
+def deferred_batch_touches():
+    """
+    合并块内的批次缓存失效，退出时一次递增涉及材料的版本号
+
+    批量删除批次时每个批次都会触发一次 post_delete 信号，合并后查询数与批次数无关。
+    """
+    if getattr(_deferred_batch_touches, 'material_ids', None) is not None:
+        yield
+        return
+    _deferred_batch_touches.material_ids = set()
+    try:
+        yield
+        material_ids = _deferred_batch_touches.material_ids
+    finally:
+        _deferred_batch_touches.material_ids = None
+    touch_material_batches(material_ids)
+
+
+def deduct_batch_quantities(batch_outgoing, material_ids):
+    """
+    用一条UPDATE扣减多个批次的剩余数量，扣减到0的批次同时标记为已耗尽
+
+    batch_outgoing 为 {批次ID: 出库数量}，material_ids 为这些批次所属的材料。
+    """
+    if not batch_outgoing:
+        return
+    outgoing = Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in batch_outgoing.items()],
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+    )
+    batches = MaterialBatch.objects.filter(pk__in=batch_outgoing)
+    with transaction.atomic():
+        # 附加 剩余数量 >= 出库数量 条件，剩余数量不会被扣减为负数；SET 子句中引用的是更新前的值
+        updated = batches.filter(GreaterThanOrEqual(F('remaining_quantity') - outgoing, 0)).update(
+            remaining_quantity=F('remaining_quantity') - outgoing,
+            status=Case(
+                When(remaining_quantity__lte=outgoing, then=Value('depleted')),
+                default=F('status'),
+            ),
+        )
+        if updated != len(batch_outgoing):
+            for pk, batch_number, remaining in batches.order_by('pk').values_list(
+                    'pk', 'batch_number', 'remaining_quantity'):
+                if remaining < batch_outgoing[pk]:
+                    raise ValidationError(
+                        f'批次 {batch_number} 剩余数量不足，剩余: {remaining}, 需要: {batch_outgoing[pk]}')
+        touch_material_batches(material_ids)
+
+
+# 变动记录的来源单据类型与业务原因
+MOVEMENT_SOURCE_TYPES = [
+    ('purchase', '采购单'),
+    ('production_order', '生产单'),
+    ('sales_order', '销售订单'),
+    ('product_outbound', '产品出库单'),
+    ('inventory', '库存盘点'),
+]
+
+MOVEMENT_REASONS = [
+    ('purchase_receipt', '采购入库'),
+    ('purchase_reversal', '撤销采购入库'),
+    ('production_issue', '生产领料'),
+    ('production_receipt', '生产完成入库'),
+    ('production_reversal', '撤销生产完成'),
+    ('sales_shipment', '订单发货出库'),
+    ('outbound', '产品出库'),
+    ('outbound_reversal', '撤销产品出库'),
+    ('adjustment', '库存调整'),
+]
+
 class Material(models.Model):
     """材料"""
     objects = models.Manager()  # 显式声明管理器
@@ -20,6 +292,13 @@ class Material(models.Model):
     supply_method = models.CharField(max_length=50, verbose_name='来料方式', null=True, blank=True)
     unit = models.CharField(max_length=20, verbose_name='单位')
     stock = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), verbose_name='库存')
+    reserved_stock = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=Decimal('0.00'),
+        editable=False,
+        verbose_name='预留库存'
+    )
     min_stock = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), verbose_name='最小库存')
     warning_stock = models.DecimalField(
         max_digits=10, 
@@ -51,6 +330,33 @@ class Material(models.Model):
         verbose_name_plural = '材料'
         ordering = ['code']
 
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        if not is_new and kwargs.get('update_fields') is None:
+            # 总库存由库位库存汇总维护、预留库存由需求汇总维护，整行保存时不写回可能已过期的值
+            kwargs['update_fields'] = _update_fields_excluding(self, ('stock', 'reserved_stock'))
+        opening_stock = self.stock if is_new else None
+        with transaction.atomic():
+            if opening_stock:
+                # 期初库存通过入库记录过账，总库存由过账回写
+                self.stock = 0
+            super().save(*args, **kwargs)
+            if opening_stock:
+                # 新建材料的期初库存记入默认库位，并留下调整入库记录供对账
+                MaterialMovement.objects.create(
+                    material=self,
+                    movement_type='in',
+                    quantity=opening_stock,
+                    unit=self.unit,
+                    reason='adjustment',
+                    notes='期初库存'
+                )
+
+    @property
+    def available_stock(self):
+        """可用库存 = 库存 - 预留库存"""
+        return self.stock - self.reserved_stock
+
     def get_stock_status(self):
         """获取库存状态"""
         if self.stock <= self.min_stock:
@@ -66,6 +372,28 @@ class Material(models.Model):
         status, _ = self.get_stock_status()
         return status in ['danger', 'warning']
 
+class MaterialLocationStock(models.Model):
+    """材料库位库存"""
+    objects = models.Manager()  # 显式声明管理器
+    material = models.ForeignKey(
+        Material,
+        on_delete=models.CASCADE,
+        related_name='location_stocks',
+        verbose_name='材料'
+    )
+    location = models.CharField(max_length=50, blank=True, verbose_name='库位')
+    stock = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), verbose_name='库存')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+
+    def __str__(self):
+        return f"{self.material.name} - {self.location or '默认库位'} - {self.stock}"
+
+    class Meta:
+        unique_together = ['material', 'location']
+        verbose_name = '材料库位库存'
+        verbose_name_plural = '材料库位库存'
+        ordering = ['material', 'location']
+
 class MaterialMovement(models.Model):
     """原材料变动记录"""
     objects = models.Manager()  # 显式声明管理器
@@ -83,7 +411,7 @@ class MaterialMovement(models.Model):
     reference_number = models.CharField(max_length=50, blank=True, verbose_name='关联单号')
     purchase = models.ForeignKey(
         'MaterialPurchase',
-        on_delete=models.CASCADE,  # 采购单删除时同步删除相关记录
+        on_delete=models.SET_NULL,  # 变动记录是库存台账，采购单删除后保留，来源仍可由 source_type/source_id 追溯
         related_name='materialmovements',
         null=True,
         blank=True,
@@ -104,32 +432,57 @@ class MaterialMovement(models.Model):
     )
     batch = models.ForeignKey(
         'MaterialBatch',
-        on_delete=models.CASCADE,  # 改为 CASCADE，这样删除批次时会同步删除相关的变动记录
+        on_delete=models.SET_NULL,  # 撤销入库删除批次时保留入库记录，与冲销记录一起构成完整台账
         null=True,
         blank=True,
         verbose_name='批次'
     )
+    source_type = models.CharField(
+        max_length=20,
+        choices=MOVEMENT_SOURCE_TYPES,
+        blank=True,
+        verbose_name='来源单据类型'
+    )
+    source_id = models.PositiveBigIntegerField(null=True, blank=True, verbose_name='来源单据ID')
+    reason = models.CharField(
+        max_length=20,
+        choices=MOVEMENT_REASONS,
+        blank=True,
+        verbose_name='变动原因'
+    )
+
+    # 过账时已计入库位库存和批次剩余数量的字段
+    POSTED_FIELDS = ('material_id', 'movement_type', 'quantity', 'location', 'batch_id')
 
     def save(self, *args, **kwargs):
         is_new = not self.pk  # 判断是否新记录
         
         if is_new:  # 只在创建新记录时更新库存
             with transaction.atomic():
-                # 更新材料库存
+                # 更新库位库存（条件UPDATE，库位库存不足时抛出异常）
                 if self.movement_type == 'in':
-                    self.material.stock += self.quantity
+                    self.material.stock = post_material_stock(self.material_id, self.location, self.quantity)
                 elif self.movement_type == 'out':
-                    if self.material.stock < self.quantity:
-                        raise ValidationError(f'库存不足，当前库存: {self.material.stock}, 需要: {self.quantity}')
-                    self.material.stock -= self.quantity
+                    self.material.stock = post_material_stock(self.material_id, self.location, -self.quantity)
                 elif self.movement_type == 'adjust':
                     # 调整不改变库存，由调整单独处理
                     pass
                 
-                self.material.save()
+                # 按增量更新批次剩余数量，与变动记录在同一事务中
+                if self.batch_id and self.movement_type == 'out':
+                    deduct_batch_quantities({self.batch_id: self.quantity}, [self.material_id])
+                    if MaterialMovement.batch.is_cached(self):
+                        self.batch.remaining_quantity -= self.quantity
+                        if self.batch.remaining_quantity <= 0:
+                            self.batch.status = 'depleted'
+                
                 # 保存变动记录
                 super().save(*args, **kwargs)
         else:
+            # 已过账的库存与批次数量不会随修改重算，影响过账的字段不允许修改
+            posted = MaterialMovement.objects.filter(pk=self.pk).values(*self.POSTED_FIELDS).first()
+            if posted and any(posted[field] != getattr(self, field) for field in self.POSTED_FIELDS):
+                raise ValidationError('已过账的变动记录不能修改材料、类型、数量、库位或批次，请另行录入冲销或调整记录')
             super().save(*args, **kwargs)
 
     def __str__(self):
@@ -139,6 +492,11 @@ class MaterialMovement(models.Model):
         verbose_name = '材料变动'
         verbose_name_plural = '材料变动'
         ordering = ['-movement_date']
+        indexes = [
+            models.Index(fields=['source_type', 'source_id', 'reason'], name='materialmove_source_idx'),
+            models.Index(fields=['material', 'movement_date'], name='materialmove_material_date_idx'),
+            models.Index(fields=['batch', 'movement_type'], name='materialmove_batch_type_idx'),
+        ]
 
 class Supplier(models.Model):
     """供应商"""
@@ -187,118 +545,105 @@ class MaterialPurchase(models.Model):
     def __str__(self):
         return self.purchase_number
 
-    def delete(self, *args, **kwargs):
-        """重写删除方法，确保关联数据一起删除"""
-        from django.db import transaction
-        with transaction.atomic():
-            # 删除相关的入库记录（会触发库存回滚）
-            self.materialmovements.all().delete()
-            # 删除采购单
-            super().delete(*args, **kwargs)
-
-    def receive_materials(self):
-        """处理采购单入库"""
+    def receive_materials(self, location=''):
+        """处理采购单入库，全部明细入库到 location 库位"""
         if self.status != 'pending':
             raise ValidationError('只能对待入库状态的采购单进行入库操作')
-        
-        # 检查是否已经有入库记录
-        if MaterialMovement.objects.filter(purchase=self, movement_type='in').exists():
-            raise ValidationError('该采购单已有入库记录，请先撤销入库')
-        
+
+        # 已分批到货的明细只入库剩余的未入库数量
+        from .receiving import receive_purchases
+
         try:
-            with transaction.atomic():
-                for item in self.items.all():
-                    # 创建材料批次
-                    batch = MaterialBatch.objects.create(
-                        material=item.material,
-                        batch_number=f"{self.purchase_number}-{item.id}",
-                        purchase=self,
-                        production_date=timezone.now().date(),
-                        initial_quantity=item.quantity,
-                        remaining_quantity=item.quantity
-                    )
-                    
-                    # 创建入库记录 - 这会通过MaterialMovement的save方法自动更新库存
-                    MaterialMovement.objects.create(
-                        material=item.material,
-                        movement_type='in',
-                        quantity=item.quantity,
-                        unit=item.unit,
-                        reference_number=self.purchase_number,
-                        purchase=self,
-                        batch=batch,
-                        notes=f'采购入库：{self.purchase_number}'
-                    )
-                    
-                    # 不需要再次更新库存，因为MaterialMovement的save方法已经更新过库存了
-                    # item.material.stock += item.quantity
-                    # item.material.save()
-                    
-                    # 更新采购项的已入库数量
-                    item.received_quantity = item.quantity
-                    item.save()
-                
-                # 更新采购单状态
-                self.status = 'received'
-                self.save()
-                
+            receive_purchases([self.pk], location)
         except Exception as e:
             raise ValidationError(f'入库处理失败：{str(e)}')
 
+        self.status = self._original_status = 'received'
+
+    def open_receipt_movements(self):
+        """尚未撤销的入库记录：撤销入库会删除批次，已冲销的入库记录不再关联批次"""
+        return MaterialMovement.objects.filter(
+            source_type='purchase',
+            source_id=self.pk,
+            reason='purchase_receipt',
+            batch__isnull=False,
+        )
+
+    def write_reversal_movements(self, inbound_movements, link_purchase=True):
+        """为入库记录批量写入对应库位的冲销出库记录，库存由调用方过账"""
+        MaterialMovement.objects.bulk_create([
+            MaterialMovement(
+                material_id=movement.material_id,
+                movement_type='out',
+                quantity=movement.quantity,
+                unit=movement.unit,
+                reference_number=self.purchase_number,
+                purchase=self if link_purchase else None,
+                location=movement.location,
+                source_type='purchase',
+                source_id=self.pk,
+                reason='purchase_reversal',
+                notes=f'撤销入库：{self.purchase_number}'
+            )
+            for movement in inbound_movements
+        ])
+
     def cancel_inbound(self):
-        """撤销入库"""
+        """
+        撤销入库
+
+        已用批次检查、入库记录汇总各一次查询；冲销记录批量写入，
+        每个（材料, 库位）只过账一次库存，查询数与采购明细行数无关。
+        """
         try:
             with transaction.atomic():
                 # 检查批次是否已被用于生产
-                used_batches = self.material_batches.filter(
-                    productionmaterial__isnull=False
+                used_batch_numbers = list(
+                    self.material_batches.filter(productionmaterial__isnull=False)
+                    .values_list('batch_number', flat=True).distinct()
                 )
-                if used_batches.exists():
+                if used_batch_numbers:
                     raise ValidationError(
                         f'以下批次已用于生产，无法撤销：'
-                        f'{", ".join([b.batch_number for b in used_batches])}'
+                        f'{", ".join(used_batch_numbers)}'
                     )
 
-                # 获取相关的所有入库记录
-                inbound_movements = MaterialMovement.objects.filter(
-                    purchase=self, 
-                    movement_type='in'
-                )
-                
-                if not inbound_movements.exists():
+                # 获取尚未撤销的入库记录
+                inbound_movements = list(self.open_receipt_movements().select_related('material').order_by('pk'))
+
+                if not inbound_movements:
                     raise ValidationError('未找到相关入库记录')
-                
+
+                # 按入库时的（材料, 库位）汇总撤销数量，一次检查各库位库存是否足够
+                materials = {}
+                location_outgoing = defaultdict(Decimal)
                 for movement in inbound_movements:
-                    # 检查库存是否足够
-                    if movement.material.stock < movement.quantity:
+                    materials[movement.material_id] = movement.material
+                    location_outgoing[(movement.material_id, movement.location)] += movement.quantity
+                location_stocks = {
+                    (material_id, location): stock
+                    for material_id, location, stock in MaterialLocationStock.objects.filter(
+                        material_id__in=materials).values_list('material_id', 'location', 'stock')
+                }
+                for (material_id, location), quantity in sorted(location_outgoing.items()):
+                    stock = location_stocks.get((material_id, location), Decimal('0'))
+                    if stock < quantity:
                         raise ValidationError(
-                            f'材料 {movement.material.name} 当前库存不足，无法撤销。'
-                            f'需要: {movement.quantity}, '
-                            f'当前库存: {movement.material.stock}'
+                            f"材料 {materials[material_id].name} 库位 {location or '默认'} 当前库存不足，无法撤销。"
+                            f'需要: {quantity}, '
+                            f'当前库存: {stock}'
                         )
 
-                    # 不需要手动更新库存，MaterialMovement.save会自动处理
-                    # movement.material.stock -= movement.quantity
-                    # movement.material.save()
+                # 每个（材料, 库位）只过账一次库存，冲销记录直接批量写入
+                post_material_stocks({key: -quantity for key, quantity in location_outgoing.items()})
+                self.write_reversal_movements(inbound_movements)
+
+                # 删除批次记录，入库记录保留并不再关联批次
+                with deferred_batch_touches():
+                    self.material_batches.all().delete()
 
-                    # 创建出库记录 - 这会通过MaterialMovement的save方法自动减少库存
-                    MaterialMovement.objects.create(
-                        material=movement.material,
-                        movement_type='out',
-                        quantity=movement.quantity,
-                        unit=movement.unit,
-                        reference_number=self.purchase_number,
-                        purchase=self,
-                        notes=f'撤销入库：{self.purchase_number}'
-                    )
-                
-                # 删除批次记录
-                self.material_batches.all().delete()
-                
                 # 重置采购项的已入库数量
-                for item in self.items.all():
-                    item.received_quantity = Decimal('0.00')
-                    item.save()
+                self.items.update(received_quantity=Decimal('0.00'))
 
                 # 更新状态
                 self.status = 'pending'
@@ -316,6 +661,10 @@ class MaterialPurchase(models.Model):
         verbose_name = '采购单'
         verbose_name_plural = '采购单'
         ordering = ['-purchase_date']
+        indexes = [
+            # 在途数量汇总只读取待入库的采购单
+            models.Index(fields=['status'], name='materialpurchase_status_idx'),
+        ]
 
 @receiver(post_save, sender=MaterialPurchase)
 def update_original_status(sender, instance, **kwargs):
@@ -367,52 +716,15 @@ class PurchaseItem(models.Model):
 @receiver(pre_delete, sender=MaterialPurchase)
 def reverse_material_purchase(sender, instance, **kwargs):
     """在删除采购单时回滚库存"""
-    if instance.status == 'received':
-        for item in instance.items.all():
-            # 创建出库记录
-            MaterialMovement.objects.create(
-                material=item.material,
-                movement_type='out',
-                quantity=item.quantity,
-                unit=item.unit,
-                reference_number=instance.purchase_number,
-                notes=f'采购单删除：{instance.purchase_number}'
-            )
-            
-            # 更新材料库存
-            material = item.material
-            material.stock -= item.quantity
-            material.save()
-
-# 在订单状态变为生产中时自动扣减原材料
-@receiver(post_save, sender='orders.Order')
-def handle_order_material_consumption(sender, instance, **kwargs):
-    """处理订单原材料消耗"""
-    if not hasattr(instance, '_original_status'):
-        return
-        
-    old_status = instance._original_status
-    new_status = instance.status
-    
-    if old_status == new_status:
-        return
-    
-    # 当订单状态变为生产中时，扣减原材料
-    if new_status == 'processing':
-        for item in instance.items.all():
-            # 获取产品所需的原材料清单
-            material_requirements = item.product.productmaterial_set.all()
-            for requirement in material_requirements:
-                # 计算所需原材料总量
-                total_needed = requirement.quantity * item.quantity
-                # 创建原材料出库记录
-                MaterialMovement.objects.create(
-                    material=requirement.material,
-                    movement_type='out',
-                    quantity=total_needed,
-                    order=instance,
-                    notes=f'生产领料 - 订单号：{instance.order_number}'
-                )
+    # 入库记录随采购单保留，按各入库记录的库位过账冲销并写入冲销记录，库存与台账保持一致；
+    # 待入库的采购单可能已分批到货一部分。冲销记录写入时采购单即将删除，不再关联采购单
+    inbound_movements = list(instance.open_receipt_movements())
+    deltas = defaultdict(Decimal)
+    for movement in inbound_movements:
+        deltas[(movement.material_id, movement.location)] -= movement.quantity
+    if deltas:
+        post_material_stocks(deltas)
+        instance.write_reversal_movements(inbound_movements, link_purchase=False)
 
 class MaterialBatch(models.Model):
     """材料批次"""
@@ -467,6 +779,14 @@ class MaterialBatch(models.Model):
     class Meta:
         verbose_name = '材料批次'
         verbose_name_plural = '材料批次'
+        indexes = [
+            # 只索引可用批次，已耗尽和已过期的历史批次不进入领料扫描
+            models.Index(
+                fields=['material', 'production_date'],
+                condition=Q(status='normal', remaining_quantity__gt=0),
+                name='materialbatch_live_fifo_idx',
+            ),
+        ]
 
 class Inventory(models.Model):
     """库存盘点"""
@@ -522,6 +842,65 @@ class Inventory(models.Model):
         self.adjustment_type = 'profit' if total_diff > 0 else 'loss' if total_diff < 0 else 'normal'
         self.save()
 
+    def confirm_inventory(self, operator=None):
+        """
+        确认盘点，把各明细（材料, 库位）的库位库存调整为实盘数量
+
+        系统数量取确认时已锁定的库位库存，差异写入盘盈（入库）或盘亏（出库）调整记录并一次过账，
+        库存与台账保持一致。
+        """
+        if self.status != 'draft':
+            raise ValidationError('只能确认草稿状态的盘点单')
+
+        with transaction.atomic():
+            items = list(self.items.select_related('material').order_by('pk'))
+            keys = [(item.material_id, item.location) for item in items]
+            duplicates = {key for key in keys if keys.count(key) > 1}
+            if duplicates:
+                material_id, location = min(duplicates)
+                material = next(item.material for item in items if item.material_id == material_id)
+                raise ValidationError(f"材料 {material.name} 库位 {location or '默认'} 重复盘点")
+
+            location_stocks = {
+                (material_id, location): stock
+                for material_id, location, stock in MaterialLocationStock.objects.select_for_update().filter(
+                    material_id__in={item.material_id for item in items}
+                ).order_by('material_id', 'location').values_list('material_id', 'location', 'stock')
+            }
+            deltas = {}
+            movements = []
+            for item in items:
+                key = (item.material_id, item.location)
+                item.system_quantity = location_stocks.get(key, Decimal('0'))
+                item.difference = item.actual_quantity - item.system_quantity
+                if not item.difference:
+                    continue
+                deltas[key] = item.difference
+                movements.append(MaterialMovement(
+                    material=item.material,
+                    movement_type='in' if item.difference > 0 else 'out',
+                    quantity=abs(item.difference),
+                    unit=item.material.unit,
+                    reference_number=self.inventory_number,
+                    operator=operator,
+                    location=item.location,
+                    source_type='inventory',
+                    source_id=self.pk,
+                    reason='adjustment',
+                    notes=f'盘点调整：{self.inventory_number}'
+                ))
+
+            # 每个（材料, 库位）只过账一次库存，调整记录直接批量写入
+            post_material_stocks(deltas)
+            MaterialMovement.objects.bulk_create(movements)
+            InventoryItem.objects.bulk_update(items, ['system_quantity', 'difference'])
+
+            self.total_difference = sum((item.difference for item in items), Decimal('0'))
+            self.adjustment_type = (
+                'profit' if self.total_difference > 0 else 'loss' if self.total_difference < 0 else 'normal')
+            self.status = 'confirmed'
+            self.save()
+
     class Meta:
         verbose_name = '库存盘点'
         verbose_name_plural = '库存盘点'
@@ -540,6 +919,7 @@ class InventoryItem(models.Model):
         on_delete=models.PROTECT,
         verbose_name='材料'
     )
+    location = models.CharField(max_length=50, blank=True, verbose_name='库位')
     system_quantity = models.DecimalField(
         max_digits=10,
         decimal_places=2,
@@ -581,6 +961,13 @@ class Product(models.Model):
         default=Decimal('0.00'),
         verbose_name='库存数量'
     )
+    reserved_stock = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=Decimal('0.00'),
+        editable=False,
+        verbose_name='预留库存'
+    )
     min_stock = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), verbose_name='最小库存')
     warning_stock = models.DecimalField(
         max_digits=10, 
@@ -612,16 +999,108 @@ class Product(models.Model):
         verbose_name_plural = '产品'
         ordering = ['code']
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # 预留库存由订单和出库单汇总维护，整行保存时不写回可能已过期的值
+            kwargs['update_fields'] = _update_fields_excluding(self, ('reserved_stock',))
+        super().save(*args, **kwargs)
+
+    @property
+    def available_stock(self):
+        """可用库存 = 库存 - 预留库存"""
+        return self.stock - self.reserved_stock
+
     def update_stock(self, quantity, movement_type):
-        """更新库存"""
-        with transaction.atomic():
-            if movement_type == 'in':
-                self.stock += quantity
-            elif movement_type == 'out':
-                if self.stock < quantity:
-                    raise ValidationError(f'库存不足，当前库存: {self.stock}, 需要: {quantity}')
-                self.stock -= quantity
-            self.save()
+        """更新库存，返回更新后的库存"""
+        if movement_type == 'in':
+            self.stock = apply_stock_delta(Product, self.pk, quantity)
+        elif movement_type == 'out':
+            self.stock = apply_stock_delta(Product, self.pk, -quantity)
+        return self.stock
+
+class ProductMaterial(models.Model):
+    """
+    产品物料清单（BOM）明细
+
+    每行为单件产品对一种材料或一种半成品（下级产品）的用量，可逐级嵌套；
+    实际用量 = 单件用量 × (1 + 损耗率)。展开后的单件材料用量见 inventory.bom。
+    """
+    objects = models.Manager()  # 显式声明管理器
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='bom_lines',
+        verbose_name='产品'
+    )
+    material = models.ForeignKey(
+        Material,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='bom_usages',
+        verbose_name='材料'
+    )
+    component = models.ForeignKey(
+        Product,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='used_in_boms',
+        verbose_name='半成品',
+        help_text='下级产品，与材料二选一'
+    )
+    quantity = models.DecimalField(
+        max_digits=12,
+        decimal_places=4,
+        verbose_name='单件用量',
+        help_text='每件产品所需的材料数量（按材料单位）或半成品件数'
+    )
+    scrap_rate = models.DecimalField(
+        max_digits=5,
+        decimal_places=4,
+        default=Decimal('0.0000'),
+        verbose_name='损耗率',
+        help_text='如 0.05 表示额外损耗 5%'
+    )
+    notes = models.TextField(blank=True, verbose_name='备注')
+
+    def __str__(self):
+        item = self.material if self.material_id else self.component
+        return f"{self.product.name} - {item}"
+
+    class Meta:
+        verbose_name = '物料清单'
+        verbose_name_plural = '物料清单'
+        unique_together = [['product', 'material'], ['product', 'component']]
+
+    @property
+    def gross_quantity(self):
+        """含损耗的单件用量"""
+        return self.quantity * (1 + self.scrap_rate)
+
+    def clean(self):
+        """数据验证"""
+        if bool(self.material_id) == bool(self.component_id):
+            raise ValidationError('材料和半成品必须且只能填写一项')
+        if self.quantity is None or self.quantity <= 0:
+            raise ValidationError('单件用量必须大于0')
+        if self.scrap_rate is None or not 0 <= self.scrap_rate < 1:
+            raise ValidationError('损耗率必须在0到1之间')
+        if self.component_id:
+            # 半成品不能直接或间接用到本产品，否则展开时会无限循环
+            ancestors = {self.product_id}
+            frontier = {self.product_id}
+            while frontier:
+                frontier = set(ProductMaterial.objects.filter(
+                    component_id__in=frontier
+                ).values_list('product_id', flat=True)) - ancestors
+                ancestors |= frontier
+            if self.component_id in ancestors:
+                raise ValidationError('半成品不能直接或间接包含本产品，物料清单不能循环引用')
+
+    def save(self, *args, **kwargs):
+        self.clean()
+        super().save(*args, **kwargs)
 
 class ProductMovement(models.Model):
     """产品变动记录"""
@@ -636,6 +1115,19 @@ class ProductMovement(models.Model):
     unit = models.CharField(max_length=20, verbose_name='单位')
     movement_date = models.DateTimeField(auto_now_add=True, verbose_name='变动时间')
     reference_number = models.CharField(max_length=50, verbose_name='关联单号')
+    source_type = models.CharField(
+        max_length=20,
+        choices=MOVEMENT_SOURCE_TYPES,
+        blank=True,
+        verbose_name='来源单据类型'
+    )
+    source_id = models.PositiveBigIntegerField(null=True, blank=True, verbose_name='来源单据ID')
+    reason = models.CharField(
+        max_length=20,
+        choices=MOVEMENT_REASONS,
+        blank=True,
+        verbose_name='变动原因'
+    )
     notes = models.TextField(blank=True, verbose_name='备注')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
 
@@ -659,6 +1151,10 @@ class ProductMovement(models.Model):
         verbose_name = '产品变动'
         verbose_name_plural = '产品变动'
         ordering = ['-movement_date']
+        indexes = [
+            models.Index(fields=['source_type', 'source_id', 'reason'], name='productmove_source_idx'),
+            models.Index(fields=['reference_number', 'movement_type'], name='productmove_ref_type_idx'),
+        ]
 
 class InventoryStatistics(models.Model):
     """库存统计"""
@@ -677,6 +1173,50 @@ class InventoryStatistics(models.Model):
         verbose_name = '库存统计'
         verbose_name_plural = '库存统计'
 
+class MaterialStockCheckpoint(models.Model):
+    """材料库存检查点（某日日末的库存余额）"""
+    objects = models.Manager()  # 显式声明管理器
+    material = models.ForeignKey(
+        Material,
+        on_delete=models.CASCADE,
+        related_name='stock_checkpoints',
+        verbose_name='材料'
+    )
+    date = models.DateField(verbose_name='检查点日期')
+    stock = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='日末库存')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+
+    def __str__(self):
+        return f"{self.material.name} - {self.date} - {self.stock}"
+
+    class Meta:
+        unique_together = ['material', 'date']
+        verbose_name = '材料库存检查点'
+        verbose_name_plural = '材料库存检查点'
+        ordering = ['-date']
+
+class ProductStockCheckpoint(models.Model):
+    """产品库存检查点（某日日末的库存余额）"""
+    objects = models.Manager()  # 显式声明管理器
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='stock_checkpoints',
+        verbose_name='产品'
+    )
+    date = models.DateField(verbose_name='检查点日期')
+    stock = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='日末库存')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+
+    def __str__(self):
+        return f"{self.product.name} - {self.date} - {self.stock}"
+
+    class Meta:
+        unique_together = ['product', 'date']
+        verbose_name = '产品库存检查点'
+        verbose_name_plural = '产品库存检查点'
+        ordering = ['-date']
+
 class MaterialCost(models.Model):
     """材料成本"""
     material = models.ForeignKey(Material, on_delete=models.CASCADE, verbose_name='材料')
@@ -692,16 +1232,6 @@ class MaterialCost(models.Model):
         verbose_name = '材料成本'
         verbose_name_plural = '材料成本'
 
-@receiver(post_save, sender=MaterialMovement)
-def update_batch_quantity(sender, instance, **kwargs):
-    """更新批次剩余数量"""
-    if instance.batch:
-        movements = MaterialMovement.objects.filter(batch=instance.batch)
-        total_out = movements.filter(movement_type='out').aggregate(
-            total=Sum('quantity'))['total'] or 0
-        instance.batch.remaining_quantity = instance.batch.initial_quantity - total_out
-        instance.batch.save()
-
 class ProductOutbound(models.Model):
     """产品出库单"""
     objects = models.Manager()  # 显式声明管理器
@@ -738,66 +1268,78 @@ class ProductOutbound(models.Model):
     )
 
     def generate_outbound_number(self):
-        """生成出库单号：日期+序号（如：20250626001）"""
-        today = timezone.now().date()
-        date_str = today.strftime('%Y%m%d')
-        
-        # 查询当天已有的出库单号，获取最大序号
-        existing_numbers = ProductOutbound.objects.filter(
-            outbound_date=today,
-            outbound_number__startswith=date_str
-        ).values_list('outbound_number', flat=True)
-        
-        max_sequence = 0
-        for number in existing_numbers:
-            try:
-                # 提取序号部分（最后3位）
-                sequence = int(number[-3:])
-                max_sequence = max(max_sequence, sequence)
-            except (ValueError, IndexError):
-                continue
-        
-        # 生成新的序号
-        new_sequence = max_sequence + 1
-        return f"{date_str}{new_sequence:03d}"
+        """生成出库单号：日期+序号（如：20250626001），由单据编号序列发放"""
+        from .sequences import PRODUCT_OUTBOUND, next_document_number
+        return next_document_number(PRODUCT_OUTBOUND)
 
     def save(self, *args, **kwargs):
-        # 如果是新记录且没有出库单号，则自动生成
-        if not self.pk and not self.outbound_number:
-            self.outbound_number = self.generate_outbound_number()
-        super().save(*args, **kwargs)
+        # 单号与出库单在同一事务中发放，保存失败时序号一并回滚
+        with transaction.atomic():
+            # 如果是新记录且没有出库单号，则自动生成
+            if not self.pk and not self.outbound_number:
+                self.outbound_number = self.generate_outbound_number()
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return self.outbound_number
 
     def confirm_outbound(self):
-        """确认出库"""
+        """
+        确认出库
+
+        锁定出库单和涉及的产品后一次校验全部明细，出库记录批量写入，
+        每个产品只过账一次库存；并发确认的出库单不会同时通过库存检查。
+        """
         if self.status != 'draft':
             raise ValidationError('只能确认草稿状态的出库单')
         
-        if not self.items.exists():
-            raise ValidationError('出库单没有明细，无法确认')
-        
         try:
             with transaction.atomic():
-                for item in self.items.all():
-                    # 检查库存是否足够
-                    if item.product.stock < item.quantity:
-                        raise ValidationError(
-                            f'产品 {item.product.name} 库存不足，'
-                            f'需要 {item.quantity}，'
-                            f'当前库存 {item.product.stock}'
-                        )
-                    
-                    # 创建产品出库记录
-                    ProductMovement.objects.create(
-                        product=item.product,
+                # 锁定出库单，防止同一出库单被重复确认
+                status = ProductOutbound.objects.select_for_update().filter(
+                    pk=self.pk).values_list('status', flat=True).first()
+                if status != 'draft':
+                    raise ValidationError('只能确认草稿状态的出库单')
+
+                items = list(self.items.order_by('pk'))
+                if not items:
+                    raise ValidationError('出库单没有明细，无法确认')
+
+                outgoing = {}
+                for item in items:
+                    outgoing[item.product_id] = outgoing.get(item.product_id, Decimal('0')) + item.quantity
+
+                # 按固定顺序一次锁定全部产品，检查库存是否足够
+                products = {
+                    product.pk: product
+                    for product in Product.objects.select_for_update().filter(pk__in=outgoing).order_by('pk')
+                }
+                errors = [
+                    f'产品 {products[product_id].name} 库存不足，'
+                    f'需要 {quantity}，'
+                    f'当前库存 {products[product_id].stock}'
+                    for product_id, quantity in outgoing.items()
+                    if products[product_id].stock < quantity
+                ]
+                if errors:
+                    raise ValidationError(errors)
+
+                # 每个产品只过账一次库存，出库记录直接批量写入
+                post_product_stocks({product_id: -quantity for product_id, quantity in outgoing.items()})
+                ProductMovement.objects.bulk_create([
+                    ProductMovement(
+                        product=products[item.product_id],
                         movement_type='out',
                         quantity=item.quantity,
-                        unit=item.product.unit,
+                        unit=products[item.product_id].unit,
                         reference_number=self.outbound_number,
+                        source_type='product_outbound',
+                        source_id=self.pk,
+                        reason='outbound',
                         notes=f'产品出库：{self.outbound_number}'
                     )
+                    for item in items
+                ])
                 
                 # 更新出库单状态
                 self.status = 'confirmed'
@@ -817,8 +1359,9 @@ class ProductOutbound(models.Model):
             with transaction.atomic():
                 # 查找相关的产品变动记录
                 movements = ProductMovement.objects.filter(
-                    reference_number=self.outbound_number,
-                    movement_type='out'
+                    source_type='product_outbound',
+                    source_id=self.pk,
+                    reason='outbound'
                 )
                 
                 # 检查是否存在相关记录
@@ -833,6 +1376,9 @@ class ProductOutbound(models.Model):
                         quantity=movement.quantity,
                         unit=movement.unit,
                         reference_number=f'撤销-{self.outbound_number}',
+                        source_type='product_outbound',
+                        source_id=self.pk,
+                        reason='outbound_reversal',
                         notes=f'撤销出库：{self.outbound_number}'
                     )
                 
@@ -875,6 +1421,11 @@ class ProductOutboundItem(models.Model):
     )
     unit = models.CharField(max_length=20, verbose_name='单位')
     notes = models.TextField(blank=True, verbose_name='备注')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 保存原始产品，更换产品时原产品的预留库存也要重新汇总（延迟加载的字段不触发查询）
+        self._original_product_id = self.__dict__.get('product_id')
     
     def __str__(self):
         return f"{self.outbound.outbound_number} - {self.product.name}"
@@ -890,4 +1441,33 @@ class ProductOutboundItem(models.Model):
     class Meta:
         verbose_name = '出库单明细'
         verbose_name_plural = '出库单明细'
-        unique_together = ['outbound', 'product']
\ No newline at end of file
+        unique_together = ['outbound', 'product']
+
+class DocumentSequence(models.Model):
+    """单据编号序列：按（前缀, 日期）记录当天已发放的最大序号"""
+    objects = models.Manager()  # 显式声明管理器
+    prefix = models.CharField(max_length=20, blank=True, verbose_name='单号前缀')
+    date = models.DateField(verbose_name='日期')
+    last_value = models.PositiveIntegerField(default=0, verbose_name='已发放序号')
+
+    def __str__(self):
+        return f"{self.prefix}{self.date:%Y%m%d} - {self.last_value}"
+
+    class Meta:
+        unique_together = ['prefix', 'date']
+        verbose_name = '单据编号序列'
+        verbose_name_plural = '单据编号序列'
+
+class CacheVersion(models.Model):
+    """缓存版本号：依赖的数据变化时递增，各进程据此使本地缓存的计算结果失效"""
+    objects = models.Manager()  # 显式声明管理器
+    key = models.CharField(max_length=100, unique=True, verbose_name='缓存键')
+    version = models.PositiveBigIntegerField(default=0, verbose_name='版本号')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+
+    def __str__(self):
+        return f"{self.key} - {self.version}"
+
+    class Meta:
+        verbose_name = '缓存版本'
+        verbose_name_plural = '缓存版本'
@@ -0,0 +1,185 @@
+"""
+采购建议模块：按再订货点为材料生成草稿采购单
+
+可用量 = 库存 - 预留库存（未完成生产单的未领用需求）+ 在途数量（草稿和待入库采购单）。
+可用量不高于再订货点时，补足到目标库存，并按最近一次采购的供应商分组生成草稿采购单。
+"""
+import datetime
+from collections import defaultdict
+from decimal import Decimal, ROUND_UP
+from typing import Dict, Any
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from .models import Material, MaterialMovement, MaterialPurchase, PurchaseItem
+from .receiving import open_purchase_quantities
+from .sequences import MATERIAL_PURCHASE, reserve_document_numbers
+
+BULK_CREATE_BATCH_SIZE = 500
+DEFAULT_LOOKBACK_DAYS = 90
+DEFAULT_LEAD_TIME_DAYS = 14
+SUGGESTION_NOTES = '系统根据再订货点生成的采购建议'
+
+
+def consumption_by_material(start, end) -> Dict[int, Decimal]:
+    """统计期间内各材料的出库数量（不含撤销入库），一条分组查询"""
+    rows = MaterialMovement.objects.filter(
+        movement_type='out',
+        movement_date__gte=start,
+        movement_date__lt=end,
+    ).exclude(reason='purchase_reversal').values('material_id').annotate(
+        total=Sum('quantity')
+    ).values_list('material_id', 'total')
+    return dict(rows)
+
+
+def suggest_purchases(as_of=None, lookback_days=DEFAULT_LOOKBACK_DAYS,
+                      lead_time_days=DEFAULT_LEAD_TIME_DAYS) -> Dict[str, Any]:
+    """
+    计算采购建议，不写入数据
+
+    材料（附带最近一次采购明细）、出库汇总、在途数量、最近采购明细各一次查询，
+    查询数与材料数量无关。
+
+    Args:
+        as_of: 计算日期，默认为今天
+        lookback_days: 统计消耗速度的天数
+        lead_time_days: 采购提前期（天）
+
+    Returns:
+        Dict: suggestions 为按供应商分组的建议，unassigned 为没有采购记录、无法确定供应商的材料
+    """
+    as_of = as_of or timezone.localdate()
+    end = timezone.make_aware(datetime.datetime.combine(as_of + datetime.timedelta(days=1), datetime.time.min))
+    start = end - datetime.timedelta(days=lookback_days)
+
+    last_item = PurchaseItem.objects.filter(
+        material=OuterRef('pk')
+    ).exclude(purchase__status='cancelled').order_by('-purchase__purchase_date', '-pk').values('pk')[:1]
+    materials = list(
+        Material.objects.filter(is_active=True)
+        .annotate(last_item_id=Subquery(last_item))
+        .only('code', 'name', 'specification', 'unit', 'stock', 'reserved_stock',
+              'min_stock', 'warning_stock', 'max_stock')
+    )
+    consumption = consumption_by_material(start, end)
+    incoming = open_purchase_quantities(statuses=('draft', 'pending'))
+
+    lines = []
+    for material in materials:
+        daily_usage = consumption.get(material.pk, Decimal('0')) / lookback_days
+        lead_time_demand = daily_usage * lead_time_days
+        reorder_point = max(material.warning_stock, material.min_stock + lead_time_demand)
+        position = material.stock - material.reserved_stock + incoming.get(material.pk, Decimal('0'))
+        if position > reorder_point:
+            continue
+        target = max(material.max_stock, reorder_point + lead_time_demand)
+        quantity = (target - position).quantize(Decimal('0.01'), rounding=ROUND_UP)
+        if quantity <= 0:
+            continue
+        lines.append({
+            'material': material,
+            'daily_usage': daily_usage,
+            'reorder_point': reorder_point,
+            'position': position,
+            'quantity': quantity,
+        })
+
+    last_items = PurchaseItem.objects.select_related('purchase').in_bulk(
+        {line['material'].last_item_id for line in lines if line['material'].last_item_id})
+
+    by_supplier = defaultdict(list)
+    unassigned = []
+    for line in lines:
+        last = last_items.get(line['material'].last_item_id)
+        if last is None:
+            unassigned.append(line)
+            continue
+        line['last_item'] = last
+        by_supplier[last.purchase.supplier_id].append(line)
+
+    return {
+        'as_of': as_of,
+        'suggestions': dict(by_supplier),
+        'unassigned': unassigned,
+    }
+
+
+def _line_data(line) -> Dict[str, Any]:
+    material = line['material']
+    return {
+        'material': material.pk,
+        'material_code': material.code,
+        'material_name': material.name,
+        'daily_usage': float(line['daily_usage']),
+        'reorder_point': float(line['reorder_point']),
+        'position': float(line['position']),
+        'quantity': float(line['quantity']),
+    }
+
+
+def create_purchase_suggestions(as_of=None, lookback_days=DEFAULT_LOOKBACK_DAYS,
+                                lead_time_days=DEFAULT_LEAD_TIME_DAYS, dry_run=False) -> Dict[str, Any]:
+    """
+    按供应商生成草稿采购单
+
+    草稿采购单计入在途数量，重复运行不会为同一缺口重复生成建议。
+    采购单和明细各用一次 bulk_create 写入；dry_run=True 时只返回建议，不写入数据。
+    """
+    result = suggest_purchases(as_of, lookback_days, lead_time_days)
+    as_of = result['as_of']
+    suggestions = result['suggestions']
+
+    purchases = [
+        MaterialPurchase(
+            supplier_id=supplier_id,
+            purchase_date=as_of,
+            status='draft',
+            notes=SUGGESTION_NOTES,
+        )
+        for supplier_id in suggestions
+    ]
+    items = [
+        PurchaseItem(
+            purchase=purchase,
+            material=line['material'],
+            control_number=line['last_item'].control_number,
+            specification=line['last_item'].specification,
+            quantity=line['quantity'],
+            unit=line['material'].unit,
+            material_type=line['last_item'].material_type,
+        )
+        for purchase, lines in zip(purchases, suggestions.values())
+        for line in lines
+    ]
+
+    if not dry_run and purchases:
+        with transaction.atomic():
+            numbers = reserve_document_numbers(MATERIAL_PURCHASE, len(purchases), as_of)
+            for purchase, number in zip(purchases, numbers):
+                purchase.purchase_number = number
+            MaterialPurchase.objects.bulk_create(purchases, batch_size=BULK_CREATE_BATCH_SIZE)
+            PurchaseItem.objects.bulk_create(items, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    return {
+        'success': True,
+        'errors': [],
+        'dry_run': dry_run,
+        'purchases': [
+            {
+                'purchase': purchase.pk,
+                'purchase_number': purchase.purchase_number,
+                'supplier': purchase.supplier_id,
+                'items': [_line_data(line) for line in lines],
+            }
+            for purchase, lines in zip(purchases, suggestions.values())
+        ],
+        'unassigned': [_line_data(line) for line in result['unassigned']],
+        'summary': {
+            'purchase_count': len(purchases),
+            'item_count': len(items),
+            'unassigned_count': len(result['unassigned']),
+        }
+    }
@@ -0,0 +1,234 @@
+"""
+采购入库模块：批量入库、分批到货入库和在途数量汇总
+"""
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Any, List
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Sum
+from django.utils import timezone
+
+from .models import (
+    MaterialBatch,
+    MaterialMovement,
+    MaterialPurchase,
+    PurchaseItem,
+    post_material_stocks,
+    touch_material_batches,
+)
+
+BULK_CREATE_BATCH_SIZE = 500
+
+# 未入库数量（采购数量 - 已入库数量）
+OPEN_QUANTITY = F('quantity') - F('received_quantity')
+
+
+def _lock_pending_purchases(purchase_ids, errors):
+    """锁定并读取采购单，缺失或非待入库状态的采购单记入 errors"""
+    purchases = MaterialPurchase.objects.select_for_update().in_bulk(purchase_ids)
+    missing = [str(pk) for pk in purchase_ids if pk not in purchases]
+    if missing:
+        errors.append(f"采购单ID {', '.join(missing)} 不存在")
+    for purchase in purchases.values():
+        if purchase.status != 'pending':
+            errors.append(f'采购单 {purchase.purchase_number} 不是待入库状态，只能对待入库状态的采购单进行入库操作')
+    return purchases
+
+
+def _post_receipts(purchases, lines, location='') -> Dict[str, Any]:
+    """
+    为一次到货写入批次、入库记录并过账库存
+
+    lines 为 (采购明细, 本次入库数量) 列表，全部入库到 location 库位。批次和入库记录批量写入，
+    明细已入库数量批量更新，每种材料只过账一次库存；
+    全部明细入库完毕的采购单用一条UPDATE标记为已入库。
+    """
+    # 同一明细的后续到货批次号追加序号，与首次到货的批次区分
+    delivered = {
+        (row['purchase_id'], row['material_id']): row['count']
+        for row in MaterialBatch.objects.filter(purchase_id__in=purchases.keys())
+        .values('purchase_id', 'material_id').annotate(count=Count('pk'))
+    }
+
+    today = timezone.now().date()
+    new_batches = []
+    for item, quantity in lines:
+        batch_number = f'{purchases[item.purchase_id].purchase_number}-{item.pk}'
+        sequence = delivered.get((item.purchase_id, item.material_id), 0)
+        if sequence:
+            batch_number = f'{batch_number}-{sequence + 1}'
+        new_batches.append(MaterialBatch(
+            material_id=item.material_id,
+            batch_number=batch_number,
+            purchase_id=item.purchase_id,
+            production_date=today,
+            initial_quantity=quantity,
+            remaining_quantity=quantity,
+        ))
+    batches = MaterialBatch.objects.bulk_create(new_batches, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    material_incoming = defaultdict(Decimal)
+    movements = []
+    for (item, quantity), batch in zip(lines, batches):
+        purchase = purchases[item.purchase_id]
+        material_incoming[item.material_id] += quantity
+        movements.append(MaterialMovement(
+            material_id=item.material_id,
+            movement_type='in',
+            quantity=quantity,
+            unit=item.unit,
+            reference_number=purchase.purchase_number,
+            purchase=purchase,
+            batch=batch,
+            location=location,
+            source_type='purchase',
+            source_id=purchase.pk,
+            reason='purchase_receipt',
+            notes=f'采购入库：{purchase.purchase_number}',
+        ))
+        item.received_quantity += quantity
+
+    # 每种材料只过账一次库存，变动记录直接批量写入
+    balances = post_material_stocks({
+        (material_id, location): quantity for material_id, quantity in material_incoming.items()
+    })
+    MaterialMovement.objects.bulk_create(movements, batch_size=BULK_CREATE_BATCH_SIZE)
+    PurchaseItem.objects.bulk_update(
+        [item for item, _ in lines], ['received_quantity'], batch_size=BULK_CREATE_BATCH_SIZE)
+
+    open_items = PurchaseItem.objects.filter(
+        purchase=OuterRef('pk'), received_quantity__lt=F('quantity'))
+    completed = MaterialPurchase.objects.filter(pk__in=purchases.keys()).filter(
+        ~Exists(open_items)).update(status='received', updated_at=timezone.now())
+    touch_material_batches(material_incoming)
+
+    return {
+        'success': True,
+        'errors': [],
+        'summary': {
+            'purchase_count': len(purchases),
+            'completed_count': completed,
+            'item_count': len(lines),
+            'material_count': len(material_incoming),
+            'stock_after': {material_id: float(stock) for material_id, stock in balances.items()},
+        }
+    }
+
+
+def receive_purchases(purchase_ids: List[int], location: str = '') -> Dict[str, Any]:
+    """
+    批量入库多张采购单
+
+    每条明细入库其未入库数量（已分批到货的部分不重复入库），
+    采购单和明细各用一次查询读取，写入走 _post_receipts 的批量路径。
+    任何一张采购单校验失败则整批不入库（抛出 ValidationError）。
+
+    Args:
+        purchase_ids: 采购单ID列表
+        location: 入库库位，默认为默认库位
+
+    Returns:
+        Dict: 入库结果汇总
+    """
+    purchase_ids = list(dict.fromkeys(purchase_ids))
+    if not purchase_ids:
+        raise ValidationError('请选择需要入库的采购单')
+
+    with transaction.atomic():
+        errors = []
+        purchases = _lock_pending_purchases(purchase_ids, errors)
+
+        items = list(PurchaseItem.objects.filter(purchase_id__in=purchases.keys()).order_by('purchase_id', 'pk'))
+        purchases_with_items = {item.purchase_id for item in items}
+        lines = [(item, item.quantity - item.received_quantity) for item in items
+                 if item.received_quantity < item.quantity]
+        purchases_with_open_items = {item.purchase_id for item, _ in lines}
+        for pk, purchase in purchases.items():
+            if purchase.status != 'pending':
+                continue
+            if pk not in purchases_with_items:
+                errors.append(f'采购单 {purchase.purchase_number} 没有明细，无法入库')
+            elif pk not in purchases_with_open_items:
+                errors.append(f'采购单 {purchase.purchase_number} 已全部入库')
+
+        if errors:
+            raise ValidationError(errors)
+
+        return _post_receipts(purchases, lines, location)
+
+
+def receive_delivery(purchase_id: int, quantities: Dict[int, Any], location: str = '') -> Dict[str, Any]:
+    """
+    采购单分批到货入库
+
+    按本次到货数量增加明细的已入库数量，每次到货生成独立的批次和入库记录；
+    全部明细入库完毕后采购单变为已入库，否则保持待入库以便继续到货。
+
+    Args:
+        purchase_id: 采购单ID
+        quantities: {采购明细ID: 本次到货数量}
+        location: 入库库位，默认为默认库位
+
+    Returns:
+        Dict: 入库结果汇总
+    """
+    if not quantities:
+        raise ValidationError('请填写本次到货数量')
+
+    with transaction.atomic():
+        errors = []
+        purchases = _lock_pending_purchases([purchase_id], errors)
+        if errors:
+            raise ValidationError(errors)
+
+        items = PurchaseItem.objects.filter(purchase_id=purchase_id).select_related('material').in_bulk()
+        lines = []
+        for item_id, quantity in quantities.items():
+            item = items.get(item_id)
+            if item is None:
+                errors.append(f'采购明细ID {item_id} 不属于该采购单')
+                continue
+            try:
+                quantity = Decimal(str(quantity))
+            except InvalidOperation:
+                quantity = None
+            if quantity is None or not quantity.is_finite():
+                errors.append(f'材料 {item.material.name} 的到货数量格式不正确')
+                continue
+            open_quantity = item.quantity - item.received_quantity
+            if quantity <= 0:
+                errors.append(f'材料 {item.material.name} 的到货数量必须大于0')
+            elif quantity > open_quantity:
+                errors.append(
+                    f'材料 {item.material.name} 到货数量超过未入库数量，'
+                    f'未入库: {open_quantity}, 本次到货: {quantity}'
+                )
+            else:
+                lines.append((item, quantity))
+
+        if errors:
+            raise ValidationError(errors)
+
+        lines.sort(key=lambda line: line[0].pk)
+        return _post_receipts(purchases, lines, location)
+
+
+def open_purchase_quantities(material_ids=None, statuses=('pending',)) -> Dict[int, Decimal]:
+    """
+    待入库采购单按材料汇总的在途数量 {材料ID: 未入库数量}
+
+    一条分组查询；先按状态索引找到待入库采购单，再按（采购单, 材料）索引读取其明细，
+    不扫描已入库的历史明细。statuses 可加入 'draft' 把尚未下达的采购单也计入。
+    """
+    items = PurchaseItem.objects.filter(
+        purchase__status__in=statuses,
+        received_quantity__lt=F('quantity'),
+    )
+    if material_ids is not None:
+        items = items.filter(material_id__in=set(material_ids))
+    rows = items.values('material_id').annotate(
+        open_quantity=Sum(OPEN_QUANTITY, output_field=models.DecimalField(max_digits=12, decimal_places=2))
+    ).values_list('material_id', 'open_quantity')
+    return dict(rows)
@@ -0,0 +1,71 @@
+"""
+预留库存模块：汇总未完成的材料需求、草稿出库单和未发货订单占用的库存
+
+Material.reserved_stock / Product.reserved_stock 由信号在相关单据变化时重新汇总，
+读取可用库存时只需读取一行。
+"""
+from decimal import Decimal
+
+from django.db.models import DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from orders.models import OrderItem
+from production.models import MaterialRequirement
+
+from .models import Material, Product, ProductOutboundItem
+
+# 占用产品库存的订单状态：已发货和已取消的订单不再占用
+OPEN_ORDER_STATUSES = ['pending', 'processing', 'completed']
+
+_DECIMAL = DecimalField(max_digits=12, decimal_places=2)
+_ZERO = Value(Decimal('0'), output_field=_DECIMAL)
+
+
+def _sum_subquery(queryset, group_field, expression):
+    """按 group_field 分组求和的关联子查询，无记录时为 0"""
+    total = queryset.values(group_field).annotate(total=Sum(expression, output_field=_DECIMAL)).values('total')
+    return Coalesce(Subquery(total, output_field=_DECIMAL), _ZERO, output_field=_DECIMAL)
+
+
+def material_reserved_expression():
+    """材料预留量：未完成生产单的需求量减去已领用量"""
+    requirements = MaterialRequirement.objects.filter(
+        material=OuterRef('pk')
+    ).exclude(production_order__status='completed')
+    return _sum_subquery(
+        requirements, 'material',
+        Greatest(F('required_quantity') - F('actual_quantity'), _ZERO, output_field=_DECIMAL),
+    )
+
+
+def product_reserved_expression():
+    """产品预留量：未发货订单的数量加上未关联未发货订单的草稿出库单数量"""
+    order_items = OrderItem.objects.filter(
+        product=OuterRef('pk'),
+        order__status__in=OPEN_ORDER_STATUSES,
+    )
+    # 关联了未发货订单的出库单已由订单占用，不重复计算
+    outbound_items = ProductOutboundItem.objects.filter(
+        product=OuterRef('pk'),
+        outbound__status='draft',
+    ).exclude(Q(outbound__order__isnull=False) & Q(outbound__order__status__in=OPEN_ORDER_STATUSES))
+    return (
+        _sum_subquery(order_items, 'product', F('quantity'))
+        + _sum_subquery(outbound_items, 'product', F('quantity'))
+    )
+
+
+def refresh_material_reserved(material_ids=None):
+    """重新汇总材料预留库存，material_ids 为空时汇总全部材料；每次调用只执行一条UPDATE"""
+    materials = Material.objects.all()
+    if material_ids is not None:
+        materials = materials.filter(pk__in=set(material_ids))
+    return materials.update(reserved_stock=material_reserved_expression())
+
+
+def refresh_product_reserved(product_ids=None):
+    """重新汇总产品预留库存，product_ids 为空时汇总全部产品；每次调用只执行一条UPDATE"""
+    products = Product.objects.all()
+    if product_ids is not None:
+        products = products.filter(pk__in=set(product_ids))
+    return products.update(reserved_stock=product_reserved_expression())
@@ -0,0 +1,326 @@
+"""
+材料需求情景模拟模块：一次计算大量需求情景（订单放大、调整交货日期）下的材料缺口
+
+产品-材料用量系数（物料清单展开结果）和各交货日期前的可用量只读取一次并装入 NumPy 数组，
+各需求日期的需求矩阵与系数矩阵做矩阵乘法后按日期累计，缺口也整体按数组计算，不逐行做 Decimal 运算。
+"""
+import math
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Any, List
+
+import numpy as np
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from orders.models import OrderItem
+from production.models import MaterialRequirement
+
+from .bom import flatten_boms
+from .models import Material, Product, PurchaseItem
+from .receiving import OPEN_QUANTITY
+
+# 情景数上限，避免一次请求构造过大的矩阵
+MAX_SCENARIOS = 1000
+
+_DECIMAL = models.DecimalField(max_digits=12, decimal_places=2)
+
+OVERFLOW_MESSAGE = '放大后的需求数量超出范围'
+
+
+def _parse_scenarios(scenarios, as_of):
+    """
+    校验情景参数，返回 (情景列表, 涉及的订单ID, 涉及的产品ID)
+
+    每个情景为 {'name', 'orders': [订单ID], 'scale': 放大倍数, 'items': [{'product_id', 'quantity'}],
+    'date': 交货日期}，orders 与 items 为列表且至少填写一项，重复的订单只计一次，scale 默认 1。
+    填写 date 时情景内全部需求按该日期交货；未填写时订单按各自的交货日期、追加产品按计划日期交货。
+    """
+    if not scenarios:
+        raise ValidationError('请至少提供一个情景')
+    if not isinstance(scenarios, list):
+        raise ValidationError('情景格式不正确，应为列表')
+    if len(scenarios) > MAX_SCENARIOS:
+        raise ValidationError(f'一次最多模拟 {MAX_SCENARIOS} 个情景')
+
+    errors = []
+    parsed = []
+    order_ids = set()
+    product_ids = set()
+    for i, scenario in enumerate(scenarios):
+        if not isinstance(scenario, dict):
+            errors.append(f'情景{i+1}：格式不正确')
+            continue
+        name = scenario.get('name') or f'情景{i+1}'
+        if not isinstance(scenario.get('orders', []), list) or not isinstance(scenario.get('items', []), list):
+            errors.append(f'{name}：订单和产品明细应为列表')
+            continue
+        try:
+            scale = float(scenario.get('scale', 1))
+            orders = list(dict.fromkeys(int(order_id) for order_id in scenario.get('orders', [])))
+            items = [
+                (int(item['product_id']), float(item['quantity']))
+                for item in scenario.get('items', [])
+            ]
+        except (KeyError, TypeError, ValueError):
+            errors.append(f'{name}：订单、产品或数量格式不正确')
+            continue
+        if not math.isfinite(scale) or not all(math.isfinite(quantity) for _, quantity in items):
+            errors.append(f'{name}：订单、产品或数量格式不正确')
+            continue
+        if scale < 0 or any(quantity < 0 for _, quantity in items):
+            errors.append(f'{name}：放大倍数和数量不能为负数')
+            continue
+        if not all(math.isfinite(quantity * scale) for _, quantity in items):
+            errors.append(f'{name}：{OVERFLOW_MESSAGE}')
+            continue
+        if not orders and not items:
+            errors.append(f'{name}：请填写订单或产品明细')
+            continue
+
+        date = None
+        if scenario.get('date'):
+            try:
+                date = parse_date(str(scenario['date']))
+            except ValueError:
+                date = None
+            if date is None:
+                errors.append(f"{name}：日期格式不正确：{scenario['date']}")
+                continue
+            date = max(date, as_of)
+
+        order_ids.update(orders)
+        product_ids.update(product_id for product_id, _ in items)
+        parsed.append({'name': name, 'orders': orders, 'scale': scale, 'items': items, 'date': date})
+
+    if errors:
+        raise ValidationError(errors)
+    return parsed, order_ids, product_ids
+
+
+def _order_demand(order_ids):
+    """各订单的交货日期和按产品汇总的数量 ({订单ID: 交货日期}, {订单ID: {产品ID: 数量}})，一条分组查询"""
+    rows = OrderItem.objects.filter(order_id__in=order_ids).values(
+        'order_id', 'order__delivery_date', 'product_id',
+    ).annotate(total=Sum('quantity')).values_list('order_id', 'order__delivery_date', 'product_id', 'total')
+    delivery_dates = {}
+    demand = defaultdict(dict)
+    for order_id, delivery_date, product_id, total in rows:
+        delivery_dates[order_id] = delivery_date
+        demand[order_id][product_id] = float(total)
+    return delivery_dates, demand
+
+
+def _order_reservations(order_ids):
+    """
+    各订单的生产单已占用的材料 {订单ID: {材料ID: 数量}}，一条分组查询
+
+    口径与材料预留库存一致（未完成生产单的需求量减去已领用量）。情景按订单数量重新计算需求，
+    这部分预留已从可用库存中扣除，需加回给包含该订单的情景，避免重复计算。
+    """
+    rows = MaterialRequirement.objects.filter(
+        production_order__sales_order_id__in=order_ids,
+    ).exclude(production_order__status='completed').values(
+        'production_order__sales_order_id', 'material_id',
+    ).annotate(
+        reserved=Sum(Greatest(F('required_quantity') - F('actual_quantity'), Value(Decimal('0')),
+                              output_field=_DECIMAL), output_field=_DECIMAL),
+    ).values_list('production_order__sales_order_id', 'material_id', 'reserved')
+    reservations = defaultdict(dict)
+    for order_id, material_id, reserved in rows:
+        reservations[order_id][material_id] = float(reserved)
+    return reservations
+
+
+def _receipt_schedule(material_ids, as_of):
+    """待入库采购单按（交货日期, 材料）汇总的未入库数量；未填或已过交货日期的按计划日期到货"""
+    rows = PurchaseItem.objects.filter(
+        purchase__status='pending',
+        received_quantity__lt=models.F('quantity'),
+        material_id__in=material_ids,
+    ).values('material_id', 'purchase__delivery_date').annotate(
+        total=Sum(OPEN_QUANTITY, output_field=models.DecimalField(max_digits=12, decimal_places=2))
+    ).values_list('material_id', 'purchase__delivery_date', 'total')
+
+    schedule = defaultdict(lambda: defaultdict(Decimal))
+    for material_id, delivery_date, total in rows:
+        schedule[max(delivery_date or as_of, as_of)][material_id] += total
+    return schedule
+
+
+def simulate_requirements(scenarios: List[Dict[str, Any]], as_of=None) -> Dict[str, Any]:
+    """
+    按情景批量计算材料需求与缺口
+
+    各需求日期的需求 = 情景需求矩阵（情景 × 产品）@ 用量系数矩阵（产品 × 材料），按日期先后累计；
+    可用量 = 库存 - 预留库存 + 情景所含订单自身的预留 + 该日期前到货的待入库采购。
+    每个日期的缺口 = max(累计需求 - 可用量, 0)，情景的缺口取各日期中最大的一个。
+    产品、订单明细、订单预留、材料和采购到货各一次查询（物料清单展开结果命中缓存时只读取一次版本号），
+    查询数与情景数无关。没有物料清单的产品不参与计算，列入 products_without_bom。
+
+    Args:
+        scenarios: 情景列表，格式见 _parse_scenarios
+        as_of: 计划日期，默认今天
+
+    Returns:
+        Dict: 每个情景的缺口、每种材料的缺口汇总
+    """
+    as_of = as_of or timezone.localdate()
+    scenarios, order_ids, product_ids = _parse_scenarios(scenarios, as_of)
+
+    existing_products = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+    missing_products = sorted(product_ids - existing_products)
+    if missing_products:
+        raise ValidationError(f"产品ID {', '.join(map(str, missing_products))} 不存在")
+    delivery_dates, order_demand = _order_demand(order_ids)
+    missing_orders = sorted(order_ids - order_demand.keys())
+    if missing_orders:
+        raise ValidationError(f"订单ID {', '.join(map(str, missing_orders))} 不存在或没有明细")
+    for demand in order_demand.values():
+        product_ids.update(demand)
+
+    # 用量系数矩阵：产品 × 材料
+    boms = flatten_boms(product_ids)
+    products = sorted(product_ids)
+    product_index = {product_id: i for i, product_id in enumerate(products)}
+    material_ids = sorted({material_id for bom in boms.values() for material_id in bom})
+    material_index = {material_id: j for j, material_id in enumerate(material_ids)}
+    coefficients = np.zeros((len(products), len(material_ids)))
+    for product_id, bom in boms.items():
+        for material_id, per_unit in bom.items():
+            coefficients[product_index[product_id], material_index[material_id]] = float(per_unit)
+
+    # 各订单的材料需求（订单 × 材料）和已占用的材料预留（订单 × 材料）
+    orders = sorted(order_demand)
+    order_index = {order_id: i for i, order_id in enumerate(orders)}
+    order_matrix = np.zeros((len(orders), len(products)))
+    for order_id, demand in order_demand.items():
+        for product_id, quantity in demand.items():
+            order_matrix[order_index[order_id], product_index[product_id]] = quantity
+    order_materials = order_matrix @ coefficients
+    reservation_matrix = np.zeros((len(orders), len(material_ids)))
+    for order_id, reserved in (_order_reservations(order_ids) if orders else {}).items():
+        for material_id, quantity in reserved.items():
+            if material_id in material_index:
+                reservation_matrix[order_index[order_id], material_index[material_id]] = quantity
+
+    # 按需求日期归集：(情景, 订单, 权重) 和追加产品的情景
+    members = np.zeros((len(scenarios), len(orders)))
+    order_demands = defaultdict(list)
+    extra_demands = defaultdict(list)
+    extra_demand = np.zeros((len(scenarios), len(products)))
+    scenario_dates = []
+    for s, scenario in enumerate(scenarios):
+        dates = set()
+        for order_id in scenario['orders']:
+            members[s, order_index[order_id]] = 1
+            date = scenario['date'] or max(delivery_dates[order_id], as_of)
+            order_demands[date].append((s, order_index[order_id], scenario['scale']))
+            dates.add(date)
+        if scenario['items']:
+            for product_id, quantity in scenario['items']:
+                extra_demand[s, product_index[product_id]] += quantity * scenario['scale']
+            date = scenario['date'] or as_of
+            extra_demands[date].append(s)
+            dates.add(date)
+        scenario_dates.append(max(dates))
+    extra_materials = extra_demand @ coefficients
+
+    # 可用量：库存 - 预留库存，加回情景所含订单自身的预留，再加上各日期之前的累计到货
+    materials = Material.objects.only('code', 'name', 'unit', 'stock', 'reserved_stock').in_bulk(material_ids)
+    on_hand = np.array([float(materials[material_id].available_stock) for material_id in material_ids])
+    base_available = on_hand + members @ reservation_matrix
+    schedule = _receipt_schedule(material_ids, as_of)
+    receipt_dates = sorted(schedule)
+    receipts = np.zeros((len(receipt_dates), len(material_ids)))
+    for d, date in enumerate(receipt_dates):
+        for material_id, quantity in schedule[date].items():
+            receipts[d, material_index[material_id]] = float(quantity)
+    cumulative_receipts = np.vstack([np.zeros((1, len(material_ids))), np.cumsum(receipts, axis=0)])
+    demand_dates = sorted(order_demands.keys() | extra_demands.keys())
+    received_by = np.searchsorted(
+        np.array(receipt_dates, dtype='datetime64[D]'), np.array(demand_dates, dtype='datetime64[D]'), side='right')
+
+    # 按日期先后累计需求，记录每个（情景, 材料）缺口最大的日期及当时的累计需求和可用量
+    shape = (len(scenarios), len(material_ids))
+    required = np.zeros(shape)
+    shortages = np.zeros(shape)
+    short_required = np.zeros(shape)
+    short_available = np.zeros(shape)
+    short_dates = np.zeros(shape, dtype=int)
+    # 溢出在循环后按情景统一检查，计算过程中不逐次告警
+    with np.errstate(over='ignore', invalid='ignore'):
+        for d, date in enumerate(demand_dates):
+            if order_demands[date]:
+                rows, order_rows, weights = (np.array(column) for column in zip(*order_demands[date]))
+                np.add.at(required, rows, weights[:, None] * order_materials[order_rows])
+            for s in extra_demands[date]:
+                required[s] += extra_materials[s]
+            available = base_available + cumulative_receipts[received_by[d]]
+            # 按用量系数的精度舍入，避免浮点误差产生极小的虚假缺口
+            deficit = np.round(required - available, 4)
+            worse = deficit > shortages
+            shortages = np.where(worse, deficit, shortages)
+            short_required = np.where(worse, required, short_required)
+            short_available = np.where(worse, available, short_available)
+            short_dates = np.where(worse, d, short_dates)
+
+    # 放大倍数与订单数量、用量系数相乘后可能溢出为无穷大，结果无法输出
+    overflow = ~np.isfinite(required).all(axis=1)
+    if overflow.any():
+        raise ValidationError([
+            f"{scenarios[s]['name']}：{OVERFLOW_MESSAGE}" for s in np.flatnonzero(overflow)])
+
+    scenario_results = []
+    for s, scenario in enumerate(scenarios):
+        short = np.flatnonzero(shortages[s] > 0)
+        scenario_results.append({
+            'name': scenario['name'],
+            'date': str(scenario_dates[s]),
+            'can_fulfil': not len(short),
+            'total_shortage': round(float(shortages[s].sum()), 4),
+            'shortages': [
+                {
+                    'material_id': material_ids[j],
+                    'material_code': materials[material_ids[j]].code,
+                    'date': str(demand_dates[short_dates[s, j]]),
+                    'required_quantity': round(float(short_required[s, j]), 4),
+                    'available_quantity': round(float(short_available[s, j]), 4),
+                    'shortage': round(float(shortages[s, j]), 4),
+                }
+                for j in short
+            ],
+        })
+
+    short_counts = (shortages > 0).sum(axis=0)
+    max_shortages = shortages.max(axis=0)
+    material_results = [
+        {
+            'material_id': material_id,
+            'material_code': materials[material_id].code,
+            'material_name': materials[material_id].name,
+            'unit': materials[material_id].unit,
+            'available_stock': round(float(on_hand[j]), 4),
+            'shortage_scenario_count': int(short_counts[j]),
+            'max_shortage': round(float(max_shortages[j]), 4),
+        }
+        for j, material_id in enumerate(material_ids)
+    ]
+
+    return {
+        'success': True,
+        'errors': [],
+        'scenarios': scenario_results,
+        'materials': material_results,
+        'products_without_bom': [product_id for product_id in products if not boms[product_id]],
+        'summary': {
+            'scenario_count': len(scenarios),
+            'product_count': len(products),
+            'material_count': len(material_ids),
+            'shortage_scenario_count': sum(1 for result in scenario_results if not result['can_fulfil']),
+        }
+    }
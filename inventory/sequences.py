@@ -0,0 +1,59 @@
+"""
+单据编号模块：按（前缀, 日期）发放连续不重复的单据编号
+
+单号格式为 前缀 + 日期(YYYYMMDD) + 序号，序号超过位数时自动加长，不再受每天 999 张的限制。
+序号用一条原子UPDATE递增，与单据在同一事务中发放；事务回滚时序号一并回滚，编号不会出现空缺。
+"""
+from typing import List
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DocumentSequence
+
+# 各类单据的前缀与序号位数
+SALES_ORDER = ('SO', 3)
+PRODUCTION_ORDER = ('PO', 2)
+PRODUCT_OUTBOUND = ('', 3)
+MATERIAL_PURCHASE = ('CG', 3)
+
+
+def format_document_number(prefix, date, value, width) -> str:
+    return f"{prefix}{date.strftime('%Y%m%d')}{value:0{width}d}"
+
+
+def reserve_document_numbers(document, count, date=None) -> List[str]:
+    """
+    一次预留 count 个连续的单据编号，用于批量创建单据
+
+    需要在创建单据的事务中调用，序号行在事务结束前保持锁定，并发请求依次取号。
+
+    Args:
+        document: 单据类型，如 SALES_ORDER
+        count: 预留数量
+        date: 单号日期，默认为今天
+    """
+    prefix, width = document
+    date = date or timezone.localdate()
+    if count <= 0:
+        return []
+
+    with transaction.atomic():
+        sequence = DocumentSequence.objects.filter(prefix=prefix, date=date)
+        if not sequence.update(last_value=F('last_value') + count):
+            # 当天第一次取号时补建序列行，并发补建由唯一约束去重
+            DocumentSequence.objects.bulk_create(
+                [DocumentSequence(prefix=prefix, date=date)], ignore_conflicts=True)
+            sequence.update(last_value=F('last_value') + count)
+        last_value = sequence.values_list('last_value', flat=True).get()
+
+    return [
+        format_document_number(prefix, date, value, width)
+        for value in range(last_value - count + 1, last_value + 1)
+    ]
+
+
+def next_document_number(document, date=None) -> str:
+    """发放下一个单据编号，需要在创建单据的事务中调用"""
+    return reserve_document_numbers(document, 1, date)[0]
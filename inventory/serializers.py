@@ -1,3 +1,4 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 from .models import (
     Material,
@@ -9,17 +10,24 @@ from .models import (
     Inventory,
     InventoryItem,
     Product,
+    ProductMaterial,
     ProductMovement,
     ProductOutbound,
-    ProductOutboundItem
+    ProductOutboundItem,
+    InventoryStatistics,
+    MaterialLocationStock
 )
 
 class MaterialSerializer(serializers.ModelSerializer):
     stock_status = serializers.SerializerMethodField()
+    available = serializers.DecimalField(
+        source='available_stock', max_digits=12, decimal_places=2, read_only=True)
     
     class Meta:
         model = Material
         fields = '__all__'
+        # 总库存由库位库存汇总维护、预留库存由需求汇总维护，只能通过变动记录和需求修改
+        read_only_fields = ['stock', 'reserved_stock']
     
     def get_stock_status(self, obj):
         if obj.stock <= obj.min_stock:
@@ -52,8 +60,9 @@ class PurchaseItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = PurchaseItem
         fields = ['id', 'material', 'material_name', 'material_specification',
-                 'control_number', 'specification', 'quantity', 'unit', 
+                 'control_number', 'specification', 'quantity', 'received_quantity', 'unit', 
                  'material_type', 'notes']
+        read_only_fields = ['received_quantity']
 
 class MaterialPurchaseSerializer(serializers.ModelSerializer):
     items = PurchaseItemSerializer(many=True, required=False)
@@ -73,6 +82,12 @@ class MaterialPurchaseSerializer(serializers.ModelSerializer):
             
         return purchase
         
+    def validate_items(self, value):
+        # 修改时明细整体重建；已有到货的明细关联着批次和入库记录，重建会丢失已入库数量
+        if value and self.instance and self.instance.items.filter(received_quantity__gt=0).exists():
+            raise serializers.ValidationError('采购单已有到货，不能修改明细')
+        return value
+
     def update(self, instance, validated_data):
         items_data = validated_data.pop('items', [])
         # 更新采购单主表字段
@@ -120,8 +135,26 @@ class InventorySerializer(serializers.ModelSerializer):
         model = Inventory
         fields = '__all__'
 
+class InventoryStatisticsSerializer(serializers.ModelSerializer):
+    material_name = serializers.CharField(source='material.name', read_only=True)
+    material_code = serializers.CharField(source='material.code', read_only=True)
+    
+    class Meta:
+        model = InventoryStatistics
+        fields = '__all__'
+
+class MaterialLocationStockSerializer(serializers.ModelSerializer):
+    material_name = serializers.CharField(source='material.name', read_only=True)
+    material_code = serializers.CharField(source='material.code', read_only=True)
+
+    class Meta:
+        model = MaterialLocationStock
+        fields = '__all__'
+
 class ProductSerializer(serializers.ModelSerializer):
     stock_status = serializers.SerializerMethodField()
+    available = serializers.DecimalField(
+        source='available_stock', max_digits=12, decimal_places=2, read_only=True)
     customer_names = serializers.SerializerMethodField()
     customers_display = serializers.SerializerMethodField()
     material_requirement = serializers.SerializerMethodField()
@@ -161,6 +194,33 @@ class ProductSerializer(serializers.ModelSerializer):
             'unit_weight_display': f'{obj.unit_weight} kg/件'
         }
 
+class ProductMaterialSerializer(serializers.ModelSerializer):
+    product_name = serializers.CharField(source='product.name', read_only=True)
+    material_name = serializers.CharField(source='material.name', read_only=True, allow_null=True)
+    component_name = serializers.CharField(source='component.name', read_only=True, allow_null=True)
+    
+    class Meta:
+        model = ProductMaterial
+        fields = ['id', 'product', 'product_name', 'material', 'material_name',
+                 'component', 'component_name', 'quantity', 'scrap_rate', 'notes']
+    
+    def validate(self, attrs):
+        """沿用模型的校验（二选一、用量、损耗率和循环引用）"""
+        instance = ProductMaterial(**{**self._current_values(), **attrs})
+        try:
+            instance.clean()
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        return attrs
+    
+    def _current_values(self):
+        if self.instance is None:
+            return {}
+        return {
+            field: getattr(self.instance, field)
+            for field in ('pk', 'product', 'material', 'component', 'quantity', 'scrap_rate')
+        }
+
 class ProductOutboundItemSerializer(serializers.ModelSerializer):
     product_name = serializers.ReadOnlyField(source='product.name')
     product_code = serializers.ReadOnlyField(source='product.code')
@@ -1,8 +1,15 @@
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.db import transaction
 from django.core.exceptions import ValidationError
-from .models import ProductOutbound, ProductOutboundItem, ProductMovement
+from orders.models import Order, OrderItem
+from production.models import ProductionOrder, MaterialRequirement
+from .bom import touch_bom
+from .material_requirements import touch_order_requirements, touch_products
+from .models import (
+    MaterialBatch, Product, ProductMaterial, ProductOutbound, ProductOutboundItem, ProductMovement, touch_material_batches,
+)
+from .reservations import refresh_material_reserved, refresh_product_reserved
 
 @receiver(post_save, sender=ProductOutboundItem)
 def handle_outbound_item_save(sender, instance, created, **kwargs):
@@ -29,6 +36,9 @@ def handle_outbound_item_save(sender, instance, created, **kwargs):
                     quantity=instance.quantity,
                     unit=instance.product.unit,
                     reference_number=instance.outbound.outbound_number,
+                    source_type='product_outbound',
+                    source_id=instance.outbound_id,
+                    reason='outbound',
                     notes=f'产品出库：{instance.outbound.outbound_number}'
                 )
         except Exception as e:
@@ -52,8 +62,79 @@ def handle_outbound_item_delete(sender, instance, **kwargs):
                     quantity=instance.quantity,
                     unit=instance.product.unit,
                     reference_number=f'撤销-{instance.outbound.outbound_number}',
+                    source_type='product_outbound',
+                    source_id=instance.outbound_id,
+                    reason='outbound_reversal',
                     notes=f'撤销出库明细：{instance.outbound.outbound_number}'
                 )
         except Exception as e:
             # 记录错误但不阻止删除
-            print(f"出库单明细删除时出错: {str(e)}") 
\ No newline at end of file
+            print(f"出库单明细删除时出错: {str(e)}")
+
+
+@receiver(post_save, sender=MaterialRequirement)
+@receiver(post_delete, sender=MaterialRequirement)
+def refresh_requirement_reservation(sender, instance, **kwargs):
+    """材料需求变化时重新汇总材料预留库存，更换材料时原材料一并汇总"""
+    refresh_material_reserved({instance.material_id, instance._original_material_id} - {None})
+    instance._original_material_id = instance.material_id
+
+
+@receiver(post_save, sender=ProductionOrder)
+def refresh_production_order_reservation(sender, instance, created, **kwargs):
+    """生产单状态变化（如完成）时重新汇总其需求材料的预留库存"""
+    if not created:
+        refresh_material_reserved(
+            instance.material_requirements.values_list('material_id', flat=True))
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+@receiver(post_save, sender=ProductOutboundItem)
+@receiver(post_delete, sender=ProductOutboundItem)
+def refresh_item_reservation(sender, instance, **kwargs):
+    """订单明细或出库单明细变化时重新汇总产品预留库存，更换产品时原产品一并汇总"""
+    refresh_product_reserved({instance.product_id, instance._original_product_id} - {None})
+    instance._original_product_id = instance.product_id
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=ProductOutbound)
+def refresh_document_reservation(sender, instance, created, **kwargs):
+    """订单或出库单状态变化时重新汇总其明细产品的预留库存"""
+    if not created:
+        refresh_product_reserved(instance.items.values_list('product_id', flat=True))
+
+
+@receiver(post_save, sender=MaterialBatch)
+@receiver(post_delete, sender=MaterialBatch)
+def touch_batch_cache(sender, instance, **kwargs):
+    """批次新增、修改或删除时使该材料的批次缓存失效"""
+    touch_material_batches([instance.material_id])
+
+
+@receiver(post_save, sender=ProductMaterial)
+@receiver(post_delete, sender=ProductMaterial)
+def touch_bom_cache(sender, instance, **kwargs):
+    """物料清单明细新增、修改或删除时使展开结果缓存失效"""
+    touch_bom()
+
+
+@receiver(post_save, sender=Order)
+def touch_order_requirement_cache(sender, instance, **kwargs):
+    """订单保存时使其材料需求计算结果失效"""
+    touch_order_requirements([instance.pk])
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def touch_order_item_requirement_cache(sender, instance, **kwargs):
+    """订单明细新增、修改或删除时使所属订单的材料需求计算结果失效"""
+    touch_order_requirements([instance.order_id])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def touch_product_requirement_cache(sender, instance, **kwargs):
+    """产品（如单重）变化时使包含该产品的订单的材料需求计算结果失效"""
+    touch_products([instance.pk])
@@ -0,0 +1,238 @@
+"""
+库存台账模块：按检查点查询历史库存、按日汇总库存统计、库存与台账对账
+"""
+import datetime
+from decimal import Decimal
+from typing import Dict, Any
+
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import (
+    InventoryStatistics,
+    Material,
+    MaterialMovement,
+    MaterialStockCheckpoint,
+    Product,
+    ProductMovement,
+    ProductStockCheckpoint,
+)
+
+CHECKPOINT_BATCH_SIZE = 500
+STATISTICS_BATCH_SIZE = 500
+
+# 日末时间取次日零点，可查询的最晚日期为最大日期的前一天
+LATEST_LEDGER_DATE = datetime.date.max - datetime.timedelta(days=1)
+
+
+def net_quantity(prefix=''):
+    """
+    变动记录的净数量聚合表达式：入库为正、出库为负，调整不计入库存
+
+    prefix 用于从库存对象反向关联到变动记录，例如 'materialmovement__'。
+    """
+    output_field = DecimalField(max_digits=12, decimal_places=2)
+    return Coalesce(
+        Sum(Case(
+            When(**{f'{prefix}movement_type': 'in'}, then=F(f'{prefix}quantity')),
+            When(**{f'{prefix}movement_type': 'out'}, then=-F(f'{prefix}quantity')),
+            default=Value(Decimal('0')),
+            output_field=output_field,
+        )),
+        Value(Decimal('0')),
+        output_field=output_field,
+    )
+
+
+def end_of_day(date):
+    """某日日末（次日零点）的时间，变动时间早于该时间的记录都计入当日"""
+    return timezone.make_aware(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time.min))
+
+
+class StockLedger:
+    """库存台账：库存对象、变动记录与检查点的对应关系"""
+
+    def __init__(self, item_model, movement_model, item_field, checkpoint_model):
+        self.item_model = item_model
+        self.movement_model = movement_model
+        self.item_field = item_field
+        self.checkpoint_model = checkpoint_model
+
+    def _net_between(self, item, start=None, end=None):
+        """统计 [start, end) 区间内的净变动量和扫描的记录数"""
+        movements = self.movement_model.objects.filter(**{self.item_field: item})
+        if start is not None:
+            movements = movements.filter(movement_date__gte=start)
+        if end is not None:
+            movements = movements.filter(movement_date__lt=end)
+        result = movements.aggregate(net=net_quantity(), count=Count('id'))
+        return result['net'], result['count']
+
+    def stock_at(self, item, date) -> Dict[str, Any]:
+        """
+        查询某日日末的库存
+
+        从最近的检查点（或当前库存）出发，只扫描两者之间的变动记录。
+        """
+        checkpoints = self.checkpoint_model.objects.filter(**{self.item_field: item})
+        before = checkpoints.filter(date__lte=date).order_by('-date').first()
+        after = checkpoints.filter(date__gt=date).order_by('date').first()
+        today = timezone.localdate()
+
+        # 选择离查询日期最近的锚点
+        anchors = [('current', today, (today - date).days)]
+        if before is not None:
+            anchors.append(('checkpoint', before, (date - before.date).days))
+        if after is not None:
+            anchors.append(('checkpoint', after, (after.date - date).days))
+        anchor_type, anchor, _ = min(anchors, key=lambda candidate: candidate[2])
+
+        boundary = end_of_day(date)
+        if anchor_type == 'current':
+            net, scanned = self._net_between(item, start=boundary)
+            stock = item.stock - net
+            anchor_date = today
+        elif anchor.date <= date:
+            net, scanned = self._net_between(item, start=end_of_day(anchor.date), end=boundary)
+            stock = anchor.stock + net
+            anchor_date = anchor.date
+        else:
+            net, scanned = self._net_between(item, start=boundary, end=end_of_day(anchor.date))
+            stock = anchor.stock - net
+            anchor_date = anchor.date
+
+        return {
+            'date': date.isoformat(),
+            'stock': float(stock),
+            'anchor': anchor_type,
+            'anchor_date': anchor_date.isoformat(),
+            'movements_scanned': scanned,
+        }
+
+    def build_checkpoints(self, date) -> int:
+        """
+        生成某日日末的库存检查点
+
+        以当前库存减去该日之后的净变动量得到日末库存，只需一次分组聚合；
+        已存在的检查点会被覆盖。
+        """
+        boundary = end_of_day(date)
+        with transaction.atomic():
+            net_after = dict(
+                self.movement_model.objects.filter(movement_date__gte=boundary)
+                .values(self.item_field)
+                .annotate(net=net_quantity())
+                .values_list(self.item_field, 'net')
+            )
+            checkpoints = [
+                self.checkpoint_model(
+                    **{f'{self.item_field}_id': pk},
+                    date=date,
+                    stock=stock - net_after.get(pk, Decimal('0')),
+                )
+                for pk, stock in self.item_model.objects.values_list('pk', 'stock').iterator()
+            ]
+            self.checkpoint_model.objects.bulk_create(
+                checkpoints,
+                batch_size=CHECKPOINT_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=[self.item_field, 'date'],
+                update_fields=['stock'],
+            )
+        return len(checkpoints)
+
+    def find_drift(self, chunk_size=2000):
+        """
+        逐个检查库存是否等于变动记录的净数量，返回存在偏差的库存对象
+
+        每个库存对象的台账净数量在同一条分组查询中计算，并分块流式读取。
+        """
+        related_prefix = f'{self.movement_model._meta.model_name}__'
+        items = self.item_model.objects.annotate(
+            ledger_stock=net_quantity(related_prefix)
+        ).values('pk', 'code', 'name', 'stock', 'ledger_stock').order_by('pk')
+
+        for item in items.iterator(chunk_size=chunk_size):
+            if item['stock'] != item['ledger_stock']:
+                yield {
+                    'id': item['pk'],
+                    'code': item['code'],
+                    'name': item['name'],
+                    'stock': item['stock'],
+                    'ledger_stock': item['ledger_stock'],
+                    'difference': item['stock'] - item['ledger_stock'],
+                }
+
+
+MATERIAL_LEDGER = StockLedger(Material, MaterialMovement, 'material', MaterialStockCheckpoint)
+PRODUCT_LEDGER = StockLedger(Product, ProductMovement, 'product', ProductStockCheckpoint)
+
+
+def build_daily_statistics(start_date, end_date) -> int:
+    """
+    生成 [start_date, end_date] 每天每种材料的库存统计
+
+    区间内的出入库量用一次按（材料, 日期）分组的聚合得到；期初库存取前一天的统计结果，
+    没有统计结果的材料以当前库存倒推。已存在的统计行会被覆盖。
+    """
+    start = end_of_day(start_date - datetime.timedelta(days=1))
+    end = end_of_day(end_date)
+    output_field = DecimalField(max_digits=12, decimal_places=2)
+    zero = Decimal('0')
+
+    with transaction.atomic():
+        opening = dict(
+            InventoryStatistics.objects.filter(date=start_date - datetime.timedelta(days=1))
+            .values_list('material_id', 'closing_stock')
+        )
+        stocks = dict(Material.objects.values_list('pk', 'stock'))
+        if len(opening) < len(stocks):
+            net_after = dict(
+                MaterialMovement.objects.filter(movement_date__gte=start)
+                .values('material')
+                .annotate(net=net_quantity())
+                .values_list('material', 'net')
+            )
+            for pk, stock in stocks.items():
+                opening.setdefault(pk, stock - net_after.get(pk, zero))
+
+        flows = {
+            (row['material'], row['day']): (row['incoming'], row['outgoing'])
+            for row in MaterialMovement.objects.filter(movement_date__gte=start, movement_date__lt=end)
+            .annotate(day=TruncDate('movement_date'))
+            .values('material', 'day')
+            .annotate(
+                incoming=Coalesce(Sum('quantity', filter=Q(movement_type='in')), zero, output_field=output_field),
+                outgoing=Coalesce(Sum('quantity', filter=Q(movement_type='out')), zero, output_field=output_field),
+            )
+        }
+
+        count = 0
+        day = start_date
+        while day <= end_date:
+            rows = []
+            for pk in stocks:
+                incoming, outgoing = flows.get((pk, day), (zero, zero))
+                closing = opening[pk] + incoming - outgoing
+                rows.append(InventoryStatistics(
+                    date=day,
+                    material_id=pk,
+                    opening_stock=opening[pk],
+                    incoming=incoming,
+                    outgoing=outgoing,
+                    closing_stock=closing,
+                ))
+                opening[pk] = closing
+            InventoryStatistics.objects.bulk_create(
+                rows,
+                batch_size=STATISTICS_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=['date', 'material'],
+                update_fields=['opening_stock', 'incoming', 'outgoing', 'closing_stock'],
+            )
+            count += len(rows)
+            day += datetime.timedelta(days=1)
+
+    return count
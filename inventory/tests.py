@@ -1,3 +1,1503 @@
-from django.test import TestCase
+import datetime
+import importlib
+import threading
+import unittest
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, Q, Sum
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from orders.models import Customer, Order, OrderItem
+from production.models import MaterialRequirement, ProductionOrder
+
+from .models import (
+    DocumentSequence,
+    Inventory,
+    InventoryItem,
+    InventoryStatistics,
+    Material,
+    MaterialBatch,
+    MaterialLocationStock,
+    MaterialMovement,
+    MaterialPurchase,
+    Product,
+    ProductMaterial,
+    ProductMovement,
+    ProductOutbound,
+    ProductOutboundItem,
+    PurchaseItem,
+    Supplier,
+    post_material_stocks,
+)
+from .bom import flatten_boms
+from .bulk_movements import post_material_movements
+from .stock_ledger import MATERIAL_LEDGER, build_daily_statistics
+from .material_requirements import MaterialRequirementCalculator
+from .purchase_suggestions import create_purchase_suggestions
+from .receiving import open_purchase_quantities, receive_delivery, receive_purchases
+from .scenarios import simulate_requirements
+from .sequences import PRODUCTION_ORDER, SALES_ORDER, next_document_number, reserve_document_numbers
+
+
+def _run_threads(target, count):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def explain_query_plan(queryset):
+    """返回 SQLite EXPLAIN QUERY PLAN 的明细行"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+class QueryPlanAssertions:
+    def assertUsesIndex(self, queryset, index_name):
+        """热点查询必须走指定索引，不能退化为全表扫描"""
+        table = queryset.model._meta.db_table
+        plan = explain_query_plan(queryset)
+        full_scans = [line for line in plan if line == f'SCAN {table}']
+        self.assertFalse(full_scans, f'{table} 全表扫描：{plan}')
+        self.assertTrue(
+            any(f'INDEX {index_name}' in line for line in plan),
+            f'未使用索引 {index_name}：{plan}')
+
+
+def _retry_locked(func):
+    """SQLite 并发写入会返回 locked，重试直到拿到写锁"""
+    while True:
+        try:
+            return func()
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+
+
+class StockPostingTests(TestCase):
+    def setUp(self):
+        self.material = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        self.product = Product.objects.create(code='P001', name='冰刀', unit='双')
+
+    def test_material_movement_updates_stock(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('10'), unit='kg')
+            movement = MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('4'), unit='kg')
+
+        self.assertEqual(movement.material.stock, Decimal('6'))
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('6'))
+
+    def test_material_out_of_stock_rejected(self):
+        with self.assertRaisesMessage(ValidationError, '库存不足'):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('1'), unit='kg')
+
+        self.assertFalse(MaterialMovement.objects.exists())
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('0'))
+
+    def test_stock_update_does_not_overwrite_other_columns(self):
+        stale = Material.objects.get(pk=self.material.pk)
+        Material.objects.filter(pk=self.material.pk).update(name='新名称')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=stale, movement_type='in', quantity=Decimal('5'), unit='kg')
+
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.name, '新名称')
+        self.assertEqual(self.material.stock, Decimal('5'))
+
+    def test_locations_post_independently(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('8'), unit='kg',
+                location='A1')
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('2'), unit='kg',
+                location='B1')
+
+        # B1 库位库存不足，即使材料总库存足够也不能出库
+        with self.assertRaisesMessage(ValidationError, '库存不足'):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('5'), unit='kg',
+                location='B1')
+
+        self.assertEqual(
+            dict(MaterialLocationStock.objects.values_list('location', 'stock')),
+            {'A1': Decimal('8'), 'B1': Decimal('2')})
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('10'))
+
+    def test_material_save_keeps_cached_total(self):
+        stale = Material.objects.get(pk=self.material.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('5'), unit='kg')
+
+        stale.name = '新名称'
+        stale.save()
+
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.name, '新名称')
+        self.assertEqual(self.material.stock, Decimal('5'))
+
+    def test_posted_movement_is_immutable(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            movement = MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('5'), unit='kg')
+
+        movement.notes = '补充说明'
+        movement.save()
+        movement.quantity = Decimal('50')
+        with self.assertRaisesMessage(ValidationError, '已过账的变动记录不能修改'):
+            movement.save()
+
+        movement.refresh_from_db()
+        self.assertEqual((movement.quantity, movement.notes), (Decimal('5'), '补充说明'))
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('operator'))
+        response = client.patch(
+            f'/api/inventory/movements/{movement.pk}/', {'quantity': '50'}, format='json')
+        self.assertEqual(response.status_code, 405)
+
+    def test_opening_stock_posted_as_movement(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            material = Material.objects.create(
+                code='M002', name='刀托', unit='个', stock=Decimal('12'))
+
+        self.assertEqual(material.stock, Decimal('12'))
+        material.refresh_from_db()
+        self.assertEqual(material.stock, Decimal('12'))
+        movement = MaterialMovement.objects.get(material=material)
+        self.assertEqual(
+            (movement.movement_type, movement.quantity, movement.reason),
+            ('in', Decimal('12'), 'adjustment'))
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+    def test_api_cannot_write_stock(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('operator'))
+        response = client.patch(
+            f'/api/inventory/materials/{self.material.pk}/',
+            {'stock': '50', 'reserved_stock': '5', 'name': '新名称'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stock'], '0.00')
+        self.assertEqual(response.data['reserved_stock'], '0.00')
+        self.material.refresh_from_db()
+        self.assertEqual((self.material.name, self.material.stock), ('新名称', Decimal('0')))
+
+    def test_post_more_keys_than_one_statement(self):
+        # 超过单条SQL表达式深度限制的库位数，分块过账且任一库位不足时整体回滚
+        keys = [(self.material.pk, f'L{i:04d}') for i in range(1200)]
+        with self.captureOnCommitCallbacks(execute=True):
+            balances = post_material_stocks({key: Decimal('2') for key in keys})
+        self.assertEqual(balances, {self.material.pk: Decimal('2400')})
+
+        deltas = {key: Decimal('-1') for key in keys}
+        deltas[keys[-1]] = Decimal('-3')
+        with self.assertRaisesMessage(ValidationError, '库存不足，当前库存: 2.00, 需要: 3'):
+            post_material_stocks(deltas)
+
+        self.assertEqual(
+            set(MaterialLocationStock.objects.values_list('stock', flat=True)), {Decimal('2')})
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('2400'))
+
+    def test_product_update_stock_returns_balance(self):
+        self.assertEqual(self.product.update_stock(Decimal('3'), 'in'), Decimal('3'))
+        with self.assertRaisesMessage(ValidationError, '库存不足'):
+            self.product.update_stock(Decimal('5'), 'out')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, Decimal('3'))
+
+
+class PurchaseReceiptTests(TestCase):
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+
+    def _pending_purchase(self, number, line_count):
+        purchase = MaterialPurchase.objects.create(
+            purchase_number=number, supplier=self.supplier,
+            purchase_date=timezone.now().date(), status='pending')
+        for i in range(line_count):
+            material = Material.objects.create(code=f'{number}-M{i}', name=f'材料{i}', unit='kg')
+            PurchaseItem.objects.create(
+                purchase=purchase, material=material, control_number=f'C{i}',
+                specification='1mm', quantity=Decimal('10'), unit='kg')
+        return purchase
+
+    def _received_purchase(self, number, line_count):
+        purchase = self._pending_purchase(number, line_count)
+        with self.captureOnCommitCallbacks(execute=True):
+            purchase.receive_materials()
+        return purchase
+
+    def _cancel(self, purchase):
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                purchase.cancel_inbound()
+        return len(queries)
+
+    def test_cancel_inbound_restores_stock(self):
+        purchase = self._received_purchase('PO001', 3)
+
+        self._cancel(purchase)
+
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.status, 'pending')
+        self.assertFalse(purchase.material_batches.exists())
+        self.assertEqual(
+            set(purchase.items.values_list('received_quantity', flat=True)), {Decimal('0')})
+        self.assertEqual(
+            set(Material.objects.values_list('stock', flat=True)), {Decimal('0')})
+        self.assertEqual(
+            MaterialMovement.objects.filter(reason='purchase_reversal').count(), 3)
+
+    def test_cancel_inbound_keeps_ledger_balanced(self):
+        purchase = self._received_purchase('PO001', 2)
+        self._cancel(purchase)
+
+        # 入库记录保留，与冲销记录相抵
+        self.assertEqual(MaterialMovement.objects.filter(reason='purchase_receipt').count(), 2)
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+        # 重新入库后再次撤销，只冲销新的入库记录
+        with self.captureOnCommitCallbacks(execute=True):
+            purchase.receive_materials()
+        self._cancel(purchase)
+
+        self.assertEqual(MaterialMovement.objects.filter(reason='purchase_reversal').count(), 4)
+        self.assertEqual(set(Material.objects.values_list('stock', flat=True)), {Decimal('0')})
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+    def test_delete_purchase_reverses_receipts(self):
+        purchase = self._pending_purchase('PO001', 2)
+        first = purchase.items.order_by('pk').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            receive_delivery(purchase.pk, {first.pk: Decimal('4')})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            purchase.delete()
+
+        first.material.refresh_from_db()
+        self.assertEqual(first.material.stock, Decimal('0'))
+        self.assertEqual(
+            list(MaterialMovement.objects.order_by('pk').values_list('reason', 'quantity', 'purchase')),
+            [('purchase_receipt', Decimal('4'), None), ('purchase_reversal', Decimal('4'), None)])
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+    def test_receive_into_location(self):
+        purchase = self._pending_purchase('PO001', 1)
+        item = purchase.items.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            receive_delivery(purchase.pk, {item.pk: Decimal('4')}, location='WH2')
+            purchase.receive_materials(location='WH3')
+
+        self.assertEqual(
+            dict(MaterialLocationStock.objects.values_list('location', 'stock')),
+            {'WH2': Decimal('4'), 'WH3': Decimal('6')})
+
+        # 撤销按入库库位冲销，库位库存不足时拒绝
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=item.material, movement_type='out', quantity=Decimal('1'), unit='kg', location='WH3')
+        purchase.refresh_from_db()
+        with self.assertRaisesMessage(ValidationError, '库位 WH3 当前库存不足，无法撤销'):
+            purchase.cancel_inbound()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=item.material, movement_type='in', quantity=Decimal('1'), unit='kg', location='WH3')
+        purchase.cancel_inbound()
+
+        self.assertEqual(
+            set(MaterialLocationStock.objects.values_list('stock', flat=True)), {Decimal('0')})
+        self.assertEqual(
+            set(MaterialMovement.objects.filter(reason='purchase_reversal').values_list('location', flat=True)),
+            {'WH2', 'WH3'})
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+    def test_cancel_inbound_query_count_is_fixed(self):
+        small = self._received_purchase('PO001', 2)
+        large = self._received_purchase('PO002', 20)
+
+        self.assertEqual(self._cancel(large), self._cancel(small))
+
+    def test_cancel_inbound_rejects_insufficient_stock(self):
+        purchase = self._received_purchase('PO001', 2)
+        item = purchase.items.order_by('pk').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=item.material, movement_type='out', quantity=Decimal('4'), unit='kg')
+
+        with self.assertRaisesMessage(ValidationError, '当前库存不足，无法撤销'):
+            purchase.cancel_inbound()
+
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.status, 'received')
+        self.assertFalse(MaterialMovement.objects.filter(reason='purchase_reversal').exists())
+
+    def test_split_deliveries(self):
+        purchase = self._pending_purchase('PO001', 2)
+        first, second = purchase.items.order_by('pk')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            receive_delivery(purchase.pk, {first.pk: Decimal('4')})
+            receive_delivery(purchase.pk, {first.pk: Decimal('6'), second.pk: Decimal('3')})
+
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.status, 'pending')
+        self.assertEqual(
+            list(purchase.items.order_by('pk').values_list('received_quantity', flat=True)),
+            [Decimal('10'), Decimal('3')])
+        self.assertEqual(
+            list(purchase.material_batches.filter(material=first.material)
+                 .order_by('pk').values_list('batch_number', 'initial_quantity')),
+            [(f'PO001-{first.pk}', Decimal('4')), (f'PO001-{first.pk}-2', Decimal('6'))])
+        self.assertEqual(open_purchase_quantities(), {second.material_id: Decimal('7')})
+
+        # 整单入库只入库剩余数量
+        with self.captureOnCommitCallbacks(execute=True):
+            purchase.receive_materials()
+
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.status, 'received')
+        second.material.refresh_from_db()
+        self.assertEqual(second.material.stock, Decimal('10'))
+        self.assertEqual(open_purchase_quantities(), {})
+
+    def test_delivery_cannot_exceed_open_quantity(self):
+        purchase = self._pending_purchase('PO001', 1)
+        item = purchase.items.get()
+        receive_delivery(purchase.pk, {item.pk: Decimal('8')})
+
+        with self.assertRaisesMessage(ValidationError, '到货数量超过未入库数量'):
+            receive_delivery(purchase.pk, {item.pk: Decimal('3')})
+
+        item.refresh_from_db()
+        self.assertEqual(item.received_quantity, Decimal('8'))
+
+    def test_delivery_rejects_non_finite_quantity(self):
+        purchase = self._pending_purchase('PO001', 1)
+        item = purchase.items.get()
+
+        for quantity in ('NaN', 'Infinity', 'abc'):
+            with self.assertRaisesMessage(ValidationError, '材料 材料0 的到货数量格式不正确'):
+                receive_delivery(purchase.pk, {item.pk: quantity})
+        self.assertFalse(purchase.material_batches.exists())
+
+    def test_items_locked_after_delivery(self):
+        purchase = self._pending_purchase('PO001', 1)
+        item = purchase.items.get()
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('operator'))
+        url = f'/api/inventory/purchases/{purchase.pk}/'
+        items = [{'material': item.material_id, 'control_number': 'C9', 'specification': '2mm',
+                  'quantity': '12', 'unit': 'kg'}]
+
+        # 尚未到货时可以修改明细
+        self.assertEqual(client.patch(url, {'items': items}, format='json').status_code, 200)
+        item = purchase.items.get()
+        receive_delivery(purchase.pk, {item.pk: Decimal('5')})
+
+        response = client.patch(url, {'items': items, 'notes': '改数量'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'items': ['采购单已有到货，不能修改明细']})
+        self.assertEqual(
+            list(purchase.items.values_list('pk', 'quantity', 'received_quantity')),
+            [(item.pk, Decimal('12'), Decimal('5'))])
+
+    def test_receive_purchases_in_one_batch(self):
+        first = self._pending_purchase('PO001', 2)
+        second = self._pending_purchase('PO002', 1)
+        item = first.items.order_by('pk').first()
+        receive_delivery(first.pk, {item.pk: Decimal('4')})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = receive_purchases([first.pk, second.pk, first.pk])
+
+        self.assertTrue(result['success'])
+        self.assertEqual(
+            set(MaterialPurchase.objects.values_list('status', flat=True)), {'received'})
+        # 已分批到货的部分不重复入库
+        self.assertEqual(
+            set(Material.objects.values_list('stock', flat=True)), {Decimal('10')})
+        self.assertEqual(open_purchase_quantities(), {})
+
+    def test_receive_purchases_rejects_whole_batch(self):
+        pending = self._pending_purchase('PO001', 1)
+        received = self._received_purchase('PO002', 1)
+
+        with self.assertRaises(ValidationError) as raised:
+            receive_purchases([pending.pk, received.pk, 999])
+
+        self.assertEqual(raised.exception.messages, [
+            '采购单ID 999 不存在',
+            '采购单 PO002 不是待入库状态，只能对待入库状态的采购单进行入库操作',
+        ])
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, 'pending')
+        self.assertFalse(pending.material_batches.exists())
+
+    def test_bulk_receive_api(self):
+        purchase = self._pending_purchase('PO001', 1)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('operator'))
+        url = '/api/inventory/purchases/bulk_receive/'
+
+        response = client.post(url, {'purchases': ['abc']}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': '采购单ID格式不正确'})
+        self.assertEqual(client.post(url, {'purchases': [999]}, format='json').data,
+                         {'success': False, 'errors': ['采购单ID 999 不存在']})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(url, {'purchases': [purchase.pk], 'location': 'WH2'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(MaterialLocationStock.objects.values_list('location', 'stock')), [('WH2', Decimal('10'))])
+
+
+class PurchaseSuggestionTests(TestCase):
+    def setUp(self):
+        self.steel = Supplier.objects.create(name='钢材供应商', code='S001')
+        self.leather = Supplier.objects.create(name='皮革供应商', code='S002')
+        self.blade = self._material('M001', supplier=self.steel, max_stock=Decimal('50'))
+        self.rivet = self._material(
+            'M002', supplier=self.steel, warning_stock=Decimal('20'), max_stock=Decimal('100'))
+        self.leather_sheet = self._material(
+            'M003', supplier=self.leather, warning_stock=Decimal('10'), max_stock=Decimal('30'))
+        self.lace = self._material('M004', warning_stock=Decimal('5'))
+
+        # 近90天消耗 90，日均 1；提前期 14 天，再订货点 14
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.blade, movement_type='in', quantity=Decimal('95'), unit='kg')
+            MaterialMovement.objects.create(
+                material=self.blade, movement_type='out', quantity=Decimal('90'), unit='kg')
+
+        # 在途的待入库采购单已覆盖皮革的缺口
+        pending = MaterialPurchase.objects.create(
+            purchase_number='PO-OPEN', supplier=self.leather,
+            purchase_date=timezone.now().date(), status='pending')
+        PurchaseItem.objects.create(
+            purchase=pending, material=self.leather_sheet, control_number='C3',
+            specification='2mm', quantity=Decimal('30'), unit='kg')
+
+    def _material(self, code, supplier=None, **fields):
+        material = Material.objects.create(code=code, name=f'材料{code}', unit='kg', **fields)
+        if supplier:
+            purchase = MaterialPurchase.objects.create(
+                purchase_number=f'PO-{code}', supplier=supplier,
+                purchase_date=timezone.now().date(), status='received')
+            PurchaseItem.objects.create(
+                purchase=purchase, material=material, control_number=f'C-{code}',
+                specification='1mm', quantity=Decimal('1'), received_quantity=Decimal('1'), unit='kg')
+        return material
+
+    def test_drafts_grouped_by_supplier(self):
+        result = create_purchase_suggestions()
+
+        self.assertEqual(result['summary'], {'purchase_count': 1, 'item_count': 2, 'unassigned_count': 1})
+        purchase = MaterialPurchase.objects.get(status='draft')
+        self.assertEqual(purchase.supplier, self.steel)
+        self.assertEqual(
+            dict(purchase.items.values_list('material__code', 'quantity')),
+            {'M001': Decimal('45'), 'M002': Decimal('100')})
+        self.assertEqual(purchase.items.get(material=self.blade).control_number, 'C-M001')
+        self.assertEqual(result['unassigned'][0]['material_code'], 'M004')
+
+        # 草稿采购单计入在途数量，重复运行不再生成
+        self.assertEqual(create_purchase_suggestions()['summary']['purchase_count'], 0)
+
+    def test_dry_run_query_count_is_fixed(self):
+        with self.assertNumQueries(4):
+            result = create_purchase_suggestions(dry_run=True)
+
+        self.assertEqual(result['summary']['item_count'], 2)
+        self.assertFalse(MaterialPurchase.objects.filter(status='draft').exists())
+
+    def test_day_parameters_validated(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('operator'))
+        url = '/api/inventory/purchases/suggestions/'
+
+        self.assertEqual(client.get(url, {'lead_time_days': '-1'}).data, {'error': '采购提前期不能为负数'})
+        self.assertEqual(client.get(url, {'lookback_days': '0'}).data, {'error': '统计天数必须大于0'})
+        self.assertEqual(client.get(url, {'lead_time_days': '0'}).status_code, 200)
+
+        with self.assertRaisesMessage(CommandError, '采购提前期不能为负数'):
+            call_command('suggest_purchases', '--lead-time-days=-1', stdout=StringIO())
+        with self.assertRaisesMessage(CommandError, '日期格式不正确：2025-02-30'):
+            call_command('suggest_purchases', date='2025-02-30', stdout=StringIO())
+        self.assertFalse(MaterialPurchase.objects.filter(status='draft').exists())
+
+
+class OutboundConfirmTests(TestCase):
+    def _outbound(self, number, line_count, stock=Decimal('10'), quantity=Decimal('4')):
+        outbound = ProductOutbound.objects.create(outbound_number=number)
+        for i in range(line_count):
+            product = Product.objects.create(code=f'{number}-P{i}', name=f'产品{i}', unit='双', stock=stock)
+            ProductOutboundItem.objects.create(outbound=outbound, product=product, quantity=quantity, unit='双')
+        return outbound
+
+    def _confirm(self, outbound):
+        with CaptureQueriesContext(connection) as queries:
+            outbound.confirm_outbound()
+        return len(queries)
+
+    def test_confirm_posts_all_lines(self):
+        outbound = self._outbound('CK001', 3)
+
+        self._confirm(outbound)
+
+        outbound.refresh_from_db()
+        self.assertEqual(outbound.status, 'confirmed')
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {Decimal('6')})
+        self.assertEqual(
+            ProductMovement.objects.filter(source_id=outbound.pk, reason='outbound').count(), 3)
+
+    def test_confirm_reports_every_short_line(self):
+        outbound = self._outbound('CK001', 2, stock=Decimal('1'))
+
+        with self.assertRaises(ValidationError) as raised:
+            outbound.confirm_outbound()
+
+        self.assertEqual(len(raised.exception.messages), 2)
+        self.assertFalse(ProductMovement.objects.exists())
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {Decimal('1')})
+
+    def test_confirm_query_count_is_fixed(self):
+        small = self._outbound('CK001', 2)
+        large = self._outbound('CK002', 20)
+
+        self.assertEqual(self._confirm(large), self._confirm(small))
+
+    def test_cancel_reverses_only_linked_movements(self):
+        outbound = self._outbound('CK001', 1)
+        self._confirm(outbound)
+        product = Product.objects.get()
+        # 单号和备注相同但不是本出库单过账的记录不会被冲销
+        ProductMovement.objects.create(
+            product=product, movement_type='out', quantity=Decimal('1'), unit='双',
+            reference_number='CK001', notes='产品出库：CK001')
+
+        outbound.cancel_outbound()
+
+        product.refresh_from_db()
+        self.assertEqual(product.stock, Decimal('9'))
+        self.assertEqual(
+            list(ProductMovement.objects.filter(reason='outbound_reversal').values_list(
+                'source_type', 'source_id', 'quantity')),
+            [('product_outbound', outbound.pk, Decimal('4'))])
+
+
+class MovementSourceBackfillTests(TestCase):
+    """0010 迁移按外键、备注前缀和单号回填变动记录的来源"""
+
+    def test_backfill(self):
+        migration = importlib.import_module('inventory.migrations.0010_backfill_movement_source')
+        material = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        product = Product.objects.create(code='P001', name='冰刀', unit='双', stock=Decimal('10'))
+        supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+        purchase = MaterialPurchase.objects.create(
+            purchase_number='PO001', supplier=supplier, purchase_date=timezone.now().date())
+        outbound = ProductOutbound.objects.create(outbound_number='CK001')
+
+        receipt = MaterialMovement.objects.create(
+            material=material, movement_type='in', quantity=Decimal('5'), unit='kg',
+            purchase=purchase, notes='采购入库：PO001')
+        manual = MaterialMovement.objects.create(
+            material=material, movement_type='in', quantity=Decimal('1'), unit='kg', notes='手工入库')
+        shipped = ProductMovement.objects.create(
+            product=product, movement_type='out', quantity=Decimal('2'), unit='双',
+            reference_number='CK001', notes='产品出库：CK001')
+        reversed_ = ProductMovement.objects.create(
+            product=product, movement_type='in', quantity=Decimal('2'), unit='双',
+            reference_number='撤销-CK001', notes='撤销出库：CK001')
+
+        migration.backfill_material_movements(apps, None)
+        migration.backfill_product_movements(apps, None)
+
+        def source(movement):
+            movement.refresh_from_db()
+            return movement.source_type, movement.source_id, movement.reason
+
+        self.assertEqual(source(receipt), ('purchase', purchase.pk, 'purchase_receipt'))
+        self.assertEqual(source(manual), ('', None, ''))
+        self.assertEqual(source(shipped), ('product_outbound', outbound.pk, 'outbound'))
+        self.assertEqual(source(reversed_), ('product_outbound', outbound.pk, 'outbound_reversal'))
+
+
+class BulkMovementTests(TestCase):
+    def setUp(self):
+        self.material = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+        purchase = MaterialPurchase.objects.create(
+            purchase_number='PO001', supplier=supplier, purchase_date=timezone.now().date())
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('20'), unit='kg')
+        self.batch = MaterialBatch.objects.create(
+            material=self.material, batch_number='B001', purchase=purchase,
+            initial_quantity=Decimal('5'), remaining_quantity=Decimal('5'))
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('operator'))
+
+    def _line(self, quantity, **extra):
+        return {'material': self.material.pk, 'movement_type': 'out', 'quantity': quantity, 'unit': 'kg', **extra}
+
+    def test_bulk_posts_all_lines(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/inventory/movements/bulk/',
+                {'lines': [self._line('3', batch=self.batch.pk), self._line('2')]}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.material.refresh_from_db()
+        self.batch.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('15'))
+        self.assertEqual(self.batch.remaining_quantity, Decimal('2'))
+
+    def test_malformed_payload_rejected(self):
+        for payload in ([self._line('1')], {'lines': 'abc'}, {}):
+            response = self.client.post('/api/inventory/movements/bulk/', payload, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['error'], '请提供变动明细列表 lines')
+
+        result = post_material_movements([self._line('1'), 'abc'])
+        self.assertFalse(result['success'])
+        self.assertEqual(result['errors'], ['第2行：明细格式不正确'])
+
+        result = post_material_movements([self._line('NaN')])
+        self.assertEqual(result['errors'], ['第1行：数量格式不正确'])
+
+    def test_line_fields_validated(self):
+        result = post_material_movements([
+            self._line('1', location=None),
+            self._line('1', location=['WH2'], movement_type=['out']),
+            self._line('1e30', reference_number=None),
+            self._line('0.005', notes=None),
+            self._line('1', location='W' * 51),
+            self._line('1', location=''),
+        ])
+
+        self.assertFalse(result['success'])
+        self.assertEqual(result['errors'], [
+            '第1行：库位格式不正确',
+            "第2行：变动类型 ['out'] 无效；库位格式不正确",
+            '第3行：数量超出范围；关联单号格式不正确',
+            '第4行：数量最多保留2位小数；备注格式不正确',
+            '第5行：库位不能超过50个字符',
+        ])
+        self.assertTrue(result['results'][5]['success'])
+        self.assertFalse(MaterialMovement.objects.filter(movement_type='out').exists())
+
+    def test_ledger_stays_balanced(self):
+        # 多个库位的净变动量一次过账，每条变动记录的数量与过账数量一致
+        with self.captureOnCommitCallbacks(execute=True):
+            result = post_material_movements([self._line('0.01')] * 3 + [
+                self._line('2.5', movement_type='in', location='WH2'),
+                self._line('0.5', location='WH2'),
+            ])
+
+        self.assertTrue(result['success'])
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('21.97'))
+        self.assertEqual(
+            dict(MaterialLocationStock.objects.values_list('location', 'stock')),
+            {'': Decimal('19.97'), 'WH2': Decimal('2')})
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+        result = post_material_movements([self._line('3', location='WH2')])
+        self.assertEqual(result['errors'], ['材料 冰刀钢 库位 WH2 库存不足，当前库存: 2.00, 需要: 3.00'])
+
+    def test_batch_cannot_go_negative(self):
+        # 材料库存足够，但批次剩余数量不足，整批不过账
+        result = post_material_movements([
+            self._line('4', batch=self.batch.pk), self._line('2', batch=self.batch.pk)])
+
+        self.assertFalse(result['success'])
+        self.assertIn('批次 B001 剩余数量不足', result['errors'][0])
+        self.batch.refresh_from_db()
+        self.material.refresh_from_db()
+        self.assertEqual(self.batch.remaining_quantity, Decimal('5'))
+        self.assertEqual(self.material.stock, Decimal('20'))
+        self.assertEqual(MaterialMovement.objects.filter(movement_type='out').count(), 0)
+
+        with self.assertRaisesMessage(ValidationError, '批次 B001 剩余数量不足'):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('6'), unit='kg',
+                batch=self.batch)
+        self.batch.refresh_from_db()
+        self.material.refresh_from_db()
+        self.assertEqual(self.batch.remaining_quantity, Decimal('5'))
+        self.assertEqual(self.material.stock, Decimal('20'))
+
+
+class BatchReconcileTests(TestCase):
+    def setUp(self):
+        self.material = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+        self.purchase = MaterialPurchase.objects.create(
+            purchase_number='PO001', supplier=supplier, purchase_date=timezone.now().date())
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('20'), unit='kg')
+        self.batch = self._batch('B001', Decimal('10'))
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('4'), unit='kg',
+                batch=self.batch)
+
+    def _batch(self, number, quantity):
+        return MaterialBatch.objects.create(
+            material=self.material, batch_number=number, purchase=self.purchase,
+            initial_quantity=quantity, remaining_quantity=quantity)
+
+    def _reconcile(self, *args):
+        out = StringIO()
+        call_command('reconcile_batches', *args, stdout=out)
+        return out.getvalue()
+
+    def test_no_drift(self):
+        self._batch('B002', Decimal('3'))
+        self.assertIn('共检查 2 个批次，未发现偏差', self._reconcile())
+
+    def test_drift_reported_and_fixed(self):
+        MaterialBatch.objects.filter(pk=self.batch.pk).update(remaining_quantity=Decimal('9'))
+
+        output = self._reconcile()
+        self.assertIn('批次 B001：记录剩余 9.00，实际剩余 6.00，偏差 3.00', output)
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.remaining_quantity, Decimal('9'))
+
+        self.assertIn('已修正 1 个批次', self._reconcile('--fix'))
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.remaining_quantity, Decimal('6'))
+        self.assertIn('未发现偏差', self._reconcile())
+
+    def test_status_drift_fixed(self):
+        # 剩余为0但仍为正常、仍有剩余却标记为已耗尽，剩余数量都没有偏差
+        empty = self._batch('B002', Decimal('2'))
+        with self.captureOnCommitCallbacks(execute=True):
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('2'), unit='kg', batch=empty)
+        MaterialBatch.objects.filter(pk=empty.pk).update(remaining_quantity=Decimal('0'), status='normal')
+        MaterialBatch.objects.filter(pk=self.batch.pk).update(remaining_quantity=Decimal('6'), status='depleted')
+
+        output = self._reconcile('--fix')
+        self.assertIn('批次 B001：剩余 6.00，状态应为 normal，记录为 depleted', output)
+        self.assertIn('批次 B002：剩余 0.00，状态应为 depleted，记录为 normal', output)
+        self.assertEqual(
+            dict(MaterialBatch.objects.values_list('batch_number', 'status')),
+            {'B001': 'normal', 'B002': 'depleted'})
+        self.assertIn('未发现偏差', self._reconcile())
+
+    def test_batch_depleted_when_used_up(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = post_material_movements([{
+                'material': self.material.pk, 'movement_type': 'out', 'quantity': '6', 'unit': 'kg',
+                'batch': self.batch.pk}])
+
+        self.assertTrue(result['success'])
+        self.batch.refresh_from_db()
+        self.assertEqual((self.batch.remaining_quantity, self.batch.status), (Decimal('0'), 'depleted'))
+
+    def test_expire_batches(self):
+        today = timezone.localdate()
+        MaterialBatch.objects.filter(pk=self.batch.pk).update(expiry_date=today - datetime.timedelta(days=1))
+        self._batch('B002', Decimal('3'))
+        MaterialBatch.objects.filter(batch_number='B002').update(expiry_date=today)
+
+        out = StringIO()
+        call_command('expire_batches', stdout=out)
+
+        self.assertIn('已将 1 个批次标记为已过期', out.getvalue())
+        self.assertEqual(
+            dict(MaterialBatch.objects.values_list('batch_number', 'status')),
+            {'B001': 'expired', 'B002': 'normal'})
+        with self.assertRaisesMessage(CommandError, '日期格式不正确：2025-02-30'):
+            call_command('expire_batches', date='2025-02-30', stdout=StringIO())
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.material = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        self.product = Product.objects.create(code='P001', name='冰刀', unit='双')
+        with self.captureOnCommitCallbacks(execute=True):
+            self._backdate(MaterialMovement.objects.create(
+                material=self.material, movement_type='in', quantity=Decimal('10'), unit='kg'), 2)
+            MaterialMovement.objects.create(
+                material=self.material, movement_type='out', quantity=Decimal('4'), unit='kg')
+        self._backdate(ProductMovement.objects.create(
+            product=self.product, movement_type='in', quantity=Decimal('3'), unit='双',
+            reference_number='T1'), 1)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('operator'))
+
+    def _backdate(self, movement, days):
+        type(movement).objects.filter(pk=movement.pk).update(
+            movement_date=timezone.now() - datetime.timedelta(days=days))
+
+    def _day(self, days_ago):
+        return str(self.today - datetime.timedelta(days=days_ago))
+
+    def test_stock_at(self):
+        expected = [(3, 0), (2, 10), (0, 6)]
+        for days_ago, stock in expected:
+            response = self.client.get(
+                f'/api/inventory/materials/{self.material.pk}/stock_at/', {'date': self._day(days_ago)})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['stock'], stock)
+
+        response = self.client.get(
+            f'/api/inventory/products/{self.product.pk}/stock_at/', {'date': self._day(2)})
+        self.assertEqual(response.data['stock'], 0)
+
+    def test_stock_at_rejects_invalid_dates(self):
+        for url in (f'/api/inventory/materials/{self.material.pk}/stock_at/',
+                    f'/api/inventory/products/{self.product.pk}/stock_at/'):
+            for date in ('', 'abc', '2025-02-30', '9999-12-31'):
+                response = self.client.get(url, {'date': date})
+                self.assertEqual(response.status_code, 400)
+
+            response = self.client.get(url, {'date': '0001-01-01'})
+            self.assertEqual((response.data['date'], response.data['stock']), ('0001-01-01', 0))
+            self.assertEqual(self.client.get(url, {'date': '9999-12-30'}).status_code, 200)
+
+        with self.assertRaisesMessage(CommandError, '日期格式不正确：2025-02-30'):
+            call_command('build_stock_checkpoints', date='2025-02-30', stdout=StringIO())
+
+    def test_build_daily_statistics(self):
+        self.assertEqual(build_daily_statistics(self.today - datetime.timedelta(days=3), self.today), 4)
+
+        rows = InventoryStatistics.objects.filter(material=self.material).order_by('date').values_list(
+            'opening_stock', 'incoming', 'outgoing', 'closing_stock')
+        self.assertEqual(list(rows), [
+            (Decimal('0'), Decimal('0'), Decimal('0'), Decimal('0')),
+            (Decimal('0'), Decimal('10'), Decimal('0'), Decimal('10')),
+            (Decimal('10'), Decimal('0'), Decimal('0'), Decimal('10')),
+            (Decimal('10'), Decimal('0'), Decimal('4'), Decimal('6')),
+        ])
+
+        # 重新汇总覆盖已有统计行，期初取前一天的结果
+        self.assertEqual(build_daily_statistics(self.today, self.today), 1)
+        self.assertEqual(InventoryStatistics.objects.count(), 4)
+
+        response = self.client.get('/api/inventory/statistics/summary/', {
+            'start_date': self._day(2), 'end_date': self._day(0), 'material': self.material.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(
+            (response.data[0]['opening_stock'], response.data[0]['incoming'],
+             response.data[0]['outgoing'], response.data[0]['closing_stock']),
+            (Decimal('0'), Decimal('10'), Decimal('4'), Decimal('6')))
+
+    def test_statistics_reject_invalid_params(self):
+        for params in ({'start_date': '2025-02-30', 'end_date': self._day(0)},
+                       {'start_date': self._day(1), 'end_date': self._day(0), 'material': 'abc'}):
+            response = self.client.get('/api/inventory/statistics/summary/', params)
+            self.assertEqual(response.status_code, 400)
+        for params in ({'start_date': '2025-02-30'}, {'end_date': 'abc'}, {'material': 'abc'}):
+            response = self.client.get('/api/inventory/statistics/', params)
+            self.assertEqual(response.status_code, 400)
+
+
+class InventoryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('operator')
+        self.material = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        with self.captureOnCommitCallbacks(execute=True):
+            for location, quantity in (('', Decimal('5')), ('WH2', Decimal('8'))):
+                MaterialMovement.objects.create(
+                    material=self.material, movement_type='in', quantity=quantity, unit='kg',
+                    location=location)
+        self.inventory = Inventory.objects.create(
+            inventory_number='PD001', inventory_date=timezone.localdate(), created_by=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _count(self, location, actual):
+        InventoryItem.objects.create(
+            inventory=self.inventory, material=self.material, location=location,
+            system_quantity=Decimal('0'), actual_quantity=actual, difference=Decimal('0'))
+
+    def test_confirm_adjusts_each_location(self):
+        self._count('', Decimal('5'))
+        self._count('WH2', Decimal('6'))
+
+        response = self.client.post(f'/api/inventory/inventories/{self.inventory.pk}/confirm/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            dict(MaterialLocationStock.objects.values_list('location', 'stock')),
+            {'': Decimal('5'), 'WH2': Decimal('6')})
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('11'))
+        self.assertEqual(
+            list(MaterialMovement.objects.filter(reason='adjustment').values_list(
+                'movement_type', 'quantity', 'location', 'source_id', 'operator')),
+            [('out', Decimal('2'), 'WH2', self.inventory.pk, self.user.pk)])
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.status, self.inventory.adjustment_type), ('confirmed', 'loss'))
+        self.assertEqual(
+            list(self.inventory.items.order_by('location').values_list('system_quantity', 'difference')),
+            [(Decimal('5'), Decimal('0')), (Decimal('8'), Decimal('-2'))])
+
+        response = self.client.post(f'/api/inventory/inventories/{self.inventory.pk}/confirm/')
+        self.assertEqual(response.status_code, 400)
+
+    def test_confirm_many_locations(self):
+        locations = [f'L{i:04d}' for i in range(1200)]
+        InventoryItem.objects.bulk_create([
+            InventoryItem(
+                inventory=self.inventory, material=self.material, location=location,
+                system_quantity=Decimal('0'), actual_quantity=Decimal('1'), difference=Decimal('0'))
+            for location in locations
+        ])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/inventory/inventories/{self.inventory.pk}/confirm/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            MaterialLocationStock.objects.filter(location__in=locations, stock=Decimal('1')).count(), 1200)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.stock, Decimal('1213'))
+        self.assertEqual(list(MATERIAL_LEDGER.find_drift()), [])
+
+    def test_duplicate_lines_rejected(self):
+        self._count('WH2', Decimal('6'))
+        self._count('WH2', Decimal('7'))
+
+        response = self.client.post(f'/api/inventory/inventories/{self.inventory.pk}/confirm/')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['message'], '材料 冰刀钢 库位 WH2 重复盘点')
+        self.assertFalse(MaterialMovement.objects.filter(reason='adjustment').exists())
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.steel = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        self.leather = Material.objects.create(code='M002', name='皮革', unit='张')
+        self.blade = Product.objects.create(code='P001', name='冰刀', unit='双')
+        self.boot = Product.objects.create(code='P002', name='冰鞋', unit='双')
+
+    def _reserved(self, *objects):
+        for obj in objects:
+            obj.refresh_from_db()
+        return [obj.reserved_stock for obj in objects]
+
+    def test_requirement_material_change_refreshes_both(self):
+        production_order = ProductionOrder.objects.create(
+            order_number='MO001', product=self.blade, planned_quantity=Decimal('1'))
+        requirement = MaterialRequirement.objects.create(
+            production_order=production_order, material=self.steel, required_quantity=Decimal('3'))
+        self.assertEqual(self._reserved(self.steel, self.leather), [Decimal('3'), Decimal('0')])
+
+        requirement.material = self.leather
+        requirement.save()
+        self.assertEqual(self._reserved(self.steel, self.leather), [Decimal('0'), Decimal('3')])
+
+        # 从数据库重新读取的实例同样记录原始材料
+        requirement = MaterialRequirement.objects.get(pk=requirement.pk)
+        requirement.material = self.steel
+        requirement.save()
+        self.assertEqual(self._reserved(self.steel, self.leather), [Decimal('3'), Decimal('0')])
+
+    def test_item_product_change_refreshes_both(self):
+        order = Order.objects.create(
+            order_number='SO001', customer=Customer.objects.create(code='C001', name='冰场'),
+            order_date=timezone.localdate(), delivery_date=timezone.localdate(), customer_order_number='K001',
+            created_by=User.objects.create_user('operator'))
+        order_item = OrderItem.objects.create(order=order, product=self.blade, quantity=Decimal('2'), unit='双')
+        outbound = ProductOutbound.objects.create(outbound_number='CK001')
+        outbound_item = ProductOutboundItem.objects.create(
+            outbound=outbound, product=self.blade, quantity=Decimal('5'), unit='双')
+        self.assertEqual(self._reserved(self.blade, self.boot), [Decimal('7'), Decimal('0')])
+
+        order_item = OrderItem.objects.get(pk=order_item.pk)
+        order_item.product = self.boot
+        order_item.save()
+        self.assertEqual(self._reserved(self.blade, self.boot), [Decimal('5'), Decimal('2')])
+
+        outbound_item.product = self.boot
+        outbound_item.save()
+        self.assertEqual(self._reserved(self.blade, self.boot), [Decimal('0'), Decimal('7')])
+
+
+class DocumentSequenceTests(TestCase):
+    def test_numbers_are_consecutive_per_prefix_and_date(self):
+        day = datetime.date(2025, 6, 26)
+
+        self.assertEqual(next_document_number(SALES_ORDER, day), 'SO20250626001')
+        self.assertEqual(
+            reserve_document_numbers(SALES_ORDER, 2, day), ['SO20250626002', 'SO20250626003'])
+        self.assertEqual(next_document_number(PRODUCTION_ORDER, day), 'PO2025062601')
+        self.assertEqual(next_document_number(SALES_ORDER, day + datetime.timedelta(days=1)), 'SO20250627001')
+
+    def test_rolled_back_numbers_are_reissued(self):
+        day = datetime.date(2025, 6, 26)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                next_document_number(SALES_ORDER, day)
+                raise RuntimeError
+
+        self.assertEqual(next_document_number(SALES_ORDER, day), 'SO20250626001')
+
+    def test_sequence_is_not_capped_by_width(self):
+        day = datetime.date(2025, 6, 26)
+        DocumentSequence.objects.create(prefix='PO', date=day, last_value=99)
+
+        self.assertEqual(next_document_number(PRODUCTION_ORDER, day), 'PO20250626100')
+
+    def test_outbound_number_generated(self):
+        first = ProductOutbound.objects.create()
+        second = ProductOutbound.objects.create()
+
+        today = timezone.localdate().strftime('%Y%m%d')
+        self.assertEqual([first.outbound_number, second.outbound_number], [f'{today}001', f'{today}002'])
+
+
+class MaterialRequirementCalculatorTests(TestCase):
+    """查询数不随明细行数增长"""
+
+    def setUp(self):
+        self.products = Product.objects.bulk_create([
+            Product(code=f'P{i:03d}', name=f'冰刀{i}', unit='双', unit_weight=Decimal('0.5'))
+            for i in range(50)
+        ])
+        self.customer = Customer.objects.create(code='C001', name='客户')
+        self.user = User.objects.create(username='sales')
+        # 物料清单展开结果已缓存（这些产品没有物料清单）
+        cache.clear()
+        flatten_boms(product.pk for product in self.products)
+
+    def _rows(self, count):
+        return [
+            {'product_id': self.products[i % len(self.products)].pk, 'quantity': 2}
+            for i in range(count)
+        ]
+
+    def _order(self, number, line_count):
+        order = Order.objects.create(
+            order_number=number, customer=self.customer, customer_order_number=number, created_by=self.user,
+            order_date=timezone.localdate(), delivery_date=timezone.localdate())
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=Decimal('2'), unit='双')
+            for product in self.products[:line_count]
+        ])
+        return order
+
+    def test_order_items_resolved_in_fixed_queries(self):
+        # 产品一次、物料清单版本号一次
+        for count in (10, 2000):
+            with self.assertNumQueries(2):
+                result = MaterialRequirementCalculator.calculate_from_order_items(self._rows(count))
+            self.assertTrue(result['success'])
+            self.assertEqual(result['summary']['total_items_processed'], count)
+            self.assertEqual(result['summary']['total_material_weight'], count * 1.0)
+
+    def test_order_lines_resolved_in_fixed_queries(self):
+        for number, line_count in (('SO001', 2), ('SO002', 50)):
+            order = self._order(number, line_count)
+            with self.assertNumQueries(6):
+                result = MaterialRequirementCalculator.calculate_from_order(order.pk)
+            self.assertEqual(result['summary']['total_product_types'], line_count)
+
+    def test_order_result_cached_until_changed(self):
+        order = self._order('SO001', 2)
+        self.assertFalse(MaterialRequirementCalculator.calculate_from_order(order.pk)['cached'])
+        with self.assertNumQueries(2):
+            result = MaterialRequirementCalculator.calculate_from_order(order.pk)
+        self.assertTrue(result['cached'])
+
+        # 订单明细变化后重新计算
+        OrderItem.objects.create(order=order, product=self.products[2], quantity=Decimal('2'), unit='双')
+        result = MaterialRequirementCalculator.calculate_from_order(order.pk)
+        self.assertFalse(result['cached'])
+        self.assertEqual(result['summary']['total_product_types'], 3)
+
+        # 产品单重变化后重新计算
+        product = self.products[0]
+        product.unit_weight = Decimal('1.5')
+        product.save()
+        result = MaterialRequirementCalculator.calculate_from_order(order.pk)
+        self.assertFalse(result['cached'])
+        self.assertEqual(result['summary']['total_material_weight'], 5.0)
+
+    def test_errors_keep_row_order(self):
+        Product.objects.filter(pk=self.products[0].pk).update(is_active=False)
+        result = MaterialRequirementCalculator.calculate_from_order_items([
+            {'product_id': self.products[0].pk, 'quantity': 1},
+            {'product_id': None, 'quantity': 1},
+            {'product_id': self.products[1].pk, 'quantity': 0},
+            {'product_id': self.products[1].pk, 'quantity': 'NaN'},
+            {'product_id': self.products[1].pk, 'quantity': '-Infinity'},
+        ])
+
+        self.assertEqual(result['errors'], [
+            f'第1行：产品ID {self.products[0].pk} 不存在或已禁用',
+            '第2行：产品ID不能为空',
+            '第3行：数量必须大于0',
+            '第4行：数量格式不正确',
+            '第5行：数量格式不正确',
+        ])
+
+
+class BillOfMaterialsTests(TestCase):
+    """多级物料清单按产品展开并缓存，编辑后失效"""
+
+    def setUp(self):
+        cache.clear()
+        self.steel = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        self.leather = Material.objects.create(code='M002', name='皮革', unit='m2')
+        self.blade = Product.objects.create(code='P001', name='冰刀', unit='片')
+        self.skate = Product.objects.create(code='P002', name='冰鞋', unit='双')
+        self.blade_steel = ProductMaterial.objects.create(
+            product=self.blade, material=self.steel, quantity=Decimal('0.5'), scrap_rate=Decimal('0.1'))
+        ProductMaterial.objects.create(
+            product=self.skate, component=self.blade, quantity=Decimal('2'))
+        ProductMaterial.objects.create(
+            product=self.skate, material=self.leather, quantity=Decimal('0.4'), scrap_rate=Decimal('0.05'))
+
+    def test_multi_level_bom_flattened_with_scrap(self):
+        flattened = flatten_boms([self.skate.pk])
+
+        self.assertEqual(flattened[self.skate.pk], {
+            self.steel.pk: Decimal('1.1'),
+            self.leather.pk: Decimal('0.42'),
+        })
+
+    def test_flattened_bom_cached_until_edited(self):
+        flatten_boms([self.skate.pk])
+        with self.assertNumQueries(1):
+            flatten_boms([self.skate.pk, self.blade.pk])
+
+        # 修改下级半成品的物料清单，上级产品的展开结果随之失效
+        with self.captureOnCommitCallbacks(execute=True):
+            self.blade_steel.quantity = Decimal('1')
+            self.blade_steel.save()
+
+        self.assertEqual(flatten_boms([self.skate.pk])[self.skate.pk][self.steel.pk], Decimal('2.2'))
+
+    def test_cyclic_bom_rejected(self):
+        with self.assertRaises(ValidationError):
+            ProductMaterial.objects.create(product=self.blade, component=self.skate, quantity=Decimal('1'))
+
+    def test_calculator_expands_bom_materials(self):
+        result = MaterialRequirementCalculator.calculate_from_order_items([
+            {'product_id': self.skate.pk, 'quantity': 10},
+            {'product_id': self.blade.pk, 'quantity': 4},
+        ])
+
+        self.assertTrue(result['success'])
+        self.assertEqual(
+            [(row['material_code'], row['required_quantity']) for row in result['bom_material_requirements']],
+            [('M001', 13.2), ('M002', 4.2)],
+        )
+
+
+class ScenarioSimulationTests(TestCase):
+    """情景模拟按矩阵整体计算，查询数与情景数无关"""
+
+    def setUp(self):
+        cache.clear()
+        self.today = timezone.localdate()
+        self.steel = Material.objects.create(code='M001', name='冰刀钢', unit='kg', stock=Decimal('10'))
+        self.blade = Product.objects.create(code='P001', name='冰刀', unit='双')
+        ProductMaterial.objects.create(product=self.blade, material=self.steel, quantity=Decimal('0.5'))
+        user = User.objects.create(username='sales')
+        customer = Customer.objects.create(code='C001', name='客户')
+        self.order = Order.objects.create(
+            order_number='SO001', customer=customer, customer_order_number='SO001', created_by=user,
+            order_date=self.today, delivery_date=self.today)
+        OrderItem.objects.create(order=self.order, product=self.blade, quantity=Decimal('10'), unit='双')
+        supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+        purchase = MaterialPurchase.objects.create(
+            purchase_number='CG001', supplier=supplier, purchase_date=self.today,
+            delivery_date=self.today + datetime.timedelta(days=10), status='pending')
+        PurchaseItem.objects.create(
+            purchase=purchase, material=self.steel, control_number='C1',
+            specification='2mm', quantity=Decimal('20'), unit='kg')
+        flatten_boms([self.blade.pk])
+
+    def test_shortages_per_scenario_and_material(self):
+        later = self.today + datetime.timedelta(days=10)
+        result = simulate_requirements([
+            {'name': '基准', 'orders': [self.order.pk]},
+            {'name': '放大3倍', 'orders': [self.order.pk], 'scale': 3},
+            {'name': '放大3倍延期', 'orders': [self.order.pk], 'scale': 3, 'date': str(later)},
+            {'name': '追加', 'orders': [self.order.pk], 'items': [{'product_id': self.blade.pk, 'quantity': 20}]},
+        ], as_of=self.today)
+
+        self.assertEqual(
+            [(scenario['name'], scenario['total_shortage']) for scenario in result['scenarios']],
+            [('基准', 0.0), ('放大3倍', 5.0), ('放大3倍延期', 0.0), ('追加', 5.0)],
+        )
+        self.assertEqual(result['scenarios'][1]['shortages'][0]['available_quantity'], 10.0)
+        self.assertEqual(result['materials'][0]['shortage_scenario_count'], 2)
+        self.assertEqual(result['materials'][0]['max_shortage'], 5.0)
+
+    def test_duplicate_orders_counted_once(self):
+        result = simulate_requirements([
+            {'name': '重复', 'orders': [self.order.pk, str(self.order.pk)], 'scale': 3},
+        ], as_of=self.today)
+
+        self.assertEqual(result['scenarios'][0]['total_shortage'], 5.0)
+        self.assertEqual(result['scenarios'][0]['shortages'][0]['required_quantity'], 15.0)
+
+    def test_query_count_independent_of_scenario_count(self):
+        for count in (2, 500):
+            scenarios = [
+                {'orders': [self.order.pk], 'scale': 1 + i / 100, 'items': [{'product_id': self.blade.pk, 'quantity': 1}]}
+                for i in range(count)
+            ]
+            with self.assertNumQueries(6):
+                result = simulate_requirements(scenarios, as_of=self.today)
+            self.assertEqual(result['summary']['scenario_count'], count)
+
+    def test_own_reservations_not_counted_twice(self):
+        # 订单已建生产单，其材料需求 5 已计入预留库存；模拟该订单时加回这部分预留
+        production_order = ProductionOrder.objects.create(
+            order_number='MO001', sales_order=self.order, product=self.blade, planned_quantity=Decimal('10'))
+        MaterialRequirement.objects.create(
+            production_order=production_order, material=self.steel, required_quantity=Decimal('5'))
+        self.steel.refresh_from_db()
+        self.assertEqual(self.steel.reserved_stock, Decimal('5'))
+
+        result = simulate_requirements([
+            {'name': '基准', 'orders': [self.order.pk]},
+            {'name': '放大3倍', 'orders': [self.order.pk], 'scale': 3},
+            {'name': '只追加', 'items': [{'product_id': self.blade.pk, 'quantity': 20}]},
+        ], as_of=self.today)
+
+        self.assertEqual(
+            [(scenario['name'], scenario['total_shortage']) for scenario in result['scenarios']],
+            [('基准', 0.0), ('放大3倍', 5.0), ('只追加', 5.0)],
+        )
+        self.assertEqual(result['materials'][0]['available_stock'], 5.0)
+
+    def test_orders_due_on_their_delivery_dates(self):
+        later = self.today + datetime.timedelta(days=10)
+        order = Order.objects.create(
+            order_number='SO002', customer=self.order.customer, customer_order_number='SO002',
+            created_by=self.order.created_by, order_date=self.today, delivery_date=later)
+        OrderItem.objects.create(order=order, product=self.blade, quantity=Decimal('30'), unit='双')
+
+        result = simulate_requirements([
+            {'name': '按交货日期', 'orders': [self.order.pk, order.pk]},
+            {'name': '全部提前', 'orders': [self.order.pk, order.pk], 'date': str(self.today)},
+            {'name': '放大2倍', 'orders': [self.order.pk, order.pk], 'scale': 2},
+        ], as_of=self.today)
+
+        # 第10天累计需求 20 与 30 的可用量（库存 10 + 到货 20）比较；提前到今天则只有库存 10
+        self.assertEqual(
+            [(scenario['name'], scenario['date'], scenario['total_shortage']) for scenario in result['scenarios']],
+            [('按交货日期', str(later), 0.0), ('全部提前', str(self.today), 10.0), ('放大2倍', str(later), 10.0)],
+        )
+        self.assertEqual(result['scenarios'][2]['shortages'][0], {
+            'material_id': self.steel.pk,
+            'material_code': 'M001',
+            'date': str(later),
+            'required_quantity': 40.0,
+            'available_quantity': 30.0,
+            'shortage': 10.0,
+        })
+
+    def test_invalid_scenarios_rejected(self):
+        with self.assertRaises(ValidationError) as context:
+            simulate_requirements([
+                {'name': '空情景'},
+                {'orders': [self.order.pk], 'date': 'bad'},
+                {'orders': [self.order.pk], 'date': '2025-02-30'},
+                '订单',
+                {'orders': [self.order.pk], 'scale': 'nan'},
+                {'orders': str(self.order.pk)},
+                {'items': {'product_id': self.blade.pk, 'quantity': 1}},
+                {'items': [{'product_id': self.blade.pk, 'quantity': 1e300}], 'scale': 1e10},
+            ])
+        self.assertEqual(context.exception.messages, [
+            '空情景：请填写订单或产品明细',
+            '情景2：日期格式不正确：bad',
+            '情景3：日期格式不正确：2025-02-30',
+            '情景4：格式不正确',
+            '情景5：订单、产品或数量格式不正确',
+            '情景6：订单和产品明细应为列表',
+            '情景7：订单和产品明细应为列表',
+            '情景8：放大后的需求数量超出范围',
+        ])
+
+        # 订单数量经放大和用量系数相乘后溢出
+        with self.assertRaisesMessage(ValidationError, '溢出：放大后的需求数量超出范围'):
+            simulate_requirements([{'name': '溢出', 'orders': [self.order.pk], 'scale': 1e308}])
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('planner'))
+        url = '/api/inventory/products/simulate_material_requirements/'
+        response = client.post(
+            url, {'as_of': '2025-02-30', 'scenarios': [{'orders': [self.order.pk]}]}, format='json')
+        self.assertEqual(response.data, {'error': '日期格式不正确'})
+        response = client.post(url, {'scenarios': {'orders': [self.order.pk]}}, format='json')
+        self.assertEqual(response.data, {'success': False, 'errors': ['情景格式不正确，应为列表']})
+
+
+class ConcurrentStockPostingTests(TransactionTestCase):
+    """多线程高频过账，验证库存没有漂移"""
+    threads = 8
+    postings_per_thread = 25
+    locations = ['', 'WH2']
+
+    def setUp(self):
+        self.material = Material.objects.create(
+            code='M001', name='冰刀钢', unit='kg', stock=Decimal('100'))
+        self.product = Product.objects.create(
+            code='P001', name='冰刀', unit='双', stock=Decimal('100'))
+        self.posted = []
+
+    def _post(self, create):
+        try:
+            _retry_locked(create)
+            self.posted.append(True)
+        except ValidationError:
+            # 库存不足被拒绝是预期行为
+            self.posted.append(False)
+
+    def _post_materials(self, index):
+        try:
+            for n in range(self.postings_per_thread):
+                movement_type = 'in' if (index + n) % 2 else 'out'
+                # 每个线程持有的都是过期的材料实例，库存必须以数据库为准
+                self._post(lambda: MaterialMovement.objects.create(
+                    material=Material(pk=self.material.pk, stock=Decimal('0')),
+                    movement_type=movement_type, quantity=Decimal('3'), unit='kg',
+                    location=self.locations[index % len(self.locations)]))
+        finally:
+            connection.close()
+
+    def _post_products(self, index):
+        try:
+            for n in range(self.postings_per_thread):
+                movement_type = 'in' if (index + n) % 2 else 'out'
+                self._post(lambda: ProductMovement.objects.create(
+                    product=Product(pk=self.product.pk, stock=Decimal('0')),
+                    movement_type=movement_type, quantity=Decimal('7'), unit='双',
+                    reference_number=f'T{index}'))
+        finally:
+            connection.close()
+
+    def test_material_stock_has_no_drift(self):
+        _run_threads(self._post_materials, self.threads)
+
+        for location in self.locations:
+            totals = MaterialMovement.objects.filter(material=self.material, location=location).aggregate(
+                incoming=Sum('quantity', filter=Q(movement_type='in')),
+                outgoing=Sum('quantity', filter=Q(movement_type='out')),
+            )
+            # 期初库存已作为调整入库记录计入台账
+            location_stock = MaterialLocationStock.objects.filter(
+                material=self.material, location=location).values_list('stock', flat=True).first()
+            self.assertEqual(
+                location_stock or Decimal('0'),
+                (totals['incoming'] or 0) - (totals['outgoing'] or 0))
+
+        totals = MaterialMovement.objects.filter(material=self.material).aggregate(
+            incoming=Sum('quantity', filter=Q(movement_type='in')),
+            outgoing=Sum('quantity', filter=Q(movement_type='out')),
+        )
+        self.material.refresh_from_db()
+        self.assertEqual(
+            self.material.stock,
+            (totals['incoming'] or 0) - (totals['outgoing'] or 0))
+        self.assertGreaterEqual(self.material.stock, 0)
+        self.assertEqual(len(self.posted), self.threads * self.postings_per_thread)
+        self.assertEqual(
+            MaterialMovement.objects.filter(material=self.material).exclude(reason='adjustment').count(),
+            self.posted.count(True))
+
+    def test_product_stock_has_no_drift(self):
+        _run_threads(self._post_products, self.threads)
+
+        totals = ProductMovement.objects.filter(product=self.product).aggregate(
+            incoming=Sum('quantity', filter=Q(movement_type='in')),
+            outgoing=Sum('quantity', filter=Q(movement_type='out')),
+        )
+        self.product.refresh_from_db()
+        self.assertEqual(
+            self.product.stock,
+            Decimal('100') + (totals['incoming'] or 0) - (totals['outgoing'] or 0))
+        self.assertGreaterEqual(self.product.stock, 0)
+        self.assertEqual(len(self.posted), self.threads * self.postings_per_thread)
+        self.assertEqual(
+            ProductMovement.objects.filter(product=self.product).count(),
+            self.posted.count(True))
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN 仅适用于 SQLite')
+class HotQueryPlanTests(QueryPlanAssertions, TestCase):
+    """库存热点查询的执行计划"""
+
+    def test_material_movements_by_date(self):
+        # 历史库存查询：某材料某时间之后的变动
+        self.assertUsesIndex(
+            MaterialMovement.objects.filter(material_id=1, movement_date__gte=timezone.now()),
+            'materialmove_material_date_idx')
+
+    def test_material_movements_by_batch(self):
+        # 批次对账：某批次的出库记录
+        self.assertUsesIndex(
+            MaterialMovement.objects.filter(batch_id=1, movement_type='out'),
+            'materialmove_batch_type_idx')
+
+    def test_product_movements_by_reference(self):
+        # 按单号查询产品出入库
+        self.assertUsesIndex(
+            ProductMovement.objects.filter(reference_number='SO001', movement_type='out'),
+            'productmove_ref_type_idx')
+
+    def test_movements_by_source(self):
+        # 冲销和来源追溯：某单据某原因的变动记录
+        self.assertUsesIndex(
+            MaterialMovement.objects.filter(source_type='purchase', source_id=1, reason='purchase_receipt'),
+            'materialmove_source_idx')
+        self.assertUsesIndex(
+            ProductMovement.objects.filter(source_type='sales_order', source_id=1, reason='sales_shipment'),
+            'productmove_source_idx')
+
+    def test_available_batches_fifo(self):
+        # 生产领料：某材料的可用批次，按生产日期先进先出
+        self.assertUsesIndex(
+            MaterialBatch.objects.filter(
+                material_id=1, status='normal', remaining_quantity__gt=0
+            ).order_by('production_date'),
+            'materialbatch_live_fifo_idx')
+
+    def test_open_purchase_quantities(self):
+        # 在途数量：只读取待入库的采购单，不扫描全部采购明细
+        self.assertUsesIndex(
+            PurchaseItem.objects.filter(purchase__status='pending', received_quantity__lt=F('quantity')),
+            'materialpurchase_status_idx')
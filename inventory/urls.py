@@ -8,11 +8,14 @@ router.register(r'movements', views.MaterialMovementViewSet)
 router.register(r'suppliers', views.SupplierViewSet)
 router.register(r'purchases', views.MaterialPurchaseViewSet)
 router.register(r'products', views.ProductViewSet)
+router.register(r'product-materials', views.ProductMaterialViewSet)
 router.register(r'product-movements', views.ProductMovementViewSet)
 router.register(r'batches', views.MaterialBatchViewSet)
 router.register(r'inventories', views.InventoryViewSet)
 router.register(r'outbounds', views.ProductOutboundViewSet)
 router.register(r'outbound-items', views.ProductOutboundItemViewSet)
+router.register(r'statistics', views.InventoryStatisticsViewSet)
+router.register(r'location-stocks', views.MaterialLocationStockViewSet)
 
 app_name = 'inventory'
 
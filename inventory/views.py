@@ -1,5 +1,5 @@
 from django.shortcuts import render, get_object_or_404
-from rest_framework import viewsets, status
+from rest_framework import viewsets, status, exceptions
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.db.models import Sum, Q, F
@@ -13,9 +13,12 @@ from .models import (
     Inventory,
     InventoryItem,
     Product,
+    ProductMaterial,
     ProductMovement,
     ProductOutbound,
-    ProductOutboundItem
+    ProductOutboundItem,
+    InventoryStatistics,
+    MaterialLocationStock
 )
 from .serializers import (
     MaterialSerializer,
@@ -27,20 +30,50 @@ from .serializers import (
     InventorySerializer,
     InventoryItemSerializer,
     ProductSerializer,
+    ProductMaterialSerializer,
     ProductMovementSerializer,
     ProductOutboundSerializer,
-    ProductOutboundItemSerializer
+    ProductOutboundItemSerializer,
+    InventoryStatisticsSerializer,
+    MaterialLocationStockSerializer
 )
 from django.http import FileResponse
 from services.material_pdf_service import MaterialPurchasePDFService
 import os
 from django.template.response import TemplateResponse
 from django.core.exceptions import ValidationError
+from django.utils.dateparse import parse_date
 from orders.models import Customer
 from orders.serializers import CustomerSerializer
 
 # Create your views here.
 
+def _parse_date_param(value):
+    """解析 YYYY-MM-DD 日期参数，格式不正确或日期不存在（如 2025-02-30）时返回 None"""
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        return None
+
+def _location_param(data):
+    """请求中的入库库位，未填写为默认库位；不是字符串或超过字段长度时返回 None"""
+    location = data.get('location') if isinstance(data, dict) else None
+    if location is None:
+        return ''
+    if not isinstance(location, str) or len(location.strip()) > 50:
+        return None
+    return location.strip()
+
+def _availability(item):
+    """库存对象的可用库存，预留库存由单据变化时维护，这里只读取一行"""
+    return {
+        'id': item.pk,
+        'code': item.code,
+        'stock': float(item.stock),
+        'reserved_stock': float(item.reserved_stock),
+        'available': float(item.available_stock),
+    }
+
 class MaterialViewSet(viewsets.ModelViewSet):
     queryset = Material.objects.all()
     serializer_class = MaterialSerializer
@@ -55,6 +88,39 @@ class MaterialViewSet(viewsets.ModelViewSet):
         serializer = MaterialMovementSerializer(movements, many=True)
         return Response(serializer.data)
     
+    @action(detail=True, methods=['get'])
+    def available(self, request, pk=None):
+        """获取材料的库存、预留库存和可用库存"""
+        material = self.get_object()
+        return Response(_availability(material))
+
+    @action(detail=True, methods=['get'])
+    def locations(self, request, pk=None):
+        """获取材料在各库位的库存"""
+        material = self.get_object()
+        location_stocks = MaterialLocationStock.objects.filter(material=material).select_related('material')
+        serializer = MaterialLocationStockSerializer(location_stocks, many=True)
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def stock_at(self, request, pk=None):
+        """查询材料在指定日期日末的库存"""
+        from .stock_ledger import LATEST_LEDGER_DATE, MATERIAL_LEDGER
+
+        material = self.get_object()
+        date = _parse_date_param(request.query_params.get('date'))
+        if date is None:
+            return Response(
+                {'error': '请提供正确的日期参数，格式为YYYY-MM-DD'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if date > LATEST_LEDGER_DATE:
+            return Response(
+                {'error': f'日期不能晚于 {LATEST_LEDGER_DATE.isoformat()}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(MATERIAL_LEDGER.stock_at(material, date))
+
     @action(detail=True, methods=['get'])
     def purchases(self, request, pk=None):
         """获取材料的采购历史"""
@@ -68,6 +134,30 @@ class MaterialMovementViewSet(viewsets.ModelViewSet):
     serializer_class = MaterialMovementSerializer
     filterset_fields = ['material', 'movement_type']
     search_fields = ['reference_number', 'notes']
+    # 变动记录过账后不可修改或删除，更正请另行录入冲销或调整记录
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """批量过账材料变动"""
+        from .bulk_movements import post_material_movements
+
+        lines = request.data.get('lines') if isinstance(request.data, dict) else None
+        if not isinstance(lines, list) or not lines:
+            return Response({'error': '请提供变动明细列表 lines'}, status=status.HTTP_400_BAD_REQUEST)
+        operator = request.user if request.user.is_authenticated else None
+
+        try:
+            result = post_material_movements(lines, operator=operator)
+        except Exception as e:
+            return Response(
+                {'error': f'批量过账失败: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        if not result['success']:
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_201_CREATED)
 
 class SupplierViewSet(viewsets.ModelViewSet):
     queryset = Supplier.objects.all()
@@ -85,10 +175,13 @@ class MaterialPurchaseViewSet(viewsets.ModelViewSet):
     def receive(self, request, pk=None):
         """确认入库"""
         purchase = self.get_object()
+        location = _location_param(request.data)
+        if location is None:
+            return Response({'error': '库位格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
             # 调用模型中的入库方法
-            purchase.receive_materials()
+            purchase.receive_materials(location)
             return Response({'status': 'success', 'message': '入库操作成功'})
         except ValidationError as e:
             return Response(
@@ -101,6 +194,102 @@ class MaterialPurchaseViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=False, methods=['post'])
+    def bulk_receive(self, request):
+        """批量入库多张采购单（整车到货）"""
+        from .receiving import receive_purchases
+
+        purchase_ids = request.data.get('purchases')
+        if not isinstance(purchase_ids, list) or not purchase_ids:
+            return Response({'error': '请提供采购单ID列表 purchases'}, status=status.HTTP_400_BAD_REQUEST)
+        location = _location_param(request.data)
+        if location is None:
+            return Response({'error': '库位格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            purchase_ids = [int(pk) for pk in purchase_ids]
+        except (TypeError, ValueError):
+            return Response({'error': '采购单ID格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            result = receive_purchases(purchase_ids, location)
+        except ValidationError as e:
+            return Response(
+                {'success': False, 'errors': e.messages},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(result)
+
+    @action(detail=True, methods=['post'])
+    def receive_delivery(self, request, pk=None):
+        """分批到货入库：{"items": [{"item": 明细ID, "quantity": 本次到货数量}]}"""
+        from .receiving import receive_delivery
+
+        purchase = self.get_object()
+        lines = request.data.get('items')
+        if not isinstance(lines, list) or not lines:
+            return Response({'error': '请提供本次到货明细 items'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            quantities = {int(line['item']): line['quantity'] for line in lines}
+        except (KeyError, TypeError, ValueError):
+            return Response({'error': '到货明细格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+        location = _location_param(request.data)
+        if location is None:
+            return Response({'error': '库位格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            result = receive_delivery(purchase.pk, quantities, location)
+        except ValidationError as e:
+            return Response(
+                {'success': False, 'errors': e.messages},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(result)
+
+    @action(detail=False, methods=['get'])
+    def open_quantities(self, request):
+        """待入库采购单按材料汇总的在途数量，可用 materials=1,2,3 筛选"""
+        from .receiving import open_purchase_quantities
+
+        materials = request.query_params.get('materials')
+        try:
+            material_ids = [int(pk) for pk in materials.split(',') if pk] if materials else None
+        except ValueError:
+            return Response({'error': '材料ID格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+
+        quantities = open_purchase_quantities(material_ids)
+        return Response([
+            {'material': material_id, 'open_quantity': float(quantity)}
+            for material_id, quantity in sorted(quantities.items())
+        ])
+
+    @action(detail=False, methods=['get', 'post'])
+    def suggestions(self, request):
+        """按再订货点计算采购建议；GET 只预览，POST 生成草稿采购单"""
+        from .purchase_suggestions import (
+            DEFAULT_LEAD_TIME_DAYS,
+            DEFAULT_LOOKBACK_DAYS,
+            create_purchase_suggestions,
+        )
+
+        params = request.data if request.method == 'POST' else request.query_params
+        try:
+            lookback_days = int(params.get('lookback_days', DEFAULT_LOOKBACK_DAYS))
+            lead_time_days = int(params.get('lead_time_days', DEFAULT_LEAD_TIME_DAYS))
+        except (TypeError, ValueError):
+            return Response({'error': '天数参数格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+        if lookback_days <= 0:
+            return Response({'error': '统计天数必须大于0'}, status=status.HTTP_400_BAD_REQUEST)
+        if lead_time_days < 0:
+            return Response({'error': '采购提前期不能为负数'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(create_purchase_suggestions(
+            lookback_days=lookback_days,
+            lead_time_days=lead_time_days,
+            dry_run=request.method != 'POST',
+        ))
+
     @action(detail=True, methods=['post'])
     def cancel_receive(self, request, pk=None):
         """撤销入库"""
@@ -163,6 +352,34 @@ class ProductViewSet(viewsets.ModelViewSet):
         serializer = CustomerSerializer(customers, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def available(self, request, pk=None):
+        """获取产品的库存、预留库存和可用库存"""
+        product = self.get_object()
+        return Response(_availability(product))
+
+    @action(detail=True, methods=['get'])
+    def bom(self, request, pk=None):
+        """获取产品展开后的单件材料用量（含各级损耗）"""
+        from .bom import flatten_boms
+        
+        product = self.get_object()
+        try:
+            flattened = flatten_boms([product.pk])[product.pk]
+        except ValidationError as e:
+            return Response({'error': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        materials = Material.objects.in_bulk(flattened.keys())
+        return Response([
+            {
+                'material_id': material_id,
+                'material_code': materials[material_id].code,
+                'material_name': materials[material_id].name,
+                'unit': materials[material_id].unit,
+                'quantity_per_unit': float(quantity),
+            }
+            for material_id, quantity in sorted(flattened.items())
+        ])
+    
     @action(detail=True, methods=['get'])
     def movements(self, request, pk=None):
         """获取产品的库存变动历史"""
@@ -171,6 +388,25 @@ class ProductViewSet(viewsets.ModelViewSet):
         serializer = ProductMovementSerializer(movements, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def stock_at(self, request, pk=None):
+        """查询产品在指定日期日末的库存"""
+        from .stock_ledger import LATEST_LEDGER_DATE, PRODUCT_LEDGER
+
+        product = self.get_object()
+        date = _parse_date_param(request.query_params.get('date'))
+        if date is None:
+            return Response(
+                {'error': '请提供正确的日期参数，格式为YYYY-MM-DD'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if date > LATEST_LEDGER_DATE:
+            return Response(
+                {'error': f'日期不能晚于 {LATEST_LEDGER_DATE.isoformat()}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(PRODUCT_LEDGER.stock_at(product, date))
+
     @action(detail=False, methods=['get'])
     def stock_warning(self, request):
         """获取库存预警产品列表"""
@@ -224,10 +460,30 @@ class ProductViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=False, methods=['post'])
+    def simulate_material_requirements(self, request):
+        """按多个需求情景（订单放大、调整交货日期）批量模拟材料缺口"""
+        from .scenarios import simulate_requirements
+        
+        as_of = None
+        if request.data.get('as_of'):
+            as_of = _parse_date_param(str(request.data['as_of']))
+            if as_of is None:
+                return Response({'error': '日期格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            return Response(simulate_requirements(request.data.get('scenarios', []), as_of=as_of))
+        except ValidationError as e:
+            return Response({'success': False, 'errors': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+class ProductMaterialViewSet(viewsets.ModelViewSet):
+    queryset = ProductMaterial.objects.select_related('product', 'material', 'component')
+    serializer_class = ProductMaterialSerializer
+    filterset_fields = ['product', 'material', 'component']
+
 class ProductMovementViewSet(viewsets.ModelViewSet):
     queryset = ProductMovement.objects.all()
     serializer_class = ProductMovementSerializer
-    filterset_fields = ['product', 'movement_type']
+    filterset_fields = ['product', 'movement_type', 'reference_number']
     search_fields = ['reference_number', 'notes']
 
 class MaterialBatchViewSet(viewsets.ModelViewSet):
@@ -246,21 +502,84 @@ class InventoryViewSet(viewsets.ModelViewSet):
     def confirm(self, request, pk=None):
         """确认盘点"""
         inventory = self.get_object()
-        if inventory.status == 'draft':
-            inventory.status = 'confirmed'
-            inventory.save()
-            
-            # 更新材料库存
-            for item in inventory.items.all():
-                material = item.material
-                material.stock = item.actual_quantity
-                material.save()
-            
-            return Response({'status': 'success'})
-        return Response(
-            {'status': 'error', 'message': '只能确认草稿状态的盘点单'},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        operator = request.user if request.user.is_authenticated else None
+        try:
+            inventory.confirm_inventory(operator=operator)
+        except ValidationError as e:
+            return Response(
+                {'status': 'error', 'message': e.messages[0]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'status': 'success'})
+
+class MaterialLocationStockViewSet(viewsets.ReadOnlyModelViewSet):
+    """材料库位库存，由变动记录过账维护"""
+    queryset = MaterialLocationStock.objects.select_related('material')
+    serializer_class = MaterialLocationStockSerializer
+    filterset_fields = ['material', 'location']
+    search_fields = ['material__code', 'material__name', 'location']
+
+class InventoryStatisticsViewSet(viewsets.ReadOnlyModelViewSet):
+    """库存日统计，数据由 rollup_inventory_statistics 命令预先汇总"""
+    queryset = InventoryStatistics.objects.select_related('material').order_by('date', 'material__code')
+    serializer_class = InventoryStatisticsSerializer
+    filterset_fields = ['material', 'date']
+    search_fields = ['material__code', 'material__name']
+
+    def get_queryset(self):
+        """支持按日期区间筛选"""
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        start_date = _parse_date_param(params.get('start_date'))
+        end_date = _parse_date_param(params.get('end_date'))
+        if (params.get('start_date') and start_date is None) or (params.get('end_date') and end_date is None):
+            raise exceptions.ValidationError({'error': '日期格式不正确，格式为YYYY-MM-DD'})
+        if start_date:
+            queryset = queryset.filter(date__gte=start_date)
+        if end_date:
+            queryset = queryset.filter(date__lte=end_date)
+        return queryset
+
+    @action(detail=False, methods=['get'])
+    def summary(self, request):
+        """按材料汇总日期区间的期初、入库、出库、期末库存"""
+        start_date = _parse_date_param(request.query_params.get('start_date'))
+        end_date = _parse_date_param(request.query_params.get('end_date'))
+        if start_date is None or end_date is None or start_date > end_date:
+            return Response(
+                {'error': '请提供正确的日期区间参数 start_date、end_date，格式为YYYY-MM-DD'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        statistics = InventoryStatistics.objects.filter(date__range=(start_date, end_date))
+        material_id = request.query_params.get('material')
+        if material_id:
+            try:
+                statistics = statistics.filter(material_id=int(material_id))
+            except ValueError:
+                return Response({'error': '材料ID格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+
+        opening = dict(statistics.filter(date=start_date).values_list('material_id', 'opening_stock'))
+        closing = dict(statistics.filter(date=end_date).values_list('material_id', 'closing_stock'))
+        totals = statistics.values(
+            'material_id', 'material__code', 'material__name'
+        ).annotate(
+            incoming=Sum('incoming'),
+            outgoing=Sum('outgoing')
+        ).order_by('material__code')
+
+        return Response([
+            {
+                'material': row['material_id'],
+                'material_code': row['material__code'],
+                'material_name': row['material__name'],
+                'opening_stock': opening.get(row['material_id']),
+                'incoming': row['incoming'],
+                'outgoing': row['outgoing'],
+                'closing_stock': closing.get(row['material_id']),
+            }
+            for row in totals
+        ])
 
 def print_purchase(request, pk):
     """
@@ -3,7 +3,7 @@ from django.db import models
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from decimal import Decimal
-from inventory.models import Product, ProductMovement
+from inventory.models import Product, ProductMovement, apply_stock_delta
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
 
@@ -79,55 +79,55 @@ def handle_order_status_change(sender, instance, **kwargs):
     if old_status == 'completed' and new_status == 'processing':
         # 从生产完成回退到生产中，需要撤销入库记录
         movements = ProductMovement.objects.filter(
-            reference_number=instance.order_number,
-            movement_type='in',
-            notes__contains='生产完成入库'
+            source_type='sales_order',
+            source_id=instance.pk,
+            reason='production_receipt'
         )
         for movement in movements:
             # 先恢复产品的库存数量
-            product = movement.product
-            product.stock -= movement.quantity
-            product.save()
+            apply_stock_delta(Product, movement.product_id, -movement.quantity)
             # 然后删除入库记录
             movement.delete()
             
     elif old_status == 'shipped' and new_status in ['completed', 'processing']:
         # 从已发货回退，需要撤销出库记录
         movements = ProductMovement.objects.filter(
-            reference_number=instance.order_number,
-            movement_type='out',
-            notes__contains='订单发货出库'
+            source_type='sales_order',
+            source_id=instance.pk,
+            reason='sales_shipment'
         )
         for movement in movements:
             # 先恢复产品的库存数量
-            product = movement.product
-            product.stock += movement.quantity
-            product.save()
+            apply_stock_delta(Product, movement.product_id, movement.quantity)
             # 然后删除出库记录
             movement.delete()
             
-        # 如果回退到生产完成，需要重新创建入库记录
-        if new_status == 'completed':
+        # 回退到生产完成时入库记录仍在；只有回退到生产中才会撤销入库记录
+        if new_status == 'completed' and not ProductMovement.objects.filter(
+            source_type='sales_order',
+            source_id=instance.pk,
+            reason='production_receipt'
+        ).exists():
             for item in instance.items.all():
                 ProductMovement.objects.create(
                     product=item.product,
                     movement_type='in',
                     quantity=item.quantity,
                     reference_number=instance.order_number,
+                    source_type='sales_order',
+                    source_id=instance.pk,
+                    reason='production_receipt',
                     notes=f'生产完成入库（状态回退） - 订单号：{instance.order_number}'
                 )
-                # 更新产品库存
-                product = item.product
-                product.stock += item.quantity
-                product.save()
+                # ProductMovement 的 save 方法会自动更新产品库存
     
     # 处理正常的状态推进
     elif new_status == 'completed':
         # 检查是否已经有入库记录
         existing_movement = ProductMovement.objects.filter(
-            reference_number=instance.order_number,
-            movement_type='in',
-            notes__contains='生产完成入库'
+            source_type='sales_order',
+            source_id=instance.pk,
+            reason='production_receipt'
         ).exists()
         
         if not existing_movement:
@@ -138,19 +138,19 @@ def handle_order_status_change(sender, instance, **kwargs):
                     movement_type='in',
                     quantity=item.quantity,
                     reference_number=instance.order_number,
+                    source_type='sales_order',
+                    source_id=instance.pk,
+                    reason='production_receipt',
                     notes=f'生产完成入库 - 订单号：{instance.order_number}'
                 )
-                # 更新产品库存
-                product = item.product
-                product.stock += item.quantity
-                product.save()
+                # ProductMovement 的 save 方法会自动更新产品库存
     
     elif new_status == 'shipped':
         # 检查是否已经有出库记录
         existing_movement = ProductMovement.objects.filter(
-            reference_number=instance.order_number,
-            movement_type='out',
-            notes__contains='订单发货出库'
+            source_type='sales_order',
+            source_id=instance.pk,
+            reason='sales_shipment'
         ).exists()
         
         if not existing_movement:
@@ -161,12 +161,12 @@ def handle_order_status_change(sender, instance, **kwargs):
                     movement_type='out',
                     quantity=item.quantity,
                     reference_number=instance.order_number,
+                    source_type='sales_order',
+                    source_id=instance.pk,
+                    reason='sales_shipment',
                     notes=f'订单发货出库 - 订单号：{instance.order_number}'
                 )
-                # 更新产品库存
-                product = item.product
-                product.stock -= item.quantity
-                product.save()
+                # ProductMovement 的 save 方法会自动更新产品库存
 
 class OrderItem(models.Model):
     """订单明细"""
@@ -179,6 +179,11 @@ class OrderItem(models.Model):
     unit = models.CharField(max_length=20, verbose_name='单位')
     notes = models.TextField(blank=True, verbose_name='备注')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 保存原始产品，更换产品时原产品的预留库存也要重新汇总（延迟加载的字段不触发查询）
+        self._original_product_id = self.__dict__.get('product_id')
+
     def __str__(self):
         return f"{self.order.order_number} - {self.product.name}"
 
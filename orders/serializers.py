@@ -1,9 +1,9 @@
 from rest_framework import serializers
 from .models import Customer, Order, OrderItem
 from inventory.models import Product
+from inventory.sequences import SALES_ORDER, next_document_number
 from django.contrib.auth import get_user_model
 from django.db import transaction
-import datetime
 
 class CustomerSerializer(serializers.ModelSerializer):
     class Meta:
@@ -35,22 +35,8 @@ class OrderSerializer(serializers.ModelSerializer):
         read_only_fields = ['order_number', 'created_by', 'created_at', 'updated_at']
 
     def generate_order_number(self):
-        """生成订单号"""
-        today = datetime.date.today()
-        date_str = today.strftime('%Y%m%d')
-        
-        # 查找今天最大的订单号
-        latest_order = Order.objects.filter(
-            order_number__startswith=f'SO{date_str}'
-        ).order_by('-order_number').first()
-        
-        if latest_order:
-            # 提取序号部分并加1
-            sequence = int(latest_order.order_number[-3:]) + 1
-        else:
-            sequence = 1
-        
-        return f'SO{date_str}{sequence:03d}'
+        """生成订单号：SO+日期+序号，由单据编号序列发放"""
+        return next_document_number(SALES_ORDER)
 
     def create(self, validated_data):
         """创建订单及其明细"""
@@ -61,10 +47,9 @@ class OrderSerializer(serializers.ModelSerializer):
         if request and hasattr(request, 'user'):
             validated_data['created_by'] = request.user
         
-        # 生成订单号
-        validated_data['order_number'] = self.generate_order_number()
-        
         with transaction.atomic():
+            # 生成订单号（与订单在同一事务中发放，创建失败时序号一并回滚）
+            validated_data['order_number'] = self.generate_order_number()
             order = Order.objects.create(**validated_data)
             
             # 创建订单明细
@@ -1,3 +1,46 @@
+import datetime
+from decimal import Decimal
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from inventory.models import Product, ProductMovement
+from inventory.stock_ledger import PRODUCT_LEDGER
+
+from .models import Customer, Order, OrderItem
+
+
+class OrderStatusMovementTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(code='P001', name='冰刀', unit='双')
+        customer = Customer.objects.create(code='C001', name='冰场')
+        self.order = Order.objects.create(
+            order_number='SO001', customer=customer, order_date=datetime.date(2025, 1, 1),
+            delivery_date=datetime.date(2025, 2, 1), customer_order_number='K001',
+            created_by=User.objects.create_user('operator'), status='processing')
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=Decimal('5'), unit='双')
+
+    def _set_status(self, status):
+        self.order.status = status
+        self.order.save()
+        self.product.refresh_from_db()
+
+    def test_status_changes_post_stock_once(self):
+        self._set_status('completed')
+        self.assertEqual(self.product.stock, Decimal('5'))
+
+        self._set_status('shipped')
+        self.assertEqual(self.product.stock, Decimal('0'))
+
+        # 从已发货回退到已完成：撤销出库记录
+        self._set_status('completed')
+        self.assertEqual(self.product.stock, Decimal('5'))
+        self.assertEqual(
+            list(ProductMovement.objects.values_list('reason', flat=True)), ['production_receipt'])
+        self.assertEqual(list(PRODUCT_LEDGER.find_drift()), [])
+
+        # 从已完成回退到生产中：撤销入库记录
+        self._set_status('processing')
+        self.assertEqual(self.product.stock, Decimal('0'))
+        self.assertFalse(ProductMovement.objects.exists())
+        self.assertEqual(list(PRODUCT_LEDGER.find_drift()), [])
@@ -10,12 +10,17 @@ from .models import (
     ProductionMaterial,
     ProcessStep,
     ProcessSchedule,
-    Equipment
+    Equipment,
+    BatchLineage,
+    MaterialPlan
 )
 from inventory.models import (  # 从 inventory 导入产品相关的模型
     Product,
     ProductMovement
 )
+from inventory.bom import create_bom_requirements
+from inventory.sequences import PRODUCTION_ORDER, reserve_document_numbers
+from django.db import transaction
 from django.utils import timezone
 from decimal import Decimal
 from django.core.exceptions import ValidationError
@@ -435,7 +440,6 @@ class ProductionOrderAdmin(admin.ModelAdmin):
         """从销售订单创建生产单"""
         from orders.models import Order, OrderItem
         from django import forms
-        import uuid
         import traceback
         
         class CreateFromOrderForm(forms.Form):
@@ -472,29 +476,34 @@ class ProductionOrderAdmin(admin.ModelAdmin):
                 
                 try:
                     created_orders = []
-                    # 为每个订单项创建一个生产单
-                    for item in order_items:
-                        # 生成唯一的生产单号
-                        production_number = f"P{uuid.uuid4().hex[:8].upper()}"
-                        
-                        # 创建生产单
-                        production_order = ProductionOrder.objects.create(
-                            order_number=production_number,
-                            sales_order=order,
-                            product=item.product,
-                            planned_quantity=item.quantity,
-                            notes=f"从销售订单 {order.order_number} 自动创建"
-                        )
-                        created_orders.append(production_order)
+                    with transaction.atomic():
+                        # 一次预留全部生产单号，与生产单在同一事务中发放
+                        production_numbers = reserve_document_numbers(PRODUCTION_ORDER, len(order_items))
+
+                        # 为每个订单项创建一个生产单
+                        for item, production_number in zip(order_items, production_numbers):
+                            # 创建生产单
+                            production_order = ProductionOrder.objects.create(
+                                order_number=production_number,
+                                sales_order=order,
+                                product=item.product,
+                                planned_quantity=item.quantity,
+                                notes=f"从销售订单 {order.order_number} 自动创建"
+                            )
+                            created_orders.append(production_order)
+                            
+                            if not skip_process_schedule:
+                                try:
+                                    # 计算工序排程（失败时只回滚该生产单的排程）
+                                    with transaction.atomic():
+                                        production_order.calculate_process_schedules()
+                                except Exception as e:
+                                    # 如果计算工序排程失败，记录错误但不删除生产单
+                                    error_msg = f"生产单 {production_number} 计算工序排程失败：{str(e)}"
+                                    self.message_user(request, error_msg, level='WARNING')
                         
-                        if not skip_process_schedule:
-                            try:
-                                # 计算工序排程
-                                production_order.calculate_process_schedules()
-                            except Exception as e:
-                                # 如果计算工序排程失败，记录错误但不删除生产单
-                                error_msg = f"生产单 {production_number} 计算工序排程失败：{str(e)}"
-                                self.message_user(request, error_msg, level='WARNING')
+                        # 按产品物料清单为新生产单批量建立材料需求
+                        create_bom_requirements(created_orders)
                     
                     # 更新订单状态为生产中
                     if order.status == 'pending':
@@ -608,6 +617,26 @@ class ProductionMaterialAdmin(admin.ModelAdmin):
     search_fields = ['production_order__order_number', 
                     'material_batch__batch_number']
 
+@admin.register(BatchLineage)
+class BatchLineageAdmin(admin.ModelAdmin):
+    list_display = ['batch_number', 'material', 'supplier', 'production_order', 'sales_order', 'customer', 'quantity']
+    list_filter = ['supplier', 'customer']
+    search_fields = ['batch_number', 'production_order__order_number', 'sales_order__order_number']
+    list_select_related = ['material', 'supplier', 'production_order', 'sales_order', 'customer']
+
+    def has_add_permission(self, request):
+        # 追溯记录由领料自动维护
+        return False
+
+@admin.register(MaterialPlan)
+class MaterialPlanAdmin(admin.ModelAdmin):
+    list_display = ['plan_date', 'order_count', 'line_count', 'shortage_count', 'unplanned_line_count', 'created_by', 'created_at']
+    list_filter = ['plan_date']
+
+    def has_add_permission(self, request):
+        # 计划由物料需求计划运行生成
+        return False
+
 @admin.register(ProcessStep)
 class ProcessStepAdmin(admin.ModelAdmin):
     list_display = ['name', 'code', 'daily_capacity', 'is_bottleneck', 'sequence']
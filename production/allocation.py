@@ -0,0 +1,268 @@
+"""
+生产领料分配模块：按先进先出原则把材料需求分配到批次
+"""
+import hashlib
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Any, List
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from inventory.models import (
+    MaterialBatch,
+    MaterialMovement,
+    batch_versions,
+    deduct_batch_quantities,
+    post_material_stocks,
+)
+from inventory.reservations import refresh_material_reserved
+
+from .lineage import record_lineage
+from .models import MaterialRequirement, ProductionMaterial
+
+BULK_CREATE_BATCH_SIZE = 500
+PREVIEW_CACHE_TIMEOUT = 60 * 60
+NO_REQUIREMENTS_MESSAGE = '未设置物料清单，无法领料'
+
+
+def load_candidate_batches(material_ids, lock=False) -> Dict[int, List[MaterialBatch]]:
+    """
+    一次查询读取所有材料的可用批次，按材料分组并按生产日期先进先出排序
+
+    lock=True 时对候选批次加行锁（select_for_update），用于实际领料。
+    """
+    batches = MaterialBatch.objects.filter(
+        material_id__in=set(material_ids),
+        status='normal',
+        remaining_quantity__gt=0,
+    ).order_by('material_id', 'production_date', 'pk')
+    if lock:
+        batches = batches.select_for_update()
+
+    by_material = defaultdict(list)
+    for batch in batches:
+        by_material[batch.material_id].append(batch)
+    return by_material
+
+
+def batch_locations(batch_ids) -> Dict[int, str]:
+    """批次所在的库位（取批次入库记录的库位），一次查询；没有入库记录的批次在默认库位"""
+    rows = MaterialMovement.objects.filter(
+        batch_id__in=set(batch_ids), movement_type='in'
+    ).values_list('batch_id', 'location')
+    return dict(rows)
+
+
+def plan_fifo_allocation(requirements, batches_by_material) -> Dict[str, Any]:
+    """
+    在内存中计算先进先出的批次分配，不访问数据库
+
+    Args:
+        requirements: 材料需求列表（需已加载 material）
+        batches_by_material: load_candidate_batches 的结果
+
+    Returns:
+        Dict: allocations 为 (需求, 批次, 数量) 列表，shortfalls 为未满足的需求
+    """
+    allocations = []
+    shortfalls = []
+    # 同一批次可能被多条需求共用，按剩余量在内存中扣减
+    available = {
+        batch.pk: batch.remaining_quantity
+        for batches in batches_by_material.values() for batch in batches
+    }
+
+    for requirement in requirements:
+        candidates = batches_by_material.get(requirement.material_id, [])
+        remaining_quantity = requirement.required_quantity
+
+        for batch in candidates:
+            if remaining_quantity <= 0:
+                break
+            quantity_from_batch = min(available[batch.pk], remaining_quantity)
+            if quantity_from_batch <= 0:
+                continue
+            allocations.append((requirement, batch, quantity_from_batch))
+            available[batch.pk] -= quantity_from_batch
+            remaining_quantity -= quantity_from_batch
+
+        if remaining_quantity > 0:
+            shortfalls.append({
+                'requirement': requirement,
+                'has_batches': bool(candidates),
+                'shortfall': remaining_quantity,
+            })
+
+    return {'allocations': allocations, 'shortfalls': shortfalls}
+
+
+def stock_shortage_message(requirement) -> str:
+    """材料总库存不足的提示"""
+    return (
+        f'材料 {requirement.material.name} 库存不足，'
+        f'需要 {requirement.required_quantity}，'
+        f'当前库存 {requirement.material.stock}'
+    )
+
+
+def shortfall_message(shortfall) -> str:
+    """与逐批领料时一致的缺料提示"""
+    material = shortfall['requirement'].material
+    if not shortfall['has_batches']:
+        return f'材料 {material.name} 没有可用批次'
+    return f"材料 {material.name} 可用批次库存不足，还需要 {shortfall['shortfall']}"
+
+
+def issue_materials(production_order):
+    """
+    按物料清单为生产单领料
+
+    一次查询锁定全部候选批次并在内存中计算分配，然后按批次所在库位每个（材料, 库位）过账一次库存、
+    所有批次用一条UPDATE扣减剩余数量，变动记录和用料记录批量写入。
+    """
+    requirements = list(production_order.material_requirements.select_related('material').order_by('pk'))
+    if not requirements:
+        raise ValidationError(NO_REQUIREMENTS_MESSAGE)
+
+    for requirement in requirements:
+        if requirement.material.stock < requirement.required_quantity:
+            raise ValidationError(stock_shortage_message(requirement))
+
+    with transaction.atomic():
+        batches_by_material = load_candidate_batches(
+            [requirement.material_id for requirement in requirements], lock=True)
+        plan = plan_fifo_allocation(requirements, batches_by_material)
+        if plan['shortfalls']:
+            raise ValidationError(shortfall_message(plan['shortfalls'][0]))
+
+        locations = batch_locations(batch.pk for _, batch, _ in plan['allocations'])
+        location_outgoing = defaultdict(Decimal)
+        batch_outgoing = defaultdict(Decimal)
+        movements = []
+        materials_used = []
+        for requirement, batch, quantity in plan['allocations']:
+            location = locations.get(batch.pk, '')
+            location_outgoing[(requirement.material_id, location)] += quantity
+            batch_outgoing[batch.pk] += quantity
+            movements.append(MaterialMovement(
+                material=requirement.material,
+                movement_type='out',
+                quantity=quantity,
+                unit=requirement.material.unit,
+                reference_number=production_order.order_number,
+                source_type='production_order',
+                source_id=production_order.pk,
+                reason='production_issue',
+                notes=f'生产领料：{production_order.order_number}',
+                batch=batch,
+                location=location,
+            ))
+            materials_used.append(ProductionMaterial(
+                production_order=production_order,
+                material_batch=batch,
+                quantity_used=quantity,
+            ))
+
+        # 从批次入库的库位出库，每个（材料, 库位）只过账一次库存
+        post_material_stocks({key: -quantity for key, quantity in location_outgoing.items()})
+
+        deduct_batch_quantities(batch_outgoing, {material_id for material_id, _ in location_outgoing})
+
+        # 变动记录的库存过账已在上面完成，这里直接批量写入
+        MaterialMovement.objects.bulk_create(movements, batch_size=BULK_CREATE_BATCH_SIZE)
+        ProductionMaterial.objects.bulk_create(materials_used, batch_size=BULK_CREATE_BATCH_SIZE)
+        record_lineage(materials_used)
+
+        # 记录实际领用数量
+        for requirement in requirements:
+            requirement.actual_quantity = requirement.required_quantity
+        MaterialRequirement.objects.bulk_update(requirements, ['actual_quantity'])
+        refresh_material_reserved([requirement.material_id for requirement in requirements])
+
+    return plan
+
+
+def _preview_cache_key(production_order, requirements):
+    """预览结果的缓存键：需求、材料库存和批次版本号任一变化都会得到新的键"""
+    versions = batch_versions(requirement.material_id for requirement in requirements)
+    fingerprint = '|'.join(
+        f'{requirement.material_id}:{requirement.required_quantity}:'
+        f'{requirement.material.stock}:{versions[requirement.material_id]}'
+        for requirement in requirements
+    )
+    digest = hashlib.md5(fingerprint.encode()).hexdigest()
+    return f'production:allocation_preview:{production_order.pk}:{digest}'
+
+
+def preview_allocation(production_order) -> Dict[str, Any]:
+    """
+    预览开始生产时的先进先出领料分配，不写入任何数据
+
+    与 issue_materials 使用同一分配逻辑；查询数固定（需求、批次版本号、批次各一次），
+    结果按批次版本号缓存，涉及材料的任一批次变化（包括其他进程中的管理命令）后自动失效。
+    """
+    requirements = list(production_order.material_requirements.select_related('material').order_by('pk'))
+    cache_key = _preview_cache_key(production_order, requirements)
+    result = cache.get(cache_key)
+    if result is not None:
+        return {**result, 'cached': True}
+
+    plan = plan_fifo_allocation(
+        requirements,
+        load_candidate_batches([requirement.material_id for requirement in requirements]),
+    )
+
+    allocations = [
+        {
+            'material_id': requirement.material_id,
+            'material_code': requirement.material.code,
+            'material_name': requirement.material.name,
+            'batch_id': batch.pk,
+            'batch_number': batch.batch_number,
+            'production_date': str(batch.production_date),
+            'batch_remaining': float(batch.remaining_quantity),
+            'quantity': float(quantity),
+        }
+        for requirement, batch, quantity in plan['allocations']
+    ]
+
+    batch_shortfalls = {shortfall['requirement'].pk: shortfall for shortfall in plan['shortfalls']}
+    shortfalls = []
+    for requirement in requirements:
+        messages = []
+        if requirement.material.stock < requirement.required_quantity:
+            messages.append(stock_shortage_message(requirement))
+        if requirement.pk in batch_shortfalls:
+            messages.append(shortfall_message(batch_shortfalls[requirement.pk]))
+        if messages:
+            shortfall = batch_shortfalls.get(requirement.pk)
+            shortfalls.append({
+                'material_id': requirement.material_id,
+                'material_code': requirement.material.code,
+                'material_name': requirement.material.name,
+                'required_quantity': float(requirement.required_quantity),
+                'stock': float(requirement.material.stock),
+                'batch_shortfall': float(shortfall['shortfall']) if shortfall else 0.0,
+                'messages': messages,
+            })
+
+    # 没有物料清单时开始生产会在领料时失败，预览同样不允许开始
+    errors = [] if requirements else [NO_REQUIREMENTS_MESSAGE]
+
+    result = {
+        'production_order': production_order.pk,
+        'order_number': production_order.order_number,
+        'can_start': not shortfalls and not errors,
+        'errors': errors,
+        'allocations': allocations,
+        'shortfalls': shortfalls,
+        'summary': {
+            'requirement_count': len(requirements),
+            'batch_count': len({allocation['batch_id'] for allocation in allocations}),
+            'shortfall_count': len(shortfalls),
+        },
+    }
+    cache.set(cache_key, result, PREVIEW_CACHE_TIMEOUT)
+    return {**result, 'cached': False}
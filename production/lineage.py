@@ -0,0 +1,112 @@
+"""
+批次追溯模块：维护生产用料的追溯记录，提供正向与反向追溯查询
+"""
+from typing import Dict, Any, List
+
+from django.db.models import Sum
+
+from inventory.models import MaterialBatch
+
+from .models import BatchLineage, ProductionOrder
+
+BULK_CREATE_BATCH_SIZE = 500
+
+
+def record_lineage(materials_used) -> List[BatchLineage]:
+    """
+    为已保存的生产用料记录批量写入追溯记录
+
+    批次（含采购单）和生产单（含销售订单）各查询一次。
+    """
+    materials_used = list(materials_used)
+    if not materials_used:
+        return []
+
+    batches = MaterialBatch.objects.select_related('purchase').in_bulk(
+        {used.material_batch_id for used in materials_used})
+    production_orders = ProductionOrder.objects.select_related('sales_order').in_bulk(
+        {used.production_order_id for used in materials_used})
+
+    lineage = []
+    for used in materials_used:
+        batch = batches[used.material_batch_id]
+        production_order = production_orders[used.production_order_id]
+        sales_order = production_order.sales_order
+        lineage.append(BatchLineage(
+            production_material=used,
+            material_batch=batch,
+            batch_number=batch.batch_number,
+            material_id=batch.material_id,
+            purchase_id=batch.purchase_id,
+            supplier_id=batch.purchase.supplier_id,
+            production_order=production_order,
+            sales_order=sales_order,
+            customer_id=sales_order.customer_id if sales_order else None,
+            quantity=used.quantity_used,
+        ))
+    return BatchLineage.objects.bulk_create(lineage, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def forward_trace(batch_id=None, supplier_id=None, batch_number=None) -> List[Dict[str, Any]]:
+    """
+    正向追溯：某批次（或某供应商的某批次号）用于哪些生产单和客户订单
+
+    按批次ID或（供应商, 批次号）走索引，一次分组查询返回结果。
+    """
+    lineage = BatchLineage.objects.all()
+    if batch_id is not None:
+        lineage = lineage.filter(material_batch_id=batch_id)
+    else:
+        lineage = lineage.filter(supplier_id=supplier_id, batch_number=batch_number)
+
+    rows = lineage.values(
+        'material_batch_id', 'batch_number',
+        'production_order_id', 'production_order__order_number',
+        'sales_order_id', 'sales_order__order_number',
+        'customer_id', 'customer__name',
+    ).annotate(quantity=Sum('quantity')).order_by('production_order_id')
+
+    return [
+        {
+            'batch_id': row['material_batch_id'],
+            'batch_number': row['batch_number'],
+            'production_order_id': row['production_order_id'],
+            'production_order_number': row['production_order__order_number'],
+            'sales_order_id': row['sales_order_id'],
+            'sales_order_number': row['sales_order__order_number'],
+            'customer_id': row['customer_id'],
+            'customer_name': row['customer__name'],
+            'quantity': float(row['quantity']),
+        }
+        for row in rows
+    ]
+
+
+def backward_trace(sales_order_id) -> List[Dict[str, Any]]:
+    """
+    反向追溯：某销售订单用到了哪些供应商的哪些批次
+
+    按销售订单走索引，一次分组查询返回结果。
+    """
+    rows = BatchLineage.objects.filter(sales_order_id=sales_order_id).values(
+        'material_batch_id', 'batch_number',
+        'material_id', 'material__code', 'material__name',
+        'purchase_id', 'purchase__purchase_number',
+        'supplier_id', 'supplier__name',
+    ).annotate(quantity=Sum('quantity')).order_by('material_batch_id')
+
+    return [
+        {
+            'batch_id': row['material_batch_id'],
+            'batch_number': row['batch_number'],
+            'material_id': row['material_id'],
+            'material_code': row['material__code'],
+            'material_name': row['material__name'],
+            'purchase_id': row['purchase_id'],
+            'purchase_number': row['purchase__purchase_number'],
+            'supplier_id': row['supplier_id'],
+            'supplier_name': row['supplier__name'],
+            'quantity': float(row['quantity']),
+        }
+        for row in rows
+    ]
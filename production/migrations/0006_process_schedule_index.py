@@ -0,0 +1,25 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:43
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('production', '0005_alter_productionorder_sales_order'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productionprogress',
+            name='actual_efficiency',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), help_text='实际完成数量/计划数量的百分比', max_digits=5, verbose_name='实际效率'),
+        ),
+        migrations.AddIndex(
+            model_name='processschedule',
+            index=models.Index(fields=['process', 'planned_start_time'], name='processsched_process_start_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0016_live_batch_index'),
+        ('orders', '0001_initial'),
+        ('production', '0006_process_schedule_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchLineage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_number', models.CharField(max_length=50, verbose_name='批次号')),
+                ('quantity', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='使用数量')),
+                ('customer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='orders.customer', verbose_name='客户')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.material', verbose_name='材料')),
+                ('material_batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lineage', to='inventory.materialbatch', verbose_name='材料批次')),
+                ('production_material', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='lineage', to='production.productionmaterial', verbose_name='生产用料')),
+                ('production_order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lineage', to='production.productionorder', verbose_name='生产单')),
+                ('purchase', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.materialpurchase', verbose_name='采购单')),
+                ('sales_order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='orders.order', verbose_name='销售订单')),
+                ('supplier', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.supplier', verbose_name='供应商')),
+            ],
+            options={
+                'verbose_name': '批次追溯',
+                'verbose_name_plural': '批次追溯',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['material_batch', 'production_order'], name='lineage_batch_idx'), models.Index(fields=['supplier', 'batch_number'], name='lineage_supplier_batch_idx'), models.Index(fields=['sales_order', 'material_batch'], name='lineage_sales_order_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def backfill_batch_lineage(apps, schema_editor):
+    """为已有的生产用料记录生成追溯记录"""
+    ProductionMaterial = apps.get_model('production', 'ProductionMaterial')
+    BatchLineage = apps.get_model('production', 'BatchLineage')
+
+    materials_used = ProductionMaterial.objects.filter(lineage__isnull=True).select_related(
+        'material_batch__purchase', 'production_order__sales_order')
+
+    pending = []
+    for used in materials_used.iterator(chunk_size=BATCH_SIZE):
+        batch = used.material_batch
+        sales_order = used.production_order.sales_order
+        pending.append(BatchLineage(
+            production_material_id=used.pk,
+            material_batch_id=batch.pk,
+            batch_number=batch.batch_number,
+            material_id=batch.material_id,
+            purchase_id=batch.purchase_id,
+            supplier_id=batch.purchase.supplier_id,
+            production_order_id=used.production_order_id,
+            sales_order_id=sales_order.pk if sales_order else None,
+            customer_id=sales_order.customer_id if sales_order else None,
+            quantity=used.quantity_used,
+        ))
+        if len(pending) >= BATCH_SIZE:
+            BatchLineage.objects.bulk_create(pending)
+            pending = []
+
+    if pending:
+        BatchLineage.objects.bulk_create(pending)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('production', '0007_batch_lineage'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_batch_lineage, migrations.RunPython.noop),
+    ]
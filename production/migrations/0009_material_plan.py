@@ -0,0 +1,59 @@
+# Generated by Django 5.1.6 on 2026-10-18 07:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0019_seed_document_sequence'),
+        ('orders', '0001_initial'),
+        ('production', '0008_backfill_batch_lineage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterialPlan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('plan_date', models.DateField(verbose_name='计划日期')),
+                ('order_count', models.PositiveIntegerField(default=0, verbose_name='销售订单数')),
+                ('line_count', models.PositiveIntegerField(default=0, verbose_name='明细数')),
+                ('shortage_count', models.PositiveIntegerField(default=0, verbose_name='缺料明细数')),
+                ('unplanned_line_count', models.PositiveIntegerField(default=0, verbose_name='未建生产单的订单明细数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='创建人')),
+            ],
+            options={
+                'verbose_name': '物料需求计划',
+                'verbose_name_plural': '物料需求计划',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MaterialPlanLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_date', models.DateField(verbose_name='需求日期')),
+                ('gross_quantity', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='毛需求')),
+                ('issued_quantity', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='已领用')),
+                ('open_quantity', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='未领用需求')),
+                ('available_quantity', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='可用量')),
+                ('shortage_quantity', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='净需求')),
+                ('projected_balance', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='预计结存')),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.material', verbose_name='材料')),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='production.materialplan', verbose_name='物料需求计划')),
+                ('production_order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='production.productionorder', verbose_name='生产单')),
+                ('sales_order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='orders.order', verbose_name='销售订单')),
+            ],
+            options={
+                'verbose_name': '物料需求计划明细',
+                'verbose_name_plural': '物料需求计划明细',
+                'ordering': ['material', 'due_date', 'id'],
+                'indexes': [models.Index(fields=['plan', 'material', 'due_date'], name='planline_material_due_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.6 on 2026-10-18 07:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0023_cache_version'),
+        ('production', '0009_material_plan'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='batchlineage',
+            name='material',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='inventory.material', verbose_name='材料'),
+        ),
+        migrations.AlterField(
+            model_name='batchlineage',
+            name='material_batch',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='lineage', to='inventory.materialbatch', verbose_name='材料批次'),
+        ),
+        migrations.AlterField(
+            model_name='batchlineage',
+            name='production_order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='lineage', to='production.productionorder', verbose_name='生产单'),
+        ),
+        migrations.AlterField(
+            model_name='batchlineage',
+            name='purchase',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='inventory.materialpurchase', verbose_name='采购单'),
+        ),
+        migrations.AlterField(
+            model_name='batchlineage',
+            name='supplier',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='inventory.supplier', verbose_name='供应商'),
+        ),
+    ]
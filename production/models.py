@@ -3,7 +3,7 @@ from django.core.exceptions import ValidationError
 from django.db import transaction
 from decimal import Decimal
 from django.utils import timezone
-from inventory.models import Material, MaterialMovement, ProductMovement
+from inventory.models import ProductMovement
 from datetime import timedelta
 from django.urls import reverse
 from django.db.models import Sum
@@ -270,74 +270,13 @@ class ProductionOrder(models.Model):
             raise ValidationError(f'完成生产操作失败：{str(e)}')
 
     def consume_materials(self):
-        """领用生产材料"""
-        material_requirements = self.material_requirements.all()
-        
-        if not material_requirements.exists():
-            raise ValidationError('未设置物料清单，无法领料')
+        """领用生产材料（按先进先出原则从批次批量领料）"""
+        from .allocation import issue_materials
 
         try:
-            with transaction.atomic():  # type: ignore
-                for requirement in material_requirements:
-                    # 检查库存是否足够
-                    if requirement.material.stock < requirement.required_quantity:
-                        raise ValidationError(
-                            f'材料 {requirement.material.name} 库存不足，'
-                            f'需要 {requirement.required_quantity}，'
-                            f'当前库存 {requirement.material.stock}'
-                        )
-
-                    # 获取可用的材料批次，按先进先出原则排序
-                    available_batches = requirement.material.batches.filter(
-                        remaining_quantity__gt=0,
-                        status='normal'
-                    ).order_by('production_date')
-                    
-                    if not available_batches.exists():
-                        raise ValidationError(f'材料 {requirement.material.name} 没有可用批次')
-                    
-                    remaining_quantity = requirement.required_quantity
-                    
-                    # 从多个批次中领料
-                    for batch in available_batches:
-                        if remaining_quantity <= 0:
-                            break
-                            
-                        # 确定从当前批次领用的数量
-                        quantity_from_batch = min(batch.remaining_quantity, remaining_quantity)
-                        
-                        # 创建材料出库记录，关联批次
-                        MaterialMovement.objects.create(
-                            material=requirement.material,
-                            movement_type='out',
-                            quantity=quantity_from_batch,
-                            unit=requirement.material.unit,
-                            reference_number=self.order_number,
-                            notes=f'生产领料：{self.order_number}',
-                            batch=batch  # 关联批次
-                        )
-                        
-                        # 创建生产用料记录
-                        ProductionMaterial.objects.create(
-                            production_order=self,
-                            material_batch=batch,
-                            quantity_used=quantity_from_batch
-                        )
-                        
-                        # 更新剩余需求量
-                        remaining_quantity -= quantity_from_batch
-                    
-                    # 如果仍有未满足的需求量，抛出异常
-                    if remaining_quantity > 0:
-                        raise ValidationError(
-                            f'材料 {requirement.material.name} 可用批次库存不足，'
-                            f'还需要 {remaining_quantity}'
-                        )
-
-                    # 记录实际领用数量
-                    requirement.actual_quantity = requirement.required_quantity
-                    requirement.save()
-
+            issue_materials(self)
+        except ValidationError as e:
+            raise ValidationError(f'领料失败：{e.messages[0]}')
         except Exception as e:
             raise ValidationError(f'领料失败：{str(e)}')
 
@@ -376,6 +315,9 @@ class ProductionOrder(models.Model):
                     quantity=self.completed_quantity,
                     unit=self.product.unit,  # type: ignore
                     reference_number=self.order_number,
+                    source_type='production_order',
+                    source_id=self.pk,
+                    reason='production_reversal',
                     notes=f'撤销生产完成 - 生产单号：{self.order_number}'
                 )
                 # ProductMovement 的 save 方法会自动更新产品库存
@@ -478,6 +420,11 @@ class MaterialRequirement(models.Model):
     )
     notes = models.TextField(blank=True, verbose_name='备注')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 保存原始材料，更换材料时原材料的预留库存也要重新汇总（延迟加载的字段不触发查询）
+        self._original_material_id = self.__dict__.get('material_id')
+
     def __str__(self):
         return f"{self.production_order.order_number} - {self.material.name}"  # type: ignore
 
@@ -636,6 +583,165 @@ class ProductionMaterial(models.Model):
         verbose_name = '生产用料'
         verbose_name_plural = '生产用料'
 
+class BatchLineage(models.Model):
+    """
+    批次追溯（每条生产用料记录一行）
+
+    冗余保存供应商、采购单、生产单、销售订单和客户，正向（批次→客户订单）
+    和反向（销售订单→供应商批次）追溯都只需一次按索引的查询。
+    追溯记录随生产用料记录一起删除；被追溯的批次、材料、采购单、供应商和生产单不能删除。
+    """
+    objects = models.Manager()  # 显式声明管理器
+    production_material = models.OneToOneField(
+        ProductionMaterial,
+        on_delete=models.CASCADE,
+        related_name='lineage',
+        verbose_name='生产用料'
+    )
+    material_batch = models.ForeignKey(
+        'inventory.MaterialBatch',
+        on_delete=models.PROTECT,
+        related_name='lineage',
+        verbose_name='材料批次'
+    )
+    batch_number = models.CharField(max_length=50, verbose_name='批次号')
+    material = models.ForeignKey(
+        'inventory.Material',
+        on_delete=models.PROTECT,
+        related_name='+',
+        verbose_name='材料'
+    )
+    purchase = models.ForeignKey(
+        'inventory.MaterialPurchase',
+        on_delete=models.PROTECT,
+        related_name='+',
+        verbose_name='采购单'
+    )
+    supplier = models.ForeignKey(
+        'inventory.Supplier',
+        on_delete=models.PROTECT,
+        related_name='+',
+        verbose_name='供应商'
+    )
+    production_order = models.ForeignKey(
+        ProductionOrder,
+        on_delete=models.PROTECT,
+        related_name='lineage',
+        verbose_name='生产单'
+    )
+    sales_order = models.ForeignKey(
+        'orders.Order',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='销售订单'
+    )
+    customer = models.ForeignKey(
+        'orders.Customer',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='客户'
+    )
+    quantity = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='使用数量')
+
+    def __str__(self):
+        return f"{self.batch_number} → {self.production_order.order_number}"  # type: ignore
+
+    class Meta:
+        verbose_name = '批次追溯'
+        verbose_name_plural = '批次追溯'
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['material_batch', 'production_order'], name='lineage_batch_idx'),
+            models.Index(fields=['supplier', 'batch_number'], name='lineage_supplier_batch_idx'),
+            models.Index(fields=['sales_order', 'material_batch'], name='lineage_sales_order_idx'),
+        ]
+
+class MaterialPlan(models.Model):
+    """
+    物料需求计划运行记录
+
+    每次运行对全部未完成销售订单做一次净需求计算，结果保存在计划明细中。
+    """
+    objects = models.Manager()  # 显式声明管理器
+    plan_date = models.DateField(verbose_name='计划日期')
+    order_count = models.PositiveIntegerField(default=0, verbose_name='销售订单数')
+    line_count = models.PositiveIntegerField(default=0, verbose_name='明细数')
+    shortage_count = models.PositiveIntegerField(default=0, verbose_name='缺料明细数')
+    unplanned_line_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='未建生产单的订单明细数'
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    created_by = models.ForeignKey(
+        'auth.User',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name='创建人'
+    )
+
+    def __str__(self):
+        return f"物料需求计划 {self.plan_date} ({self.created_at:%Y-%m-%d %H:%M})"
+
+    class Meta:
+        verbose_name = '物料需求计划'
+        verbose_name_plural = '物料需求计划'
+        ordering = ['-created_at']
+
+class MaterialPlanLine(models.Model):
+    """物料需求计划明细（每条未领完的材料需求、未建生产单订单明细的每种材料各一行，按交货日期分期）"""
+    objects = models.Manager()  # 显式声明管理器
+    plan = models.ForeignKey(
+        MaterialPlan,
+        on_delete=models.CASCADE,
+        related_name='lines',
+        verbose_name='物料需求计划'
+    )
+    material = models.ForeignKey(
+        'inventory.Material',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='材料'
+    )
+    sales_order = models.ForeignKey(
+        'orders.Order',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='销售订单'
+    )
+    production_order = models.ForeignKey(
+        ProductionOrder,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='生产单'
+    )
+    due_date = models.DateField(verbose_name='需求日期')
+    gross_quantity = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='毛需求')
+    issued_quantity = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='已领用')
+    open_quantity = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='未领用需求')
+    available_quantity = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='可用量')
+    shortage_quantity = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='净需求')
+    projected_balance = models.DecimalField(max_digits=12, decimal_places=2, verbose_name='预计结存')
+
+    def __str__(self):
+        return f"{self.material} - {self.due_date} - {self.shortage_quantity}"
+
+    class Meta:
+        verbose_name = '物料需求计划明细'
+        verbose_name_plural = '物料需求计划明细'
+        ordering = ['material', 'due_date', 'id']
+        indexes = [
+            models.Index(fields=['plan', 'material', 'due_date'], name='planline_material_due_idx'),
+        ]
+
 class ProcessStep(models.Model):
     """工序步骤"""
     objects = models.Manager()  # 显式声明管理器
@@ -701,4 +807,7 @@ class ProcessSchedule(models.Model):
     class Meta:
         ordering = ['planned_start_time']
         verbose_name = '工序排程'
-        verbose_name_plural = '工序排程'
\ No newline at end of file
+        verbose_name_plural = '工序排程'
+        indexes = [
+            models.Index(fields=['process', 'planned_start_time'], name='processsched_process_start_idx'),
+        ]
\ No newline at end of file
@@ -0,0 +1,211 @@
+"""
+物料需求计划模块：对全部未完成销售订单做一次按交货日期分期的净需求计算
+
+毛需求取自这些订单的生产单材料需求，扣除已领料（生产用料）后按交货日期排序，
+依次用材料库存和按交货日期到货的待入库采购单抵扣，抵扣不足的部分即为净需求（缺料）。
+尚未建生产单的订单明细按物料清单展开后一并参与抵扣。
+不属于本次计划的未完成生产单的未领用需求先从库存中扣除。
+"""
+from collections import defaultdict
+from decimal import Decimal, ROUND_UP
+from typing import Dict, Any, List
+
+from django.db import models, transaction
+from django.db.models import Exists, Min, OuterRef, Sum
+from django.utils import timezone
+
+from inventory.bom import REQUIREMENT_QUANTUM, flatten_boms
+from inventory.receiving import OPEN_QUANTITY
+from inventory.models import Material, PurchaseItem
+from orders.models import Order, OrderItem
+
+from .models import (
+    MaterialPlan,
+    MaterialPlanLine,
+    MaterialRequirement,
+    ProductionMaterial,
+    ProductionOrder,
+)
+
+BULK_CREATE_BATCH_SIZE = 500
+
+# 参与计划的销售订单状态
+PLANNED_ORDER_STATUSES = ['pending', 'processing']
+
+_ZERO = Decimal('0')
+
+
+def _issued_quantities(production_order_ids) -> Dict[tuple, Decimal]:
+    """各（生产单, 材料）已领用数量，一条分组查询"""
+    rows = ProductionMaterial.objects.filter(
+        production_order_id__in=production_order_ids
+    ).values('production_order_id', 'material_batch__material_id').annotate(
+        total=Sum('quantity_used')
+    ).values_list('production_order_id', 'material_batch__material_id', 'total')
+    return {(production_order_id, material_id): total for production_order_id, material_id, total in rows}
+
+
+def _scheduled_receipts(material_ids, as_of) -> Dict[int, List[tuple]]:
+    """待入库采购单按（材料, 交货日期）汇总的未入库数量；未填或已过交货日期的按计划日期到货"""
+    rows = PurchaseItem.objects.filter(
+        purchase__status='pending',
+        received_quantity__lt=models.F('quantity'),
+        material_id__in=material_ids,
+    ).values('material_id', 'purchase__delivery_date').annotate(
+        total=Sum(OPEN_QUANTITY, output_field=models.DecimalField(max_digits=12, decimal_places=2))
+    ).values_list('material_id', 'purchase__delivery_date', 'total')
+
+    receipts = defaultdict(lambda: defaultdict(Decimal))
+    for material_id, delivery_date, total in rows:
+        receipts[material_id][max(delivery_date or as_of, as_of)] += total
+    return {material_id: sorted(by_date.items()) for material_id, by_date in receipts.items()}
+
+
+def _unplanned_order_items() -> List[Dict[str, Any]]:
+    """未建生产单（因而没有材料需求）的销售订单明细，一条查询"""
+    production_orders = ProductionOrder.objects.filter(
+        sales_order=OuterRef('order'), product=OuterRef('product'))
+    return list(OrderItem.objects.filter(order__status__in=PLANNED_ORDER_STATUSES).filter(
+        ~Exists(production_orders)
+    ).values(
+        'order_id', 'order__order_number', 'order__delivery_date',
+        'product_id', 'product__code', 'product__name', 'product__unit_weight', 'quantity',
+    ).order_by('order__delivery_date', 'order_id', 'pk'))
+
+
+def run_material_plan(as_of=None, user=None) -> Dict[str, Any]:
+    """
+    运行一次物料需求计划并保存结果
+
+    材料需求、已领用数量、采购到货、订单数和未建生产单的订单明细各一次查询，
+    未建生产单的明细按物料清单展开（展开结果命中缓存），计划明细批量写入，查询数与订单数量无关。
+
+    Returns:
+        Dict: plan 为保存的计划，unplanned_lines 为未建生产单的销售订单明细，
+        其中 has_bom 为 False 的明细没有物料清单，未计入材料需求
+    """
+    as_of = as_of or timezone.localdate()
+
+    # 未完成生产单的全部材料需求；属于未完成销售订单的参与计划，其余只占用库存
+    requirements = list(
+        MaterialRequirement.objects.exclude(production_order__status='completed')
+        .select_related('material', 'production_order__sales_order')
+        .only(
+            'material_id', 'production_order_id', 'required_quantity',
+            'material__stock',
+            'production_order__sales_order_id',
+            'production_order__sales_order__status',
+            'production_order__sales_order__delivery_date',
+        )
+    )
+    issued = _issued_quantities({requirement.production_order_id for requirement in requirements})
+
+    # 需求为 (交货日期, 销售订单ID, 生产单ID, 毛需求, 已领用, 未领用)
+    demands = defaultdict(list)
+    committed = defaultdict(Decimal)
+    stock = {}
+    for requirement in requirements:
+        issued_quantity = issued.get((requirement.production_order_id, requirement.material_id), _ZERO)
+        open_quantity = max(requirement.required_quantity - issued_quantity, _ZERO)
+        stock[requirement.material_id] = requirement.material.stock
+        sales_order = requirement.production_order.sales_order
+        if sales_order is None or sales_order.status not in PLANNED_ORDER_STATUSES:
+            committed[requirement.material_id] += open_quantity
+            continue
+        if open_quantity > 0:
+            demands[requirement.material_id].append((
+                sales_order.delivery_date, sales_order.pk, requirement.production_order_id,
+                requirement.required_quantity, issued_quantity, open_quantity))
+
+    # 未建生产单的订单明细按物料清单展开，没有生产单也就没有已领用数量
+    unplanned_items = _unplanned_order_items()
+    boms = flatten_boms({item['product_id'] for item in unplanned_items})
+    for item in unplanned_items:
+        for material_id, per_unit in boms[item['product_id']].items():
+            quantity = (per_unit * item['quantity']).quantize(REQUIREMENT_QUANTUM, rounding=ROUND_UP)
+            demands[material_id].append((
+                item['order__delivery_date'], item['order_id'], None, quantity, _ZERO, quantity))
+    missing_stock = demands.keys() - stock.keys()
+    if missing_stock:
+        stock.update(Material.objects.filter(pk__in=missing_stock).values_list('pk', 'stock'))
+
+    receipts = _scheduled_receipts(demands.keys(), as_of)
+
+    lines = []
+    for material_id, material_demands in demands.items():
+        material_demands.sort(key=lambda demand: (demand[0], demand[1], demand[2] or 0))
+        pending_receipts = list(receipts.get(material_id, []))
+        balance = stock[material_id] - committed[material_id]
+        for due_date, sales_order_id, production_order_id, gross_quantity, issued_quantity, open_quantity \
+                in material_demands:
+            # 交货日期之前到货的采购计入可用量
+            while pending_receipts and pending_receipts[0][0] <= due_date:
+                balance += pending_receipts.pop(0)[1]
+            available = max(balance, _ZERO)
+            balance -= open_quantity
+            lines.append(MaterialPlanLine(
+                material_id=material_id,
+                sales_order_id=sales_order_id,
+                production_order_id=production_order_id,
+                due_date=due_date,
+                gross_quantity=gross_quantity,
+                issued_quantity=issued_quantity,
+                open_quantity=open_quantity,
+                available_quantity=available,
+                shortage_quantity=max(open_quantity - available, _ZERO),
+                projected_balance=balance,
+            ))
+
+    order_count = Order.objects.filter(status__in=PLANNED_ORDER_STATUSES).count()
+    unplanned_lines = [
+        {
+            'sales_order': item['order_id'],
+            'sales_order_number': item['order__order_number'],
+            'delivery_date': str(item['order__delivery_date']),
+            'product': item['product_id'],
+            'product_code': item['product__code'],
+            'product_name': item['product__name'],
+            'quantity': float(item['quantity']),
+            'estimated_weight': float(item['product__unit_weight'] * item['quantity']),
+            'has_bom': bool(boms[item['product_id']]),
+        }
+        for item in unplanned_items
+    ]
+
+    with transaction.atomic():
+        plan = MaterialPlan.objects.create(
+            plan_date=as_of,
+            order_count=order_count,
+            line_count=len(lines),
+            shortage_count=sum(1 for line in lines if line.shortage_quantity > 0),
+            unplanned_line_count=len(unplanned_lines),
+            created_by=user,
+        )
+        for line in lines:
+            line.plan = plan
+        MaterialPlanLine.objects.bulk_create(lines, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    return {'plan': plan, 'unplanned_lines': unplanned_lines}
+
+
+def material_shortages(plan) -> List[Dict[str, Any]]:
+    """按材料汇总计划的缺料：总净需求和最早缺料日期，一条分组查询"""
+    rows = plan.lines.filter(shortage_quantity__gt=0).values(
+        'material_id', 'material__code', 'material__name', 'material__unit',
+    ).annotate(
+        shortage=Sum('shortage_quantity'),
+        first_shortage_date=Min('due_date'),
+        open_quantity=Sum('open_quantity'),
+    ).order_by('first_shortage_date', 'material__code')
+    return [
+        {
+            'material': row['material_id'],
+            'material_code': row['material__code'],
+            'material_name': row['material__name'],
+            'unit': row['material__unit'],
+            'open_quantity': float(row['open_quantity']),
+            'shortage': float(row['shortage']),
+            'first_shortage_date': str(row['first_shortage_date']),
+        }
+        for row in rows
+    ]
@@ -6,10 +6,16 @@ from .models import (
     ProductionMaterial,
     MaterialRequirement,
     ProductionProgress,
-    Equipment
+    Equipment,
+    BatchLineage,
+    MaterialPlan,
+    MaterialPlanLine
 )
+from django.db import transaction
+
+from inventory.bom import create_bom_requirements
 from inventory.models import Product
-from datetime import datetime
+from inventory.sequences import PRODUCTION_ORDER, next_document_number
 
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
@@ -88,42 +94,34 @@ class ProductionOrderSerializer(serializers.ModelSerializer):
         # 提取材料需求数据
         material_requirements_data = validated_data.pop('material_requirements_data', [])
         
-        # 自动生成生产订单号
-        if not validated_data.get('order_number'):
-            today = datetime.now().strftime('%Y%m%d')
-            # 获取当天的最大序号
-            latest_order = ProductionOrder.objects.filter(
-                order_number__startswith=f'PO{today}'
-            ).order_by('-order_number').first()
+        with transaction.atomic():
+            # 自动生成生产订单号（与生产单在同一事务中发放，创建失败时序号一并回滚）
+            if not validated_data.get('order_number'):
+                validated_data['order_number'] = next_document_number(PRODUCTION_ORDER)
             
-            if latest_order:
-                # 提取序号并加1
-                sequence = int(latest_order.order_number[-2:]) + 1
-            else:
-                sequence = 1
+            # 创建生产订单
+            production_order = super().create(validated_data)
             
-            validated_data['order_number'] = f'PO{today}{sequence:02d}'
-        
-        # 创建生产订单
-        production_order = super().create(validated_data)
-        
-        # 创建材料需求记录
-        try:
-            for material_data in material_requirements_data:
-                # material_name 已经被 validate_material_name 转换为 Material 对象
-                material = material_data.get('material_name')
-                
-                # 创建材料需求记录
-                MaterialRequirement.objects.create(
-                    production_order=production_order,
-                    material=material,
-                    required_quantity=material_data.get('required_quantity', 0),
-                    notes=material_data.get('notes', '')
-                )
-        except Exception as e:
-            # 如果创建材料需求失败，删除已创建的订单
-            production_order.delete()
-            raise serializers.ValidationError(f"创建材料需求失败: {str(e)}")
+            # 未填写材料需求时按产品物料清单自动生成
+            if not material_requirements_data:
+                create_bom_requirements([production_order])
+            
+            # 创建材料需求记录
+            try:
+                for material_data in material_requirements_data:
+                    # material_name 已经被 validate_material_name 转换为 Material 对象
+                    material = material_data.get('material_name')
+                    
+                    # 创建材料需求记录
+                    MaterialRequirement.objects.create(
+                        production_order=production_order,
+                        material=material,
+                        required_quantity=material_data.get('required_quantity', 0),
+                        notes=material_data.get('notes', '')
+                    )
+            except Exception as e:
+                # 如果创建材料需求失败，整个事务回滚，已创建的订单不会保留
+                raise serializers.ValidationError(f"创建材料需求失败: {str(e)}")
         
         return production_order
     
@@ -190,4 +188,33 @@ class EquipmentSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Equipment
-        fields = '__all__' 
\ No newline at end of file
+        fields = '__all__'
+
+class BatchLineageSerializer(serializers.ModelSerializer):
+    material_name = serializers.CharField(source='material.name', read_only=True)
+    supplier_name = serializers.CharField(source='supplier.name', read_only=True)
+    production_order_number = serializers.CharField(source='production_order.order_number', read_only=True)
+    sales_order_number = serializers.CharField(source='sales_order.order_number', read_only=True, default=None)
+    customer_name = serializers.CharField(source='customer.name', read_only=True, default=None)
+
+    class Meta:
+        model = BatchLineage
+        fields = '__all__'
+
+
+class MaterialPlanSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MaterialPlan
+        fields = '__all__'
+
+
+class MaterialPlanLineSerializer(serializers.ModelSerializer):
+    material_code = serializers.CharField(source='material.code', read_only=True)
+    material_name = serializers.CharField(source='material.name', read_only=True)
+    sales_order_number = serializers.CharField(source='sales_order.order_number', read_only=True, default=None)
+    production_order_number = serializers.CharField(
+        source='production_order.order_number', read_only=True, default=None)
+
+    class Meta:
+        model = MaterialPlanLine
+        fields = '__all__'
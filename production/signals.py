@@ -1,12 +1,14 @@
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
-from .models import ProductionOrder, ProcessSchedule
-from inventory.models import ProductMovement
+from .models import BatchLineage, ProductionOrder, ProductionMaterial, ProcessSchedule
+from .lineage import record_lineage
+from inventory.models import MaterialBatch, MaterialPurchase, ProductMovement
+from orders.models import Order
 from django.db import transaction
 from django.core.mail import send_mail
 from django.utils import timezone
-from django.db.models import Sum
+from django.db.models import Subquery, Sum
 
 @receiver(pre_save, sender=ProductionOrder)
 def handle_production_order_status_change(sender, instance, **kwargs):
@@ -34,6 +36,9 @@ def handle_production_order_status_change(sender, instance, **kwargs):
                         quantity=instance.completed_quantity,
                         unit=instance.product.unit,
                         reference_number=instance.order_number,
+                        source_type='production_order',
+                        source_id=instance.pk,
+                        reason='production_receipt',
                         notes=f'生产完成入库 - 生产单号：{instance.order_number}'
                     )
             
@@ -103,4 +108,54 @@ def calculate_process_load(process):
     # 计算负荷率
     if daily_capacity > 0:
         return (total_work / daily_capacity) * 100
-    return 0 
\ No newline at end of file
+    return 0
+
+
+@receiver(post_save, sender=ProductionMaterial)
+def sync_lineage_for_material_used(sender, instance, **kwargs):
+    """逐条保存的生产用料同步写入追溯记录（批量领料时由 issue_materials 直接写入）"""
+    BatchLineage.objects.filter(production_material=instance).delete()
+    record_lineage([instance])
+
+
+@receiver(post_save, sender=ProductionOrder)
+def sync_lineage_sales_order(sender, instance, created, **kwargs):
+    """生产单关联的销售订单变化时同步追溯记录"""
+    if created:
+        return
+    BatchLineage.objects.filter(production_order=instance).exclude(
+        sales_order_id=instance.sales_order_id
+    ).update(
+        sales_order_id=instance.sales_order_id,
+        customer_id=Subquery(Order.objects.filter(pk=instance.sales_order_id).values('customer')[:1]),
+    )
+
+
+@receiver(post_save, sender=Order)
+def sync_lineage_customer(sender, instance, created, **kwargs):
+    """销售订单的客户变化时同步追溯记录"""
+    if created:
+        return
+    BatchLineage.objects.filter(sales_order=instance).exclude(
+        customer_id=instance.customer_id
+    ).update(customer_id=instance.customer_id)
+
+
+@receiver(post_save, sender=MaterialPurchase)
+def sync_lineage_supplier(sender, instance, created, **kwargs):
+    """采购单的供应商变化时同步追溯记录"""
+    if created:
+        return
+    BatchLineage.objects.filter(purchase=instance).exclude(
+        supplier_id=instance.supplier_id
+    ).update(supplier_id=instance.supplier_id)
+
+
+@receiver(post_save, sender=MaterialBatch)
+def sync_lineage_batch_number(sender, instance, created, **kwargs):
+    """批次号变化时同步追溯记录"""
+    if created:
+        return
+    BatchLineage.objects.filter(material_batch=instance).exclude(
+        batch_number=instance.batch_number
+    ).update(batch_number=instance.batch_number)
@@ -1,3 +1,315 @@
+import datetime
+import unittest
+from io import StringIO
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import ProtectedError
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from inventory.models import (
+    Material, MaterialBatch, MaterialLocationStock, MaterialMovement, MaterialPurchase, Product,
+    ProductMaterial, PurchaseItem, Supplier,
+)
+from inventory.receiving import receive_delivery
+from inventory.tests import QueryPlanAssertions
+from orders.models import Customer, Order, OrderItem
+
+from .models import BatchLineage, MaterialRequirement, ProcessSchedule, ProductionMaterial, ProductionOrder
+from .allocation import preview_allocation
+from .planning import material_shortages, run_material_plan
+from .serializers import ProductionOrderSerializer
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN 仅适用于 SQLite')
+class HotQueryPlanTests(QueryPlanAssertions, TestCase):
+    """生产热点查询的执行计划"""
+
+    def test_process_schedules_by_start_time(self):
+        # 工序排程：某工序在某时间之后的排程
+        self.assertUsesIndex(
+            ProcessSchedule.objects.filter(process_id=1, planned_start_time__gte=timezone.now()),
+            'processsched_process_start_idx')
+
+    def test_lineage_traces(self):
+        # 正向追溯（按批次、按供应商批次号）和反向追溯（按销售订单）各一次按索引的查询
+        self.assertUsesIndex(
+            BatchLineage.objects.filter(material_batch_id=1).order_by('production_order_id'), 'lineage_batch_idx')
+        self.assertUsesIndex(
+            BatchLineage.objects.filter(supplier_id=1, batch_number='B001'), 'lineage_supplier_batch_idx')
+        self.assertUsesIndex(
+            BatchLineage.objects.filter(sales_order_id=1).order_by('material_batch_id'), 'lineage_sales_order_idx')
+
+
+class MaterialPlanTests(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.user = User.objects.create(username='planner')
+        self.customer = Customer.objects.create(code='C001', name='客户')
+        self.supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+        self.steel = Material.objects.create(code='M001', name='冰刀钢', unit='kg', stock=Decimal('10'))
+        self.blade = Product.objects.create(code='P001', name='冰刀', unit='双')
+        self.boot = Product.objects.create(code='P002', name='冰鞋', unit='双')
+
+    def _days(self, days):
+        return self.today + datetime.timedelta(days=days)
+
+    def _sales_order(self, number, delivery_in, status='pending', product=None):
+        order = Order.objects.create(
+            order_number=number, customer=self.customer, customer_order_number=number,
+            order_date=self.today, delivery_date=self._days(delivery_in), status=status,
+            created_by=self.user)
+        OrderItem.objects.create(
+            order=order, product=product or self.blade, quantity=Decimal('1'), unit='双')
+        return order
+
+    def _production_order(self, number, required, sales_order=None):
+        production_order = ProductionOrder.objects.create(
+            order_number=number, sales_order=sales_order, product=self.blade, planned_quantity=Decimal('1'))
+        MaterialRequirement.objects.create(
+            production_order=production_order, material=self.steel, required_quantity=required)
+        return production_order
+
+    def _purchase(self, number, quantity, delivery_in):
+        purchase = MaterialPurchase.objects.create(
+            purchase_number=number, supplier=self.supplier, purchase_date=self.today,
+            delivery_date=self._days(delivery_in), status='pending')
+        PurchaseItem.objects.create(
+            purchase=purchase, material=self.steel, control_number='C1',
+            specification='2mm', quantity=quantity, unit='kg')
+        return purchase
+
+    def test_time_phased_net_requirements(self):
+        self._production_order('PO001', Decimal('8'), self._sales_order('SO001', 5))
+        later = self._production_order('PO002', Decimal('12'), self._sales_order('SO002', 10, 'processing'))
+        # 不属于销售订单的生产单先占用库存
+        self._production_order('PO003', Decimal('3'))
+        # 销售订单已完成，不参与计划，但其未领用需求仍占用库存
+        completed = self._sales_order('SO003', 1)
+        Order.objects.filter(pk=completed.pk).update(status='completed')
+        self._production_order('PO004', Decimal('1'), completed)
+        self._purchase('CG001', Decimal('5'), 7)
+        self._sales_order('SO004', 20, product=self.boot)
+
+        # 已领用 2，生产单 PO002 的未领用需求为 10
+        received = MaterialPurchase.objects.create(
+            purchase_number='CG000', supplier=self.supplier, purchase_date=self.today, status='received')
+        batch = MaterialBatch.objects.create(
+            material=self.steel, batch_number='B001', purchase=received,
+            initial_quantity=Decimal('2'), remaining_quantity=Decimal('0'))
+        ProductionMaterial.objects.create(production_order=later, material_batch=batch, quantity_used=Decimal('2'))
+
+        result = run_material_plan(user=self.user)
+
+        plan = result['plan']
+        self.assertEqual(
+            (plan.order_count, plan.line_count, plan.shortage_count, plan.unplanned_line_count), (3, 2, 2, 1))
+        # 期初可用 10 - 3 - 1 = 6；第5天需求 8 缺 2；第7天到货 5；第10天需求 10 缺 7
+        self.assertEqual(
+            list(plan.lines.values_list(
+                'due_date', 'issued_quantity', 'open_quantity', 'available_quantity',
+                'shortage_quantity', 'projected_balance')),
+            [
+                (self._days(5), Decimal('0'), Decimal('8'), Decimal('6'), Decimal('2'), Decimal('-2')),
+                (self._days(10), Decimal('2'), Decimal('10'), Decimal('3'), Decimal('7'), Decimal('-7')),
+            ])
+        self.assertEqual(material_shortages(plan), [{
+            'material': self.steel.pk,
+            'material_code': 'M001',
+            'material_name': '冰刀钢',
+            'unit': 'kg',
+            'open_quantity': 18.0,
+            'shortage': 9.0,
+            'first_shortage_date': str(self._days(5)),
+        }])
+        self.assertEqual([line['product_code'] for line in result['unplanned_lines']], ['P002'])
+
+    def test_query_count_does_not_grow_with_orders(self):
+        for i in range(2):
+            self._production_order(f'PO{i:03d}', Decimal('1'), self._sales_order(f'SO{i:03d}', i))
+        with self.assertNumQueries(9):
+            run_material_plan()
+
+        for i in range(2, 30):
+            self._production_order(f'PO{i:03d}', Decimal('1'), self._sales_order(f'SO{i:03d}', i))
+        with self.assertNumQueries(9):
+            plan = run_material_plan()['plan']
+        self.assertEqual(plan.line_count, 30)
+
+    def test_unplanned_lines_exploded_by_bom(self):
+        cache.clear()
+        ProductMaterial.objects.create(product=self.boot, material=self.steel, quantity=Decimal('1.5'))
+        later = self._sales_order('SO001', 10)
+        production_order = self._production_order('PO001', Decimal('8'), later)
+        # 冰鞋订单尚未建生产单，按物料清单需要 3 kg，交货更早，先占用库存
+        early = self._sales_order('SO002', 5, product=self.boot)
+        OrderItem.objects.filter(order=early).update(quantity=Decimal('2'))
+        self._sales_order('SO003', 20, product=Product.objects.create(code='P003', name='鞋带', unit='副'))
+
+        result = run_material_plan()
+
+        plan = result['plan']
+        self.assertEqual(
+            list(plan.lines.order_by('due_date').values_list(
+                'sales_order', 'production_order', 'open_quantity', 'shortage_quantity')),
+            [
+                (early.pk, None, Decimal('3'), Decimal('0')),
+                (later.pk, production_order.pk, Decimal('8'), Decimal('1')),
+            ])
+        self.assertEqual(
+            [(line['product_code'], line['has_bom']) for line in result['unplanned_lines']],
+            [('P002', True), ('P003', False)])
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f'/api/production/material-plans/{plan.pk}/lines/'
+        self.assertEqual(client.get(url, {'material': 'abc'}).status_code, 400)
+        self.assertEqual(client.get(url, {'material': self.steel.pk}).status_code, 200)
+
+
+class ProductionOrderBomTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.steel = Material.objects.create(code='M001', name='冰刀钢', unit='kg')
+        self.blade = Product.objects.create(code='P001', name='冰刀', unit='双')
+        ProductMaterial.objects.create(
+            product=self.blade, material=self.steel, quantity=Decimal('0.333'), scrap_rate=Decimal('0.05'))
+
+    def test_requirements_generated_from_bom(self):
+        serializer = ProductionOrderSerializer(data={'product': self.blade.pk, 'planned_quantity': '10'})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        production_order = serializer.save()
+
+        requirement = production_order.material_requirements.get()
+        self.assertEqual(requirement.material, self.steel)
+        # 0.333 × 1.05 × 10 = 3.4965，向上取整到两位小数
+        self.assertEqual(requirement.required_quantity, Decimal('3.50'))
+        self.steel.refresh_from_db()
+        self.assertEqual(self.steel.reserved_stock, Decimal('3.50'))
+
+
+class MaterialIssueTests(TestCase):
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name='钢材供应商', code='S001')
+        self.blade = Product.objects.create(code='P001', name='冰刀', unit='双')
+
+    def _receive(self, number, material_count, quantity, location='', deliveries=1):
+        purchase = MaterialPurchase.objects.create(
+            purchase_number=number, supplier=self.supplier, purchase_date=timezone.localdate(),
+            status='pending')
+        items = {}
+        for i in range(material_count):
+            material = Material.objects.create(code=f'{number}-M{i}', name=f'材料{i}', unit='kg')
+            item = PurchaseItem.objects.create(
+                purchase=purchase, material=material, control_number=f'C{i}',
+                specification='2mm', quantity=quantity, unit='kg')
+            items[item.pk] = quantity / deliveries
+        # 每次到货为每种材料生成一个批次
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(deliveries):
+                receive_delivery(purchase.pk, items, location=location)
+        return [item.material for item in purchase.items.select_related('material').order_by('pk')]
+
+    def _production_order(self, number, materials, required):
+        production_order = ProductionOrder.objects.create(
+            order_number=number, product=self.blade, planned_quantity=Decimal('1'))
+        MaterialRequirement.objects.bulk_create([
+            MaterialRequirement(production_order=production_order, material=material, required_quantity=required)
+            for material in materials
+        ])
+        return production_order
+
+    def test_issue_from_receipt_location(self):
+        # 材料只入库到 WH2，领料从批次入库的库位出库
+        steel, = self._receive('PO001', 1, Decimal('10'), location='WH2')
+        production_order = self._production_order('MO001', [steel], Decimal('4'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            production_order.consume_materials()
+
+        self.assertEqual(
+            dict(MaterialLocationStock.objects.filter(material=steel).values_list('location', 'stock')),
+            {'WH2': Decimal('6')})
+        self.assertEqual(
+            list(MaterialMovement.objects.filter(reason='production_issue').values_list('location', 'quantity')),
+            [('WH2', Decimal('4'))])
+        steel.refresh_from_db()
+        self.assertEqual(steel.stock, Decimal('6'))
+
+    def test_issue_query_count_is_fixed(self):
+        # 20 种材料、每种 3 个批次，领料拆分为 60 个批次分配
+        materials = self._receive('PO001', 20, Decimal('9'), deliveries=3)
+        production_order = self._production_order('MO001', materials, Decimal('8'))
+
+        with self.assertNumQueries(24):
+            production_order.consume_materials()
+
+        self.assertEqual(ProductionMaterial.objects.filter(production_order=production_order).count(), 60)
+        self.assertEqual(
+            set(MaterialBatch.objects.values_list('remaining_quantity', 'status')),
+            {(Decimal('0'), 'depleted'), (Decimal('1'), 'normal')})
+        self.assertEqual(
+            set(Material.objects.filter(pk__in=[m.pk for m in materials]).values_list('stock', flat=True)),
+            {Decimal('1')})
+
+        small = self._production_order('MO002', self._receive('PO002', 2, Decimal('9'), deliveries=3), Decimal('8'))
+        with self.assertNumQueries(24):
+            small.consume_materials()
+
+    def test_preview_cached_until_batches_change(self):
+        cache.clear()
+        steel, = self._receive('PO001', 1, Decimal('9'), deliveries=3)
+        production_order = self._production_order('MO001', [steel], Decimal('8'))
+
+        preview = preview_allocation(production_order)
+        self.assertTrue(preview['can_start'])
+        self.assertFalse(preview['cached'])
+        with self.assertNumQueries(2):
+            self.assertTrue(preview_allocation(production_order)['cached'])
+
+        # 只改变批次（管理命令在其他进程中运行，数据库中的版本号随之递增），预览重新计算
+        MaterialBatch.objects.filter(material=steel).update(expiry_date=timezone.localdate())
+        call_command('expire_batches', date=str(timezone.localdate() + datetime.timedelta(days=1)), stdout=StringIO())
+
+        preview = preview_allocation(production_order)
+        self.assertFalse(preview['cached'])
+        self.assertFalse(preview['can_start'])
+        self.assertEqual(preview['shortfalls'][0]['messages'], ['材料 材料0 没有可用批次'])
+
+    def test_preview_without_requirements_cannot_start(self):
+        production_order = self._production_order('MO001', [], Decimal('1'))
+
+        preview = preview_allocation(production_order)
+        self.assertFalse(preview['can_start'])
+        self.assertEqual(preview['errors'], ['未设置物料清单，无法领料'])
+        with self.assertRaisesMessage(ValidationError, '未设置物料清单，无法领料'):
+            production_order.consume_materials()
+
+    def test_lineage_trace_and_protection(self):
+        steel, = self._receive('PO001', 1, Decimal('10'))
+        production_order = self._production_order('MO001', [steel], Decimal('4'))
+        with self.captureOnCommitCallbacks(execute=True):
+            production_order.consume_materials()
+        batch = MaterialBatch.objects.get(material=steel)
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('operator'))
+        response = client.get('/api/production/batch-lineage/forward/', {'batch': batch.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['quantity'] for row in response.data], [4.0])
+        self.assertEqual(client.get('/api/production/batch-lineage/forward/', {'batch': 'abc'}).status_code, 400)
+        self.assertEqual(
+            client.get('/api/production/batch-lineage/backward/', {'sales_order': 'abc'}).status_code, 400)
 
-# Create your tests here.
+        # 已被追溯的生产单和供应商不能删除，追溯记录保留
+        with self.assertRaises(ProtectedError):
+            production_order.delete()
+        with self.assertRaises(ProtectedError):
+            self.supplier.delete()
+        self.assertEqual(BatchLineage.objects.filter(material_batch=batch).count(), 1)
@@ -12,6 +12,8 @@ router.register(r'production-materials', views.ProductionMaterialViewSet)
 router.register(r'production-orders', views.ProductionOrderViewSet)
 router.register(r'production-progress', views.ProductionProgressViewSet)
 router.register(r'equipments', views.EquipmentViewSet)
+router.register(r'batch-lineage', views.BatchLineageViewSet)
+router.register(r'material-plans', views.MaterialPlanViewSet)
 
 app_name = 'production'
 
@@ -11,7 +11,9 @@ from .models import (
     ProductionProgress,
     ProcessStep,
     ProcessSchedule,
-    Equipment
+    Equipment,
+    BatchLineage,
+    MaterialPlan
 )
 from .serializers import (
     ProductSerializer,
@@ -21,8 +23,13 @@ from .serializers import (
     ProductionProgressSerializer,
     ProcessStepSerializer,
     ProcessScheduleSerializer,
-    EquipmentSerializer
+    EquipmentSerializer,
+    BatchLineageSerializer,
+    MaterialPlanSerializer,
+    MaterialPlanLineSerializer
 )
+from .lineage import forward_trace, backward_trace
+from .planning import material_shortages, run_material_plan
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -82,6 +89,85 @@ class ProductionMaterialViewSet(viewsets.ModelViewSet):
     filterset_fields = ['production_order', 'material_batch']
     search_fields = ['production_order__order_number']
 
+class BatchLineageViewSet(viewsets.ReadOnlyModelViewSet):
+    """批次追溯，由领料时自动维护"""
+    queryset = BatchLineage.objects.select_related(
+        'material', 'supplier', 'production_order', 'sales_order', 'customer')  # type: ignore[attr-defined]
+    serializer_class = BatchLineageSerializer
+    filterset_fields = ['material_batch', 'supplier', 'production_order', 'sales_order', 'customer']
+    search_fields = ['batch_number', 'production_order__order_number', 'sales_order__order_number']
+
+    @action(detail=False, methods=['get'])
+    def forward(self, request):
+        """正向追溯：批次用于哪些生产单和客户订单（?batch= 或 ?supplier=&batch_number=）"""
+        batch_id = request.query_params.get('batch')
+        supplier_id = request.query_params.get('supplier')
+        batch_number = request.query_params.get('batch_number')
+        try:
+            if batch_id:
+                return Response(forward_trace(batch_id=int(batch_id)))
+            if supplier_id and batch_number:
+                return Response(forward_trace(supplier_id=int(supplier_id), batch_number=batch_number))
+        except ValueError:
+            return Response({'error': '批次ID或供应商ID格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {'error': '请提供批次ID（batch），或供应商ID（supplier）和批次号（batch_number）'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    @action(detail=False, methods=['get'])
+    def backward(self, request):
+        """反向追溯：销售订单用到了哪些供应商批次（?sales_order=）"""
+        sales_order_id = request.query_params.get('sales_order')
+        if not sales_order_id:
+            return Response({'error': '请提供销售订单ID（sales_order）'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            sales_order_id = int(sales_order_id)
+        except ValueError:
+            return Response({'error': '销售订单ID格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(backward_trace(sales_order_id))
+
+class MaterialPlanViewSet(viewsets.ReadOnlyModelViewSet):
+    """物料需求计划，每次运行保存一份结果"""
+    queryset = MaterialPlan.objects.all()  # type: ignore[attr-defined]
+    serializer_class = MaterialPlanSerializer
+    filterset_fields = ['plan_date']
+
+    @action(detail=False, methods=['post'])
+    def run(self, request):
+        """对全部未完成销售订单运行一次物料需求计划，返回计划和按材料汇总的缺料"""
+        user = request.user if request.user.is_authenticated else None
+        result = run_material_plan(user=user)
+        plan = result['plan']
+        return Response({
+            'plan': self.get_serializer(plan).data,
+            'shortages': material_shortages(plan),
+            'unplanned_lines': result['unplanned_lines'],
+        }, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def shortages(self, request, pk=None):
+        """按材料汇总的缺料：净需求合计和最早缺料日期"""
+        return Response(material_shortages(self.get_object()))
+
+    @action(detail=True, methods=['get'])
+    def lines(self, request, pk=None):
+        """计划明细，可用 ?material= 筛选，?shortage_only=true 只看缺料"""
+        lines = self.get_object().lines.select_related('material', 'sales_order', 'production_order')
+        material_id = request.query_params.get('material')
+        if material_id:
+            try:
+                lines = lines.filter(material_id=int(material_id))
+            except ValueError:
+                return Response({'error': '材料ID格式不正确'}, status=status.HTTP_400_BAD_REQUEST)
+        if request.query_params.get('shortage_only') in ('1', 'true'):
+            lines = lines.filter(shortage_quantity__gt=0)
+
+        page = self.paginate_queryset(lines)
+        if page is not None:
+            return self.get_paginated_response(MaterialPlanLineSerializer(page, many=True).data)
+        return Response(MaterialPlanLineSerializer(lines, many=True).data)
+
 class ProductionOrderViewSet(viewsets.ModelViewSet):
     queryset = ProductionOrder.objects.all()  # type: ignore[attr-defined]
     serializer_class = ProductionOrderSerializer
@@ -99,6 +185,14 @@ class ProductionOrderViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=['get'])
+    def allocation_preview(self, request, pk=None):
+        """预览开始生产时的批次领料分配和缺料情况，不写入数据"""
+        from .allocation import preview_allocation
+
+        production_order = self.get_object()
+        return Response(preview_allocation(production_order))
+
     @action(detail=True, methods=['post'])
     def start_production(self, request, pk=None):
         """开始生产"""